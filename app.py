@@ -1,17 +1,75 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, BackgroundTasks
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from pathlib import Path
+import asyncio
 import logging
-import shutil
 import os
+import threading
+import time
 from typing import List
-# from uber_ocr_en import UberReceiptProcessor # using ocr
-from uber_llm_ocr import UberReceiptProcessor # using llm
 from tempfile import NamedTemporaryFile
+from jobs import JOB_WORKERS, JobManager, QueueFullError
+from uploads import UPLOAD_CHUNK_BYTES, UPLOAD_MAX_CHUNK_BYTES, UploadError, UploadManager
+from pdf_stream import QueueWriter
+from report_cache import ReportCache, get_default_report_cache
+from work_queue import WORK_DIR, get_work_queue
+from engines import DEFAULT_ENGINE, UnknownEngineError, check_engine, extraction_version, make_processor
+from receipt_events import format_sse
+from receipt_metrics import HTTP_IN_FLIGHT, HTTP_REQUESTS, get_trace, render, start_trace, timed
+from receipt_sources import (MEMORY_SOURCE_MAX_BYTES, UnreadableReceiptError, discard_source, expand_receipt_paths,
+                             is_receipt_file, spool_upload)
+
+# 提取引擎：llm（默认）、tesseract，或先用 tesseract、置信度低时再用 LLM 的 hybrid；
+# 每个请求可以用 engine 参数另选。引擎模块在第一次使用时才导入，启动时不加载 OCR 和 OpenAI
+RECEIPT_ENGINE = check_engine(DEFAULT_ENGINE)
+
+def new_processor(engine=None, **kwargs):
+    """Create a processor for the requested engine, or the configured one"""
+    return make_processor(engine or RECEIPT_ENGINE, **kwargs)
+
+def resolve_engine(engine):
+    """Validate a per-request engine name, rejecting unknown ones with 400"""
+    if not engine:
+        return None
+    try:
+        return check_engine(engine)
+    except UnknownEngineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 app = FastAPI()
+# 设置 WORK_QUEUE_PATH 后任务交给 receipt_worker 进程，否则在本进程的工作线程中处理
+if WORK_DIR:
+    os.makedirs(WORK_DIR, exist_ok=True)
+# 生成过的报告按内容缓存，同样的请求不再提取和渲染；REPORT_CACHE_DISABLED=1 关闭
+report_cache = get_default_report_cache()
+jobs = JobManager(new_processor, work_queue=get_work_queue(), report_cache=report_cache)
+uploads = UploadManager(new_processor)
+# 上传的小文件留在内存中直接交给引擎；worker 在其他进程中读取文件，所以使用工作队列时全部写到 WORK_DIR
+UPLOAD_MEMORY_LIMIT = 0 if jobs.work_queue is not None else MEMORY_SOURCE_MAX_BYTES
+# 同时进行的流式报告数，与任务工作线程数一致
+stream_slots = threading.BoundedSemaphore(JOB_WORKERS)
+# 没有新事件时 SSE 连接发送注释行的间隔（秒），防止代理断开空闲连接
+SSE_KEEPALIVE_SECONDS = 15
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """Per-route latency histogram and in-flight gauge"""
+    HTTP_IN_FLIGHT.inc(method=request.method)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec(method=request.method)
+        # 使用路由模板（如 /jobs/{job_id}）而不是实际路径，避免标签无限增长
+        route = request.scope.get("route")
+        HTTP_REQUESTS.observe(time.perf_counter() - start,
+                              route=getattr(route, "path", "unmatched"), status=status)
 
 # 设置静态文件和模板
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -27,61 +85,365 @@ templates = Jinja2Templates(directory="templates")
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+def wants_trace(request):
+    """Tracing is opt-in per request via ?trace=1 or an X-Trace: 1 header"""
+    return request.query_params.get("trace") == "1" or request.headers.get("x-trace") == "1"
+
+def save_uploads(files):
+    """Read uploaded images and PDFs once, returning (receipt refs, original names, content hashes)
+
+    Small files stay in memory and large ones spill to temp files; release the refs with discard_source.
+    A PDF that cannot be opened rejects the whole request with 400 instead of leaving its receipts out.
+    """
+    temp_files, names, digests = [], [], []
+    try:
+        for file in files:
+            if is_receipt_file(file.filename):
+                # 读取的同时计算哈希，之后提取和去重都不再读文件
+                ref, digest = spool_upload(file.file, file.filename, WORK_DIR, UPLOAD_MEMORY_LIMIT)
+                temp_files.append(ref)
+                names.append(file.filename)
+                digests.append(digest)
+                try:
+                    expand_receipt_paths([ref])
+                except UnreadableReceiptError as e:
+                    raise HTTPException(status_code=400, detail=f"Cannot read PDF {file.filename}: {e.__cause__}")
+    except Exception:
+        discard_uploads(temp_files)
+        raise
+    return temp_files, names, digests
+
+def discard_uploads(temp_files):
+    for file_path in temp_files:
+        try:
+            discard_source(file_path)
+        except Exception as e:
+            logging.error(f"Error deleting temporary file {file_path}: {e}")
+
+def report_key(digests, images_per_page, engine):
+    """Content key of the report these uploads produce, or None when the report cache is off"""
+    if report_cache is None:
+        return None
+    engine = engine or RECEIPT_ENGINE
+    return ReportCache.make_key(digests, images_per_page, engine, extraction_version(engine))
+
+def report_response(request, path, key=None, headers=None):
+    """Serve a finished report; a content key becomes the ETag and a matching If-None-Match gets 304"""
+    headers = dict(headers or {})
+    headers.update({
+        'Content-Type': 'application/pdf',
+        'Content-Disposition': f'inline; filename="expense_report.pdf"'
+    })
+    if key:
+        etag = f'"{key}"'
+        headers['ETag'] = etag
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers={'ETag': etag})
+    return FileResponse(path, headers=headers)
+
+async def submit_job(files, images_per_page, trace=None, engine=None):
+    """Save the uploads and queue a job, rejecting with 503 when the queue is full"""
+    with timed("upload_save", trace, files=len(files)):
+        temp_files, names, digests = await run_in_threadpool(save_uploads, files)
+    key = report_key(digests, images_per_page, engine)
+    try:
+        return jobs.submit(temp_files, names, images_per_page, trace, engine, key)
+    except QueueFullError as e:
+        discard_uploads(temp_files)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    files: List[UploadFile],
+    images_per_page: int = Form(4),
+    engine: str = Form(None)
+    ):
+    if not files:
+        raise HTTPException(status_code=400, detail="No files were uploaded")
+    engine = resolve_engine(engine)
+    trace = start_trace("/jobs") if wants_trace(request) else None
+    job = await submit_job(files, images_per_page, trace, engine)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "pdf_url": f"/jobs/{job.id}/pdf",
+        "events_url": f"/jobs/{job.id}/events",
+        "queue_depth": jobs.queue_depth(),
+        "trace_url": f"/traces/{trace.id}" if trace else None,
+    }
+
+def get_job_or_404(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job_or_404(job_id).to_dict()
+
+def event_stream(request, log, done_fields=None):
+    """Send an EventLog as Server-Sent Events; a reconnect with Last-Event-ID resumes where it stopped
+
+    done_fields are added to a successful done event, e.g. the report URL.
+    """
+    try:
+        after = int(request.headers.get("last-event-id") or 0)
+    except ValueError:
+        after = 0
+
+    async def body():
+        last = after
+        while True:
+            events, closed = await log.wait(last, SSE_KEEPALIVE_SECONDS)
+            for event_id, event, data in events:
+                last = event_id
+                if event == "done" and data.get("status") == "done" and done_fields:
+                    data = dict(data, **done_fields)
+                yield format_sse(event_id, event, data)
+            if closed:
+                return
+            if not events:
+                if await request.is_disconnected():
+                    return
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(body(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """Each receipt's result and the running totals as they are extracted, then a done event"""
+    job = get_job_or_404(job_id)
+    return event_stream(request, job.progress.log, {"pdf_url": f"/jobs/{job.id}/pdf"})
+
+@app.get("/jobs/{job_id}/pdf")
+async def job_pdf(job_id: str, request: Request):
+    job = get_job_or_404(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if not os.path.exists(job.output_path):
+        # The report cache evicted it to stay under its size limit
+        raise HTTPException(status_code=410, detail="Report is no longer available, submit the job again")
+    return report_response(request, job.output_path, job.report_key)
+
+def run_stream(temp_files, images_per_page, writer, engine=None):
+    """Extract and write the report into writer; runs on its own thread"""
+    try:
+        processor = new_processor(engine, output_path="expense_report.pdf", images_per_page=images_per_page)
+        processor.stream_pdf(temp_files, writer)
+        writer.close()
+    except Exception as e:
+        logging.exception("Streaming report failed")
+        writer.close(e)
+    finally:
+        discard_uploads(temp_files)
+        stream_slots.release()
+
+async def stream_report_response(request, files, images_per_page, engine=None):
+    """Stream the PDF to the client while receipts are still being extracted"""
+    if not stream_slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Too many reports in progress", headers={"Retry-After": "10"})
+    try:
+        temp_files, _, digests = await run_in_threadpool(save_uploads, files)
+    except Exception:
+        stream_slots.release()
+        raise
+    # A report generated before is sent whole; streamed reports are not stored in the cache
+    key = report_key(digests, images_per_page, engine)
+    hit = report_cache.get(key) if key else None
+    if hit is not None:
+        stream_slots.release()
+        discard_uploads(temp_files)
+        return report_response(request, hit[0], key)
+    writer = QueueWriter()
+    threading.Thread(target=run_stream, args=(temp_files, images_per_page, writer, engine),
+                     daemon=True).start()
+
+    async def body():
+        chunks = writer.chunks()
+        try:
+            while True:
+                chunk = await run_in_threadpool(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # Client went away: stop the producer instead of leaving it blocked on a full queue
+            writer.cancel()
+
+    # Headers go out before extraction finishes, so errors surface as a truncated PDF
+    return StreamingResponse(
+        body(),
+        media_type='application/pdf',
+        headers={'Content-Disposition': f'inline; filename="expense_report.pdf"'}
+    )
+
+def upload_error(e):
+    """Map an UploadError to an HTTP error; 409s carry the offset to resume from"""
+    headers = {"Upload-Offset": str(e.received)} if e.received is not None else None
+    return HTTPException(status_code=e.status, detail=str(e), headers=headers)
+
+def get_upload_or_404(upload_id):
+    session = uploads.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+@app.post("/uploads", status_code=201)
+async def create_upload(request: Request, images_per_page: int = Form(4), engine: str = Form(None)):
+    """Open a chunked upload; files are then sent with PUT /uploads/{id}/files/{index}"""
+    engine = resolve_engine(engine)
+    trace = start_trace("/uploads") if wants_trace(request) else None
+    try:
+        session = await run_in_threadpool(uploads.create, images_per_page, trace, engine)
+    except UploadError as e:
+        raise upload_error(e)
+    return {
+        "upload_id": session.id,
+        "status_url": f"/uploads/{session.id}",
+        "finish_url": f"/uploads/{session.id}/finish",
+        "events_url": f"/uploads/{session.id}/events",
+        "chunk_size": UPLOAD_CHUNK_BYTES,
+        "trace_url": f"/traces/{trace.id}" if trace else None,
+    }
+
+@app.put("/uploads/{upload_id}/files/{index}")
+async def upload_chunk(upload_id: str, index: int, name: str, request: Request):
+    """Store one chunk of a file; the raw body is placed at the Content-Range offset
+
+    Extraction of a file starts as soon as its last chunk arrives.
+    """
+    session = get_upload_or_404(upload_id)
+    if index < 0:
+        raise HTTPException(status_code=400, detail="File index must not be negative")
+    too_large = HTTPException(status_code=413, detail=f"Chunks are limited to {UPLOAD_MAX_CHUNK_BYTES} bytes")
+    if int(request.headers.get("content-length") or 0) > UPLOAD_MAX_CHUNK_BYTES:
+        raise too_large
+    # Chunked transfer encoding has no Content-Length, so the limit is also enforced while reading
+    data = bytearray()
+    async for part in request.stream():
+        data += part
+        if len(data) > UPLOAD_MAX_CHUNK_BYTES:
+            raise too_large
+    data = bytes(data)
+    try:
+        received = await run_in_threadpool(session.write_chunk, index, name,
+                                           request.headers.get("content-range"), data)
+    except UploadError as e:
+        raise upload_error(e)
+    return {"index": index, "received": received}
+
+@app.get("/uploads/{upload_id}")
+async def upload_status(upload_id: str):
+    """Bytes received per file (to resume from) and extraction progress"""
+    return get_upload_or_404(upload_id).status()
+
+@app.get("/uploads/{upload_id}/events")
+async def upload_events(upload_id: str, request: Request):
+    """Each receipt's result as soon as its file is uploaded and extracted, then a done event
+
+    The report itself is the response of the finish request.
+    """
+    return event_stream(request, get_upload_or_404(upload_id).progress.log)
+
+@app.post("/uploads/{upload_id}/finish")
+async def finish_upload(upload_id: str, background_tasks: BackgroundTasks):
+    """Wait for the remaining extractions and return the PDF report"""
+    session = get_upload_or_404(upload_id)
+    with NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
+        output_path = tmp_file.name
+    try:
+        await run_in_threadpool(session.finish, output_path)
+    except UploadError as e:
+        os.unlink(output_path)
+        raise upload_error(e)
+    except Exception as e:
+        logging.exception(f"Upload {upload_id} failed")
+        os.unlink(output_path)
+        uploads.discard(upload_id)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    def cleanup():
+        uploads.discard(upload_id)
+        os.unlink(output_path)
+
+    background_tasks.add_task(cleanup)
+    headers = {
+        'Content-Type': 'application/pdf',
+        'Content-Disposition': f'inline; filename="expense_report.pdf"'
+    }
+    if session.trace:
+        headers['X-Trace-Id'] = session.trace.id
+    return FileResponse(output_path, headers=headers)
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def cancel_upload(upload_id: str):
+    """Abandon an upload and drop whatever was received or extracted"""
+    get_upload_or_404(upload_id)
+    uploads.discard(upload_id)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/traces/{trace_id}")
+async def trace_detail(trace_id: str):
+    trace = get_trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace.to_dict()
+
 @app.post("/upload")
 async def process_receipts(
+    request: Request,
     files: List[UploadFile],
     background_tasks: BackgroundTasks,
-    images_per_page: int = Form(4)
+    images_per_page: int = Form(4),
+    stream: bool = Form(False),
+    engine: str = Form(None)
     ):
 
     # Validate input files
     if not files:
         raise HTTPException(status_code=400, detail="No files were uploaded")
+    engine = resolve_engine(engine)
 
-    # Using temp files to handle uploaded images and pdf
-    with NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-        temp_path = tmp_file.name
+    # Stream pages to the client as receipts are extracted
+    if stream:
+        return await stream_report_response(request, files, images_per_page, engine)
 
-        # Save uploaded files to temporary location
-        temp_files = []
-        for file in files:
-            if file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                with NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as f:
-                    shutil.copyfileobj(file.file, f)
-                    temp_files.append(f.name)
-
-        # Process receipts
-        processor = UberReceiptProcessor(
-            output_path=temp_path,
-            images_per_page=images_per_page
-        )
-
-        for file_path in temp_files:
-            processor.add_receipt(file_path)
-        processor.create_pdf()
-
-        # Clean up temporary image files
-        for file_path in temp_files:
-            try:
-                os.unlink(file_path)
-            except Exception as e:
-                logging.error(f"Error deleting temporary file {file_path}: {e}")
-
-        # Return the PDF file
-        try:
-            response = FileResponse(
-                temp_path,
-                headers={
-                    'Content-Type': 'application/pdf',
-                    'Content-Disposition': f'inline; filename="expense_report.pdf"'
-                }
-            )
-            # Delete the temporary PDF file after it's been sent
-            background_tasks.add_task(os.unlink, temp_path)
-            return response
-        except Exception as e:
-            logging.error(f"Error sending PDF file: {e}")
-            raise HTTPException(status_code=500, detail=str(e))
+    # Extraction and rendering run on the job workers, not on the event loop
+    trace = start_trace("/upload") if wants_trace(request) else None
+    job = await submit_job(files, images_per_page, trace, engine)
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def resolve(j):
+        if not finished.done():
+            finished.set_result(j)
+
+    job.add_done_callback(lambda j: loop.call_soon_threadsafe(resolve, j))
+    await finished
+
+    if job.status != "done":
+        jobs.discard(job.id)
+        raise HTTPException(status_code=500, detail=job.error)
+
+    # Return the PDF file; cached reports carry an ETag and are kept for the next identical request
+    try:
+        headers = {'X-Trace-Id': trace.id} if trace else None
+        response = report_response(request, job.output_path, job.report_key, headers)
+        # Delete the temporary PDF file after it's been sent
+        background_tasks.add_task(jobs.discard, job.id)
+        return response
+    except Exception as e:
+        logging.error(f"Error sending PDF file: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
     # 处理收据
     # output_path = str(OUTPUT_DIR / "expense_report.pdf")
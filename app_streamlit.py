@@ -1,9 +1,21 @@
 import streamlit as st
-from pathlib import Path
-import tempfile
-from uber_ocr_en import UberReceiptProcessor
+import hashlib
+import io
 import os
-import base64
+import shutil
+import tempfile
+import weakref
+from engines import make_processor
+from receipt_report import StreamingReportWriter
+from receipt_sources import discard_source, is_pdf, make_page_ref, open_receipt_image, put_memory, split_page_ref
+
+# 提取引擎，默认与之前一样使用本地 tesseract
+ENGINE = os.getenv("RECEIPT_ENGINE", "tesseract")
+# 预览缩略图的最长边（像素）和 PDF 首页预览的栅格化 DPI
+THUMBNAIL_SIZE = 320
+THUMBNAIL_DPI = 40
+# 进程内缓存的缩略图数量，所有会话共用
+THUMBNAIL_CACHE_ENTRIES = 512
 
 
 st.set_page_config(
@@ -12,16 +24,115 @@ st.set_page_config(
     layout="wide"
 )
 
+
+def _release(dir, sources):
+    shutil.rmtree(dir, True)
+    for ref in sources.values():
+        discard_source(ref)
+
+
+class ReceiptSession:
+    """每个浏览器会话自己的上传、提取结果和最近一次生成的报告
+
+    上传的文件已经在内存中，直接以内存引用交给引擎，不写入磁盘；
+    提取结果按文件内容哈希保存，重新运行脚本（点击按钮、修改设置）时不会重复提取；
+    会话结束、对象被回收时释放上传的文件并删除会话目录。
+    """
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="receipt_session_")
+        self.files = {}  # 上传控件的 file_id -> (内容哈希, 收据引用)
+        self.sources = {}  # 内容哈希 -> 内存引用
+        self.results = {}  # 内容哈希 -> 每页一条的提取结果
+        self.processor = None
+        self.report_key = None
+        self.report = None
+        weakref.finalize(self, _release, self.dir, self.sources)
+
+    def save(self, file):
+        """登记上传的文件，同一文件只哈希一次，同样内容只保留一份"""
+        if file.file_id not in self.files:
+            data = file.getvalue()
+            digest = hashlib.sha256(data).hexdigest()
+            if digest not in self.sources:
+                # 引用保留原文件名，报告里的重复列表仍显示原名
+                self.sources[digest] = put_memory(data, file.name, digest)
+            self.files[file.file_id] = (digest, self.sources[digest])
+        return self.files[file.file_id]
+
+    def extract(self, files, on_progress=None):
+        """只提取还没有结果的文件；处理器在会话内复用，去重也覆盖之前提取过的文件"""
+        todo = {path: digest for digest, path in files if digest not in self.results}
+        if not todo:
+            return
+        if self.processor is None:
+            self.processor = make_processor(ENGINE, output_path=os.path.join(self.dir, "report.pdf"))
+        paths = list(todo)
+        done = [0]
+
+        def on_result(index, receipt_info):
+            done[0] += 1
+            if on_progress:
+                on_progress(done[0])
+
+        by_file = {}
+        for receipt_info in self.processor.add_receipts(paths, on_result=on_result):
+            by_file.setdefault(split_page_ref(receipt_info['path'])[0], []).append(receipt_info)
+        for path, digest in todo.items():
+            self.results[digest] = by_file.get(path, [])
+
+    def receipts(self, files):
+        """按上传顺序排列的收据；代表收据已被移除时不再标记为重复"""
+        receipts = [r for digest, _ in files for r in self.results.get(digest, [])]
+        present = {r['path'] for r in receipts}
+        return [r if r.get('duplicate_of') in present or 'duplicate_of' not in r
+                else {k: v for k, v in r.items() if k != 'duplicate_of'}
+                for r in receipts]
+
+    def render(self, files, images_per_page):
+        """生成报告PDF；文件和版式都没变时直接返回上次的结果"""
+        key = (tuple(digest for digest, _ in files), images_per_page)
+        if key != self.report_key:
+            out = io.BytesIO()
+            writer = StreamingReportWriter(out, images_per_page)
+            for receipt in self.receipts(files):
+                writer.add(receipt)
+            writer.close()
+            self.report_key, self.report = key, out.getvalue()
+        return self.report
+
+
+@st.cache_data(max_entries=THUMBNAIL_CACHE_ENTRIES, show_spinner=False)
+def thumbnail(digest, _path):
+    """按内容哈希缓存的 JPEG 缩略图；_path 不参与缓存键"""
+    ref = make_page_ref(_path, 1) if is_pdf(_path) else _path
+    with open_receipt_image(ref, THUMBNAIL_DPI) as img:
+        # JPEG 可以直接按缩小的尺寸解码
+        img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        img = img.convert("RGB")
+    img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def get_session():
+    if "receipts" not in st.session_state:
+        st.session_state.receipts = ReceiptSession()
+    return st.session_state.receipts
+
+
 def main():
     st.title("🧾 Uber Receipt Processor")
     st.write("Upload your Uber receipts and get an organized PDF report")
+    session = get_session()
 
     # File upload section with drag & drop
     uploaded_files = st.file_uploader(
         "Drop your Uber receipts here",
-        type=['png', 'jpg', 'jpeg'],
+        type=['png', 'jpg', 'jpeg', 'pdf'],
         accept_multiple_files=True,
-        help="You can upload multiple receipt images at once"
+        help="You can upload multiple receipt images or PDFs at once"
     )
 
     # Sidebar for options
@@ -37,90 +148,64 @@ def main():
 
     # Preview section
     if uploaded_files:
+        files = [session.save(file) for file in uploaded_files]
         st.subheader(f"Preview ({len(uploaded_files)} files)")
 
         # Create a grid layout for previews
         cols = st.columns(5)
-        for idx, file in enumerate(uploaded_files):
-            with cols[idx % 4]:
-                st.image(file, caption=file.name, use_column_width=True)
+        for idx, (file, (digest, path)) in enumerate(zip(uploaded_files, files)):
+            with cols[idx % 5]:
+                try:
+                    st.image(thumbnail(digest, path), caption=file.name, use_container_width=True)
+                except Exception:
+                    st.write(f"📄 {file.name}")
 
-        # Process button
-        if st.button("Process Receipts", type="primary"):
+        # 已提取过的文件直接使用结果，只有新文件需要点击处理
+        pending = sum(1 for digest, _ in files if digest not in session.results)
+        if pending and st.button("Process Receipts", type="primary"):
             with st.spinner("Processing receipts..."):
                 try:
-                    # Create temporary directory for processing
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        temp_dir = Path(temp_dir)
-
-                        # Progress bar
-                        progress_bar = st.progress(0)
-                        status_text = st.empty()
-
-                        # Save uploaded files
-                        saved_files = []
-                        for idx, file in enumerate(uploaded_files):
-                            temp_file = temp_dir / file.name
-                            temp_file.write_bytes(file.getvalue())
-                            saved_files.append(temp_file)
-
-                            # Update progress
-                            progress = (idx + 1) / (len(uploaded_files) * 2)  # First half for saving
-                            progress_bar.progress(progress)
-                            status_text.text(f"Saving file {idx + 1} of {len(uploaded_files)}...")
-
-                        # Process receipts
-                        output_pdf = Path(__file__).parent / "report"/"streamlit_output.pdf"
-                        processor = UberReceiptProcessor(
-                            str(output_pdf),
-                            images_per_page=images_per_page
-                        )
-
-                        # Process each receipt
-                        receipt_info = []
-                        for idx, file in enumerate(saved_files):
-                            processor.add_receipt(str(file))
-                            receipt_info.append(processor.receipts[-1])
-                            # info = processor.extract_info_from_image(str(file))
-                            # receipt_info.append((file.name, info))
-
-                            # Update progress
-                            progress = 0.5 + (idx + 1) / (len(uploaded_files) * 2)  # Second half for processing
-                            progress_bar.progress(progress)
-                            status_text.text(f"Processing receipt {idx + 1} of {len(uploaded_files)}...")
-
-                        # Generate PDF
-                        processor.create_pdf()
-                        progress_bar.progress(1.0)
-                        status_text.text("Processing complete...")
-
-                        # Show results
-                        st.success("✅ All receipts processed successfully!")
-
-                        # Display receipt information in a table
-                        if receipt_info:
-                            st.subheader("Receipt Details")
-                            for receipt in receipt_info:
-                                # print(receipt)
-                                st.write(f"**{receipt}**")
-                                # st.write(f"**Total$:** ${receipt.amount:.2f}")
-                                # st.write(f"**Type:** {receipt.type}")
-                                # st.write(f"**Date:** {receipt.date}")
-                                st.write("---")  # Adds a horizontal line between receipts
-
-                        # Offer PDF download
-                        with open(output_pdf, "rb") as pdf_file:
-                            st.download_button(
-                                "📥 Download Report",
-                                pdf_file,
-                                "streamlit_uber_receipts_report.pdf",
-                                "application/pdf",
-                                use_container_width=True
-                            )
+                    progress_bar = st.progress(0)
+                    status_text = st.empty()
+
+                    def on_progress(done):
+                        progress_bar.progress(min(done / pending, 1.0))
+                        status_text.text(f"Processed {done} receipts...")
 
+                    session.extract(files, on_progress)
+                    progress_bar.progress(1.0)
+                    status_text.text("Processing complete...")
+                    st.success("✅ All receipts processed successfully!")
                 except Exception as e:
                     st.error(f"❌ An error occurred: {str(e)}")
                     st.write("Please make sure all files are valid receipt images and try again.")
+            pending = sum(1 for digest, _ in files if digest not in session.results)
+
+        if pending:
+            st.info(f"{pending} new files to process")
+        else:
+            # 修改版式只重新生成PDF，不重新提取
+            try:
+                report = session.render(files, images_per_page)
+            except Exception as e:
+                st.error(f"❌ Could not generate the report: {str(e)}")
+                return
+
+            # Display receipt information in a table
+            st.subheader("Receipt Details")
+            for receipt in session.receipts(files):
+                st.write(f"**{receipt}**")
+                st.write("---")  # Adds a horizontal line between receipts
+
+            # Offer PDF download
+            st.download_button(
+                "📥 Download Report",
+                report,
+                "streamlit_uber_receipts_report.pdf",
+                "application/pdf",
+                on_click="ignore",
+                use_container_width=True
+            )
     else:
         # Show instructions when no files are uploaded
         st.info("👆 Upload your Uber receipt images to get started!")
@@ -0,0 +1,102 @@
+"""启动耗时预算：在干净的子进程中测每个入口模块的导入时间，超出预算或导入了重依赖时返回非零
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --repeat 5 --budget app=700 --output import_time.json
+
+引擎模块由 engines 在第一次使用时导入，所以 app 和 engines 不应该加载 OpenAI、pytesseract 或任何引擎。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# 每个模块的导入时间预算（毫秒，取多次运行的最小值）；app 的大部分时间是 fastapi 本身
+BUDGETS_MS = {
+    "engines": 20,
+    "receipt_batch": 250,
+    "uber_llm_ocr": 300,
+    "uber_ocr_en": 300,
+    "uber_hybrid_ocr": 350,
+    "app": 900,
+}
+# 导入这些模块时不允许连带导入的重依赖
+FORBIDDEN = {
+    "engines": ("openai", "pytesseract", "uber_llm_ocr", "uber_ocr_en"),
+    "receipt_batch": ("openai", "pytesseract", "numpy", "uber_llm_ocr", "uber_ocr_en"),
+    "uber_llm_ocr": ("openai", "httpx", "pytesseract", "pandas", "numpy"),
+    "uber_ocr_en": ("openai", "pytesseract", "pandas", "numpy"),
+    "uber_hybrid_ocr": ("openai", "pytesseract", "pandas", "numpy"),
+    "app": ("openai", "pytesseract", "pandas", "numpy", "uber_llm_ocr", "uber_ocr_en", "uber_hybrid_ocr"),
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module):
+    """导入一次 module，返回 (毫秒, 被连带导入的禁用模块)"""
+    code = (f"import sys, json; import {module}; "
+            f"print(json.dumps([m for m in {list(FORBIDDEN.get(module, ()))!r} if m in sys.modules]))")
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True, cwd=ROOT, env=env)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed: {(proc.stderr.strip().splitlines() or ['?'])[-1]}")
+    # -X importtime 的每行格式为 "import time: self | cumulative | name"，顶层模块的累计时间就是总耗时
+    for line in proc.stderr.splitlines():
+        parts = [p.strip() for p in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            microseconds = int(parts[1])
+            break
+    else:
+        raise RuntimeError(f"no importtime line for {module}")
+    return microseconds / 1000, json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def check(budgets, repeat=3):
+    """逐个模块测量，返回结果列表"""
+    results = []
+    for module, budget in budgets.items():
+        samples, loaded = [], []
+        for _ in range(repeat):
+            ms, loaded = measure(module)
+            samples.append(ms)
+        best = min(samples)
+        results.append({
+            "module": module,
+            "ms": round(best, 1),
+            "budget_ms": budget,
+            "forbidden_imports": loaded,
+            "ok": best <= budget and not loaded,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time budget check")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--budget", action="append", default=[], metavar="MODULE=MS",
+                        help="override or add a budget")
+    parser.add_argument("--modules", default=None, help="comma separated subset to check")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    budgets = dict(BUDGETS_MS)
+    for item in args.budget:
+        module, _, ms = item.partition("=")
+        budgets[module] = float(ms)
+    if args.modules:
+        budgets = {m: budgets[m] for m in args.modules.split(",") if m}
+
+    results = check(budgets, args.repeat)
+    for r in results:
+        extra = f"  loads {', '.join(r['forbidden_imports'])}" if r["forbidden_imports"] else ""
+        print(f"{'ok  ' if r['ok'] else 'FAIL'} {r['module']:<16} {r['ms']:>8.1f} ms  "
+              f"(budget {r['budget_ms']:g} ms){extra}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
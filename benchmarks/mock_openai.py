@@ -0,0 +1,189 @@
+"""本地模拟的 chat-completions 服务，可配置延迟和错误率
+
+收到图片后用缩略图找到最接近的合成收据，返回它的标准答案，
+因此准确率反映的是预处理、批量拆分和解析是否正确，而不是模型本身。
+
+    python -m benchmarks.mock_openai --truth /tmp/receipts --port 8765 --latency 0.5 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python uber_llm_ocr.py
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageChops, ImageOps
+from receipt_sources import autocrop
+from benchmarks.synthetic import load_dataset
+
+PROMPT_TOKENS_PER_IMAGE = {"low": 85, "high": 765}
+PROMPT_TOKENS_TEXT = 250
+COMPLETION_TOKENS_PER_RECEIPT = 30
+# 比较用的灰度缩略图尺寸；同一版式的收据只差几行字，16x16 的感知哈希分不开，这个尺寸可以
+SIGNATURE_SIZE = (64, 128)
+
+
+def signature(img):
+    """和 LLM 预处理一样裁掉空白、转灰度后缩到 SIGNATURE_SIZE"""
+    return autocrop(ImageOps.exif_transpose(img).convert("L")).resize(SIGNATURE_SIZE, Image.BOX)
+
+
+def distance(a, b):
+    """两个缩略图逐像素差的绝对值之和"""
+    return sum(value * count for value, count in enumerate(ImageChops.difference(a, b).histogram()))
+
+
+class MockOpenAI:
+    """模拟服务的配置、标准答案索引和请求计数"""
+
+    def __init__(self, dataset=(), latency=0.3, jitter=0.1, per_image_latency=0.05,
+                 error_rate=0.0, malformed_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.per_image_latency = per_image_latency
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "images": 0, "errors": 0, "malformed": 0, "tokens": 0}
+        self._truth = []
+        for item in dataset:
+            with Image.open(item["path"]) as img:
+                self._truth.append((signature(img), item))
+        self._server = None
+
+    def _roll(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def _count(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self.counters[key] += value
+
+    def lookup(self, img):
+        """返回缩略图最接近的标准答案；没有数据集时返回固定答案"""
+        if not self._truth:
+            return {"type": "Trip", "date": "2024-01-01", "amount": 10.0}
+        value = signature(img)
+        return min(self._truth, key=lambda entry: distance(value, entry[0]))[1]
+
+    def answer(self, body):
+        """根据请求内容构造回复，返回 (HTTP 状态码, 回复 JSON)"""
+        content = body["messages"][0]["content"]
+        images = []
+        details = []
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    url = part["image_url"]["url"]
+                    images.append(base64.b64decode(url.split(",", 1)[1]))
+                    details.append(part["image_url"].get("detail", "high"))
+
+        time.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)
+                       + self.per_image_latency * len(images)))
+        self._count(requests=1, images=len(images))
+        if self._roll(self.error_rate):
+            self._count(errors=1)
+            return 429 if self._roll(0.5) else 500, {"error": {"message": "mock error", "type": "server_error"}}
+
+        answers = []
+        for data in images:
+            with Image.open(io.BytesIO(data)) as img:
+                truth = self.lookup(img)
+            date = datetime.strptime(truth["date"], "%Y-%m-%d")
+            answers.append({"type": truth["type"], "date": date.strftime("%b %d, %Y"),
+                            "amount": f"${truth['amount']:.2f}"})
+        if not answers:
+            # 纯文本请求（PDF 文本层）：合成数据集没有这种收据，返回固定答案
+            answers.append({"type": "Trip", "date": "Jan 01, 2024", "amount": "$10.00"})
+
+        if len(images) > 1:
+            text = json.dumps([dict(answer, index=i + 1) for i, answer in enumerate(answers)])
+        else:
+            text = json.dumps(answers[0])
+        if self._roll(self.malformed_rate):
+            self._count(malformed=1)
+            text = text[:len(text) // 2]
+
+        prompt_tokens = sum(PROMPT_TOKENS_PER_IMAGE.get(d, 765) for d in details) or PROMPT_TOKENS_TEXT
+        completion_tokens = COMPLETION_TOKENS_PER_RECEIPT * len(answers)
+        self._count(tokens=prompt_tokens + completion_tokens)
+        return 200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def start(self, host="127.0.0.1", port=0):
+        """在后台线程中启动服务，返回 base_url"""
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, headers=()):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    self._send(200, mock.counters)
+                else:
+                    self._send(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, payload = mock.answer(body)
+                self._send(status, payload, [("Retry-After", "0")] if status == 429 else ())
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock chat-completions server for benchmarks")
+    parser.add_argument("--truth", help="directory produced by benchmarks.synthetic")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    mock = MockOpenAI(load_dataset(args.truth) if args.truth else (), args.latency, args.jitter,
+                      error_rate=args.error_rate, malformed_rate=args.malformed_rate)
+    print(f"Mock chat-completions listening on {mock.start(args.host, args.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,626 @@
+"""基准测试：提取、create_pdf 和 /upload 端到端的吞吐量、延迟分位数、峰值内存和准确率
+
+    python -m benchmarks.run --count 40 --output bench.json
+    python -m benchmarks.run --stages extract --engines llm --batch-size 4 --error-rate 0.05
+    python -m benchmarks.run --stages workers --worker-counts 1,2,4 --latency 0.3
+    python -m benchmarks.run --stages upload --upload-concurrency 8 --upload-requests 32
+    python -m benchmarks.run --stages create_pdf --short-meals --layouts row,grid,shelf
+    python -m benchmarks.run --stages ledger --ledger-receipts 100000
+    python -m benchmarks.run --stages decode --image-cache-sizes 0,64,512 --image-format JPEG
+
+每个测试在独立的子进程中运行，峰值 RSS 互不影响；结果写成 JSON，便于和之前的结果比较。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from benchmarks.synthetic import generate_dataset, load_dataset
+
+STAGES = ("extract", "create_pdf", "upload", "workers", "ledger", "decode")
+ENGINES = ("llm", "tesseract", "hybrid")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    """最近秩法分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def latency_summary(latencies):
+    return {
+        "samples": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+    }
+
+
+def peak_rss_mb():
+    """本进程和已结束的子进程（OCR 进程池）中最大的常驻内存，单位 MB"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": own / scale, "children": children / scale}
+
+
+def process_io():
+    """/proc/self/io 中的读写字节数和系统调用次数（仅 Linux）；read_bytes/write_bytes 是真正到达块设备的部分"""
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return None
+
+
+def io_delta(before, after, requests):
+    """两次 process_io() 之间每个请求的平均值"""
+    if before is None or after is None:
+        return None
+    return {key: (after[key] - before[key]) / requests for key in after}
+
+
+def normalize_date(value):
+    """把各引擎返回的日期统一成 YYYY-MM-DD，无法识别时返回 None"""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    for fmt in ("%b %d, %Y", "%a %b %d %Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(str(value).strip(), fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def accuracy(results, dataset):
+    """逐字段比较提取结果和标准答案"""
+    truth = {item["path"]: item for item in dataset}
+    counts = {"type": 0, "date": 0, "amount": 0, "all": 0}
+    for result in results:
+        expected = truth[result["path"]]
+        ok = {
+            "type": result["type"] == expected["type"],
+            "date": normalize_date(result["date"]) == expected["date"],
+            "amount": abs(result["amount"] - expected["amount"]) < 0.005,
+        }
+        ok["all"] = all(ok.values())
+        for key, value in ok.items():
+            counts[key] += value
+    return {key: value / len(results) for key, value in counts.items()} if results else {}
+
+
+def _start_mock(dataset, args):
+    """启动模拟服务并让 OpenAI 客户端指向它；必须在导入 uber_llm_ocr 之前调用"""
+    from benchmarks.mock_openai import MockOpenAI
+    mock = MockOpenAI(dataset, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, malformed_rate=args.malformed_rate)
+    os.environ["OPENAI_BASE_URL"] = mock.start()
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    return mock
+
+
+def _make_processor(engine, args, output_path):
+    # 关闭缓存，每次都真正执行提取；去重保持默认设置，不同的收据不应被合并
+    if engine == "llm":
+        from uber_llm_ocr import UberReceiptProcessor
+        return UberReceiptProcessor(output_path, cache=False, batch_size=args.batch_size)
+    if engine == "hybrid":
+        from uber_llm_ocr import UberReceiptProcessor as LLMProcessor
+        from uber_hybrid_ocr import UberReceiptProcessor
+        # 去重由混合引擎自己完成
+        llm = LLMProcessor(output_path, cache=False, dedup_threshold=-1, batch_size=args.batch_size)
+        return UberReceiptProcessor(output_path, cache=False, llm=llm)
+    # tesseract-roi / tesseract-full 指定OCR模式
+    from uber_ocr_en import OCR_MODE, UberReceiptProcessor
+    mode = engine.partition("-")[2] or OCR_MODE
+    return UberReceiptProcessor(output_path, cache=False, ocr_mode=mode)
+
+
+def bench_extract(dataset, args):
+    """单张串行提取的延迟分位数，以及 add_receipts 并发提取的吞吐量和准确率"""
+    mock = _start_mock(dataset, args) if args.variant in ("llm", "hybrid") else None
+    paths = [item["path"] for item in dataset]
+    output_path = os.path.join(args.workdir, f"extract_{args.variant}.pdf")
+
+    processor = _make_processor(args.variant, args, output_path)
+    latencies = []
+    for path in paths[:args.latency_samples]:
+        start = time.perf_counter()
+        processor.extract_info_from_image(path)
+        latencies.append(time.perf_counter() - start)
+
+    processor = _make_processor(args.variant, args, output_path)
+    start = time.perf_counter()
+    results = processor.add_receipts(paths)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "receipts": len(paths),
+        "seconds": elapsed,
+        "throughput": len(paths) / elapsed,
+        "latency": latency_summary(latencies),
+        "accuracy": accuracy(results, dataset),
+        # 数据集中的收据各不相同，这里应该是 0
+        "duplicates": sum(1 for r in results if 'duplicate_of' in r),
+    }
+    if args.variant.startswith("tesseract"):
+        # 单张收据各OCR阶段的平均耗时，用来比较 roi 和 full 两种模式
+        from receipt_metrics import STAGE_SECONDS
+        result["stages"] = {key[0]: mean for key, mean in sorted(STAGE_SECONDS.means().items())}
+    if args.variant == "hybrid":
+        result["escalations"] = processor.summarize_escalations()
+    elif mock is not None:
+        result["batch_size"] = args.batch_size
+        result["requests"] = processor.summarize_request_stats()
+    if mock is not None:
+        result["mock"] = dict(mock.counters)
+        mock.stop()
+    return result
+
+
+def bench_create_pdf(dataset, args):
+    """用标准答案作为提取结果，只测报告生成
+
+    row / grid / shelf 比较页面版式（快速渲染），legacy 是原来的单行版式加直接嵌入原图；
+    grid 和 shelf 每页 --grid-images-per-page 张。记录页数、PDF大小和最窄的图片宽度（可读性的下限）。
+    """
+    from receipt_report import PAGE_SIZE, receipt_aspect, write_report
+    from receipt_sources import get_image_cache, pdf_page_count
+    from report_layout import make_layout
+    receipts = [dict(item, date=datetime.strptime(item["date"], "%Y-%m-%d").strftime("%b %d, %Y"))
+                for item in dataset]
+    total = sum(item["amount"] for item in dataset)
+    output_path = os.path.join(args.workdir, f"report_{args.variant}.pdf")
+    fast = args.variant != "legacy"
+    layout = "row" if args.variant == "legacy" else args.variant
+    images_per_page = args.grid_images_per_page if layout in ("grid", "shelf") else 4
+
+    latencies = []
+    for _ in range(args.repeat):
+        # 每次都从解码开始，不使用上一次留在缓存中的图片
+        get_image_cache().clear()
+        start = time.perf_counter()
+        write_report(output_path, receipts, total, images_per_page, fast=fast, layout=layout)
+        latencies.append(time.perf_counter() - start)
+    pages = make_layout(PAGE_SIZE, images_per_page, mode=layout).paginate(
+        (receipt, receipt_aspect(receipt)) for receipt in receipts)
+    return {
+        "receipts": len(receipts),
+        "layout": layout,
+        "min_image_width": min(placement.width for page in pages for placement in page),
+        "seconds": sum(latencies),
+        "throughput": len(receipts) * len(latencies) / sum(latencies),
+        "latency": latency_summary(latencies),
+        "pdf_bytes": os.path.getsize(output_path),
+        "pages": pdf_page_count(output_path),
+    }
+
+
+def bench_upload(dataset, args):
+    """通过 TestClient 并发调用 /upload，统计端到端延迟和每个请求的磁盘读写、系统调用次数
+
+    file-disk 变体把所有上传写入临时文件再读回（UPLOAD_MEMORY_MAX_BYTES=0），与默认的内存路径对比。
+    """
+    # 模拟服务会导入 receipt_dedup 和 receipt_sources，环境变量要在启动它之前设置
+    os.environ["RECEIPT_CACHE_DISABLED"] = "1"
+    # 每次请求都真正提取和渲染
+    os.environ["REPORT_CACHE_DISABLED"] = "1"
+    # 并发的请求都能拿到工作线程和流式报告的名额
+    os.environ["JOB_WORKERS"] = str(args.upload_concurrency)
+    if args.variant == "file-disk":
+        os.environ["UPLOAD_MEMORY_MAX_BYTES"] = "0"
+    _start_mock(dataset, args)
+    from fastapi.testclient import TestClient
+    import app
+
+    stream = args.variant == "stream"
+    payloads = []
+    for item in dataset:
+        with open(item["path"], "rb") as f:
+            payloads.append((os.path.basename(item["path"]), f.read()))
+
+    def post(i):
+        batch = payloads[(i * args.upload_files) % len(payloads):][:args.upload_files]
+        files = [("files", (name, io.BytesIO(data))) for name, data in batch]
+        start = time.perf_counter()
+        # 每个线程各用一个客户端
+        response = TestClient(app.app).post("/upload", files=files,
+                                            data={"images_per_page": "4", "stream": str(stream).lower()})
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200 or not response.content.startswith(b"%PDF"):
+            raise RuntimeError(f"/upload failed with {response.status_code}: {response.text[:200]}")
+        return elapsed, len(batch)
+
+    post(0)  # 预热：导入引擎、建立连接
+    before = process_io()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.upload_concurrency) as executor:
+        results = list(executor.map(post, range(args.upload_requests)))
+    seconds = time.perf_counter() - start
+    after = process_io()
+    latencies = [elapsed for elapsed, _ in results]
+    receipts = sum(count for _, count in results)
+    return {
+        "requests": len(latencies),
+        "concurrency": args.upload_concurrency,
+        "receipts": receipts,
+        "seconds": seconds,
+        "throughput": receipts / seconds,
+        "latency": latency_summary(latencies),
+        # 模拟服务在同一进程中，它的 socket 读写也计入 rchar/wchar 和 syscr/syscw，各变体相同
+        "io_per_request": io_delta(before, after, len(latencies)),
+    }
+
+
+def bench_workers(dataset, args):
+    """一个 JobManager 前端 + N 个 receipt_worker 进程共用一个队列，测整个任务的吞吐量"""
+    import shutil
+    os.environ["RECEIPT_CACHE_DISABLED"] = "1"
+    mock = _start_mock(dataset, args)
+    from jobs import JobManager
+    from work_queue import WorkQueue
+
+    workers = int(args.variant.partition("-")[2])
+    workdir = tempfile.mkdtemp(prefix=f"workers{workers}_", dir=args.workdir)
+    queue_path = os.path.join(workdir, "queue.sqlite3")
+    work_queue = WorkQueue(queue_path)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    procs = [subprocess.Popen([sys.executable, os.path.join(ROOT, "receipt_worker.py"), "--queue", queue_path,
+                               "--threads", str(args.worker_threads), "--name", f"bench-{i}"],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for i in range(workers)]
+    try:
+        manager = JobManager(lambda **kwargs: None, workers=1, work_queue=work_queue)
+
+        def run_job(items, prefix):
+            # 任务结束时会删除上传的文件，每次使用副本
+            files = []
+            for item in items:
+                path = os.path.join(workdir, f"{prefix}_{len(files)}_{os.path.basename(item['path'])}")
+                shutil.copyfile(item["path"], path)
+                files.append(path)
+            job = manager.submit(files, [os.path.basename(p) for p in files], engine="llm")
+            job.wait()
+            if job.status != "done":
+                raise RuntimeError(f"job failed: {job.error}")
+            manager.discard(job.id)
+            return len(files)
+
+        # 预热：每个 worker 先导入引擎、建立连接，不计入结果
+        run_job(dataset[:workers * args.worker_threads], "warmup")
+        latencies = []
+        receipts = 0
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            receipts += run_job(dataset, i)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        mock.stop()
+    return {
+        "workers": workers,
+        "worker_threads": args.worker_threads,
+        "receipts": receipts,
+        "seconds": sum(latencies),
+        "throughput": receipts / sum(latencies),
+        "latency": latency_summary(latencies),
+    }
+
+
+def _ledger_receipts(count, seed=0):
+    """逐个生成台账测试用的收据字典，日期格式与 LLM 返回的一致，约 5% 是重复"""
+    import random
+    rnd = random.Random(seed)
+    start = datetime(2022, 1, 1)
+    for i in range(count):
+        receipt = {
+            "date": (start + timedelta(days=rnd.randrange(3 * 365))).strftime("%b %d, %Y"),
+            "amount": round(rnd.uniform(3, 180), 2),
+            "type": rnd.choice(("Trip", "Meal")),
+            "path": f"/archive/{2022 + i % 3}/receipt_{i:07d}.png",
+        }
+        if rnd.random() < 0.05:
+            receipt["duplicate_of"] = f"/archive/{2022 + i % 3}/receipt_{max(0, i - 1):07d}.png"
+        yield receipt
+
+
+def bench_ledger(dataset, args):
+    """不需要图片：比较 --ledger-receipts 张收据存成字典列表和单独存进台账的内存
+    （处理器两者都保留，台账的内存是额外的），
+    Python 循环和台账按类型、类型×月份、金额区间汇总的耗时，以及 CSV / Parquet 导出和读取
+    """
+    import tracemalloc
+    from receipt_ledger import ReceiptLedger, parse_receipt_date
+    from receipt_report import summarize_by_type
+    count = args.ledger_receipts
+    ReceiptLedger().aggregate("type")  # 先导入 NumPy，不计入内存和耗时
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    receipts = list(_ledger_receipts(count))
+    dict_bytes = tracemalloc.get_traced_memory()[0] - before
+    before = tracemalloc.get_traced_memory()[0]
+    # 收据逐个生成、写入后即释放，台账的内存包括它自己的路径字符串
+    ledger = ReceiptLedger.from_receipts(_ledger_receipts(count))
+    ledger_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    def loop_by_type_month():
+        totals = {}
+        for receipt in receipts:
+            if 'duplicate_of' in receipt:
+                continue
+            parsed = parse_receipt_date(receipt['date'])
+            key = (receipt['type'], parsed.strftime("%Y-%m") if parsed else "unknown")
+            totals[key] = totals.get(key, 0) + receipt['amount']
+        return totals
+
+    def timed_runs(fn):
+        samples = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        return min(samples)
+
+    aggregation = {
+        "python_by_type": timed_runs(lambda: summarize_by_type(receipts)),
+        "python_by_type_month": timed_runs(loop_by_type_month),
+        "ledger_by_type": timed_runs(ledger.totals_by_type),
+        "ledger_by_type_month": timed_runs(lambda: ledger.aggregate("type", "month")),
+        "ledger_by_amount_range": timed_runs(lambda: ledger.aggregate("amount_range")),
+    }
+    assert ledger.totals_by_type() == summarize_by_type(receipts)[0]
+
+    try:
+        # pyarrow 第一次转换数组时会导入 pandas，这个一次性的开销不计入导出耗时
+        ReceiptLedger().save(os.path.join(args.workdir, "warmup.parquet"))
+    except ImportError:
+        pass
+    export = {}
+    for extension in ("csv", "parquet"):
+        path = os.path.join(args.workdir, f"ledger.{extension}")
+        try:
+            start = time.perf_counter()
+            ledger.save(path)
+            saved = time.perf_counter() - start
+            start = time.perf_counter()
+            loaded = ReceiptLedger.load(path)
+            export[extension] = {"save_seconds": saved, "load_seconds": time.perf_counter() - start,
+                                 "bytes": os.path.getsize(path), "rows": len(loaded)}
+        except ImportError as e:
+            # 没有安装 pyarrow 时跳过 Parquet
+            export[extension] = {"error": str(e)}
+
+    latencies = [aggregation["ledger_by_type_month"]]
+    return {
+        "receipts": count,
+        "seconds": sum(latencies),
+        "throughput": count / aggregation["ledger_by_type_month"],
+        "latency": latency_summary(latencies),
+        "bytes_per_receipt": {"dicts": dict_bytes / count, "ledger": ledger_bytes / count,
+                              "ledger_columns": ledger.nbytes() / count},
+        "aggregation_seconds": aggregation,
+        "export": export,
+    }
+
+
+def bench_decode(dataset, args):
+    """LLM 引擎的一整批：去重、提取和生成报告，统计图片解码次数、解码图片缓存的命中和峰值占用
+
+    变体 cache-<MiB> 设置解码图片缓存的容量，cache-0 关闭缓存，每个阶段各自解码。
+    """
+    from receipt_metrics import IMAGE_DECODES, STAGE_SECONDS
+    from receipt_sources import get_image_cache
+    # 模拟服务启动时会在本进程中计算数据集的哈希，这时不使用缓存，也不计入解码次数
+    cache = get_image_cache()
+    cache.resize(0)
+    mock = _start_mock(dataset, args)
+    from uber_llm_ocr import UberReceiptProcessor
+    cache.clear()
+    cache.resize(int(args.variant.partition("-")[2]) * 1024 * 1024)
+    kinds = ("full", "draft", "pdf")
+    before = {kind: IMAGE_DECODES.value(kind=kind) for kind in kinds}
+    paths = [item["path"] for item in dataset]
+    processor = UberReceiptProcessor(os.path.join(args.workdir, f"decode_{args.variant}.pdf"), cache=False,
+                                     batch_size=args.batch_size)
+    start = time.perf_counter()
+    processor.add_receipts(paths)
+    processor.create_pdf()
+    elapsed = time.perf_counter() - start
+    mock.stop()
+    decodes = {kind: IMAGE_DECODES.value(kind=kind) - before[kind] for kind in kinds}
+    # 各阶段处理图片的总耗时（秒）：去重哈希、LLM 请求前的图片预处理、报告中的图片重采样
+    means = STAGE_SECONDS.means()
+    image_seconds = {stage: means[(stage,)] * STAGE_SECONDS.count(stage=stage)
+                     for stage in ("dedup_hash", "image_prepare", "render_image") if (stage,) in means}
+    return {
+        "receipts": len(paths),
+        "seconds": elapsed,
+        "throughput": len(paths) / elapsed,
+        "latency": latency_summary([elapsed]),
+        "decodes": decodes,
+        "decodes_per_receipt": sum(decodes.values()) / len(paths),
+        "image_seconds": image_seconds,
+        "image_cache": cache.stats(),
+    }
+
+
+BENCHMARKS = {"extract": bench_extract, "create_pdf": bench_create_pdf, "upload": bench_upload,
+              "workers": bench_workers, "ledger": bench_ledger, "decode": bench_decode}
+
+
+def run_stage(args):
+    """子进程入口：运行一个测试并把结果以 JSON 打印在最后一行"""
+    dataset = load_dataset(args.dataset)[:args.count]
+    result = BENCHMARKS[args.stage](dataset, args)
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+def _stage_variants(args):
+    for stage in args.stages:
+        if stage == "extract":
+            for engine in args.engines:
+                if engine == "tesseract":
+                    for mode in args.ocr_modes:
+                        yield stage, f"{engine}-{mode}"
+                else:
+                    yield stage, engine
+        elif stage == "create_pdf":
+            for layout in args.layouts:
+                yield stage, layout
+            yield stage, "legacy"
+        elif stage == "workers":
+            for count in args.worker_counts:
+                yield stage, f"workers-{count}"
+        elif stage == "ledger":
+            yield stage, "columnar"
+        elif stage == "decode":
+            for size in args.image_cache_sizes:
+                yield stage, f"cache-{size}"
+        else:
+            yield stage, "file"
+            yield stage, "file-disk"
+            yield stage, "stream"
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def _child_args(args, stage, variant):
+    names = ["count", "latency", "jitter", "error_rate", "malformed_rate", "batch_size",
+             "latency_samples", "repeat", "upload_files", "upload_requests", "upload_concurrency",
+             "worker_threads", "grid_images_per_page", "ledger_receipts", "workdir"]
+    argv = ["--stage", stage, "--variant", variant, "--dataset", args.dataset]
+    for name in names:
+        argv += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    return argv
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receipt pipeline benchmarks")
+    parser.add_argument("--count", type=int, default=40, help="number of synthetic receipts")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--workdir", default=None, help="where receipts and PDFs are written")
+    parser.add_argument("--dataset", default=None, help="reuse a directory from benchmarks.synthetic")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--decoys", action="store_true", help="add a promotional amount above each total")
+    parser.add_argument("--short-meals", action="store_true",
+                        help="crop Uber Eats receipts to their content, as short real receipts are")
+    parser.add_argument("--image-format", choices=["PNG", "JPEG"], default="PNG", help="format of the receipts")
+    parser.add_argument("--ocr-modes", default="roi,full", help="tesseract OCR modes to compare")
+    # 模拟服务
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=1)
+    # 各测试的规模
+    parser.add_argument("--latency-samples", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--upload-files", type=int, default=8)
+    parser.add_argument("--upload-requests", type=int, default=3)
+    parser.add_argument("--upload-concurrency", type=int, default=4, help="/upload requests in flight")
+    parser.add_argument("--worker-counts", default="1,2,4", help="receipt_worker processes to compare")
+    parser.add_argument("--worker-threads", type=int, default=2, help="threads per receipt_worker")
+    parser.add_argument("--layouts", default="row,grid,shelf", help="report layouts to compare in create_pdf")
+    parser.add_argument("--grid-images-per-page", type=int, default=8,
+                        help="images per page for the grid and shelf layouts")
+    parser.add_argument("--ledger-receipts", type=int, default=50000, help="receipts in the ledger benchmark")
+    parser.add_argument("--image-cache-sizes", default="0,64,512",
+                        help="decoded image cache sizes in MiB to compare in decode")
+    # 子进程参数
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--variant", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="receipt_bench_")
+    os.makedirs(args.workdir, exist_ok=True)
+    if args.stage:
+        return run_stage(args)
+
+    args.stages = [s for s in args.stages.split(",") if s]
+    args.engines = [e for e in args.engines.split(",") if e]
+    args.ocr_modes = [m for m in args.ocr_modes.split(",") if m]
+    args.worker_counts = [int(n) for n in args.worker_counts.split(",") if n]
+    args.layouts = [name for name in args.layouts.split(",") if name]
+    args.image_cache_sizes = [int(n) for n in args.image_cache_sizes.split(",") if n]
+    if args.dataset is None:
+        args.dataset = os.path.join(args.workdir, "receipts")
+        generate_dataset(args.dataset, args.count, args.seed, args.image_format, args.decoys, args.short_meals)
+
+    results = []
+    for stage, variant in _stage_variants(args):
+        print(f"Running {stage} ({variant})...")
+        proc = subprocess.run([sys.executable, "-m", "benchmarks.run"] + _child_args(args, stage, variant),
+                              capture_output=True, text=True)
+        entry = {"stage": stage, "variant": variant}
+        try:
+            entry.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+            # 例如没有安装 tesseract；记录错误后继续其他测试
+            entry["error"] = (proc.stderr.strip().splitlines() or ["no output"])[-1]
+            print(f"  failed: {entry['error']}")
+        results.append(entry)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("stage", "variant")},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    for entry in results:
+        if "error" not in entry:
+            print(f"{entry['stage']:>10} {entry['variant']:<9} {entry['throughput']:8.2f} receipts/s  "
+                  f"p50 {entry['latency']['p50']:.3f}s  p99 {entry['latency']['p99']:.3f}s  "
+                  f"rss {entry['peak_rss_mb']['self']:.0f} MB")
+            if "bytes_per_receipt" in entry:
+                memory, seconds = entry["bytes_per_receipt"], entry["aggregation_seconds"]
+                print(f"{'':>10} {'':<9} {memory['dicts']:.0f} B/receipt as dicts, {memory['ledger']:.0f} B as a "
+                      f"ledger alone; by type x month {seconds['python_by_type_month'] * 1000:.1f} ms loop, "
+                      f"{seconds['ledger_by_type_month'] * 1000:.1f} ms ledger")
+            if "decodes" in entry:
+                cache = entry["image_cache"]
+                print(f"{'':>10} {'':<9} {entry['decodes_per_receipt']:.2f} decodes/receipt {entry['decodes']}, "
+                      f"cache hits {cache['hits']}, evictions {cache['evictions']}, "
+                      f"peak {cache['peak_bytes'] / 2 ** 20:.0f} MiB")
+            if "pages" in entry:
+                print(f"{'':>10} {'':<9} {entry['pages']} pages, {entry['pdf_bytes'] / 1024:.0f} KiB, "
+                      f"narrowest image {entry['min_image_width']:.0f} pt")
+            if entry.get("io_per_request"):
+                io_stats = entry["io_per_request"]
+                print(f"{'':>10} {'':<9} per request: {io_stats['syscr']:.0f} read / {io_stats['syscw']:.0f} write "
+                      f"syscalls, {io_stats['write_bytes'] / 1024:.0f} KiB written to disk")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""生成带标准答案的合成 Uber 行程 / Uber Eats 收据图片
+
+    python -m benchmarks.synthetic out_dir --count 50
+"""
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+from PIL import Image, ImageDraw, ImageFont
+
+RECEIPT_SIZE = (1170, 2532)  # 手机截图的尺寸
+TRUTH_FILE = "truth.jsonl"
+
+STREETS = ["Main St", "Market St", "Mission St", "Broadway", "Oak Ave", "Pine St", "2nd Ave"]
+RESTAURANTS = ["Sushi House", "Taco Bar", "Pho 88", "Burger Joint", "Green Bowl", "Pizza Place"]
+DISHES = ["Chicken Bowl", "Spicy Tuna Roll", "Beef Pho", "Cheeseburger", "Caesar Salad",
+          "Margherita Pizza", "Fries", "Iced Tea", "Miso Soup", "Tacos (3)"]
+
+
+def _font(size, bold=False):
+    name = "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf"
+    try:
+        return ImageFont.truetype(name, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def _random_time(rnd):
+    start = datetime(2024, 1, 1)
+    return start + timedelta(minutes=rnd.randrange(366 * 24 * 60))
+
+
+def make_receipt(seed, kind=None, decoy=False, short_meals=False):
+    """返回 (图片, 标准答案)；kind 为 "Trip" 或 "Meal"，默认随机
+
+    decoy=True 时在总价上方加一行带金额的促销文字，用来检验是否取到了真正的总价。
+    short_meals=True 时 Uber Eats 收据没有菜品图片，裁到内容结束处，和真实的短收据一样宽高比接近 1。
+    """
+    rnd = random.Random(seed)
+    kind = kind or rnd.choice(["Trip", "Meal"])
+    when = _random_time(rnd)
+    img = Image.new("RGB", RECEIPT_SIZE, "white")
+    draw = ImageDraw.Draw(img)
+    small, body, big, title = _font(30), _font(36), _font(64, True), _font(72, True)
+
+    # 和真实收据一样，第一个金额就是总价，后面才是明细
+    lines = []
+    if kind == "Trip":
+        fare = round(rnd.uniform(4, 45), 2)
+        fees = [("Booking Fee", round(rnd.uniform(0.5, 4), 2)), ("Tolls", round(rnd.uniform(0, 8), 2))]
+        total = round(fare + sum(v for _, v in fees), 2)
+        draw.text((60, 60), "Uber", font=title, fill="black")
+        draw.text((60, 200), when.strftime("%b %d %I:%M") + when.strftime("%p"), font=body, fill="black")
+        draw.text((60, 300), "Thanks for riding, Alex", font=big, fill="black")
+        lines.append(("Trip fare", fare))
+        lines.extend(fees)
+        pickup = f"{rnd.randint(1, 999)} {rnd.choice(STREETS)}"
+        dropoff = f"{rnd.randint(1, 999)} {rnd.choice(STREETS)}"
+        footer = [f"UberX  {rnd.uniform(1, 25):.2f} mi  {rnd.randint(5, 60)} min",
+                  f"{when.strftime('%I:%M %p')}  {pickup}", f"Drop-off  {dropoff}"]
+    else:
+        items = [(rnd.choice(DISHES), round(rnd.uniform(3, 22), 2)) for _ in range(rnd.randint(1, 5))]
+        fees = [("Service Fee", round(rnd.uniform(1, 5), 2)), ("Delivery Fee", round(rnd.uniform(0, 6), 2))]
+        total = round(sum(v for _, v in items + fees), 2)
+        draw.text((60, 60), "Uber Eats", font=title, fill="black")
+        draw.text((60, 200), when.strftime("%a %b %d %Y").replace(" 0", " "), font=body, fill="black")
+        draw.text((60, 300), f"Order from {rnd.choice(RESTAURANTS)}", font=big, fill="black")
+        lines.extend(items)
+        lines.extend(fees)
+        footer = ["Delivered to", f"{rnd.randint(1, 999)} {rnd.choice(STREETS)}"]
+
+    if decoy:
+        # 单独的随机数序列，不影响其他内容，同一 seed 生成的收据只多出这一行
+        promo = random.Random(-seed - 1).uniform(1, 10)
+        text = f"Uber One saved you ${promo:.2f}" if kind == "Meal" else f"Earn ${promo:.2f} in Uber Cash"
+        draw.text((60, 400), text, font=small, fill="black")
+    draw.text((60, 460), "Total", font=big, fill="black")
+    draw.text((760, 460), f"${total:.2f}", font=big, fill="black")
+    draw.line((60, 580, 1110, 580), fill="black", width=3)
+    y = 640
+    for label, value in lines:
+        draw.text((60, y), label, font=body, fill="black")
+        draw.text((860, y), f"{value:.2f}", font=body, fill="black")
+        y += 70
+    short = short_meals and kind == "Meal"
+    if short:
+        y += 40
+    else:
+        # 地图或菜品图片的占位色块
+        draw.rectangle((60, y + 40, 1110, y + 640), fill=(rnd.randint(180, 230), 225, rnd.randint(180, 230)))
+        y += 700
+    for text in footer:
+        draw.text((60, y), text, font=small, fill="black")
+        y += 50
+    if short:
+        img = img.crop((0, 0, RECEIPT_SIZE[0], y + 60))
+
+    truth = {"type": kind, "date": when.strftime("%Y-%m-%d"), "amount": total}
+    return img, truth
+
+
+def generate_dataset(out_dir, count, seed=0, fmt="PNG", decoys=False, short_meals=False):
+    """生成 count 张收据并写入 truth.jsonl，返回 [{path, type, date, amount}]"""
+    os.makedirs(out_dir, exist_ok=True)
+    extension = ".jpg" if fmt == "JPEG" else ".png"
+    dataset = []
+    with open(os.path.join(out_dir, TRUTH_FILE), "w") as f:
+        for i in range(count):
+            img, truth = make_receipt(seed * 1000003 + i, decoy=decoys, short_meals=short_meals)
+            path = os.path.abspath(os.path.join(out_dir, f"receipt_{i:05d}{extension}"))
+            img.save(path, fmt)
+            truth["path"] = path
+            f.write(json.dumps(truth) + "\n")
+            dataset.append(truth)
+    return dataset
+
+
+def load_dataset(out_dir):
+    with open(os.path.join(out_dir, TRUTH_FILE)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Uber receipts with ground truth")
+    parser.add_argument("out_dir")
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["PNG", "JPEG"], default="PNG")
+    parser.add_argument("--decoys", action="store_true", help="add a promotional amount above the total")
+    parser.add_argument("--short-meals", action="store_true", help="crop Uber Eats receipts to their content")
+    args = parser.parse_args(argv)
+    generate_dataset(args.out_dir, args.count, args.seed, args.format, args.decoys, args.short_meals)
+    print(f"Generated {args.count} receipts in {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""提取引擎注册表：按名称创建处理器，引擎模块在第一次使用时才导入
+
+新引擎只需要提供与 UberReceiptProcessor 相同接口的类，然后调用 register()，
+或者通过环境变量 RECEIPT_ENGINE_PLUGINS="名称=模块:类,..." 注册。
+"""
+import importlib
+import os
+import threading
+
+# 默认引擎，可以被每个请求的 engine 参数覆盖
+DEFAULT_ENGINE = os.getenv("RECEIPT_ENGINE", "llm")
+
+_registry = {}
+_loaded = {}
+_lock = threading.Lock()
+
+
+class UnknownEngineError(ValueError):
+    """没有注册的引擎名称"""
+
+
+def register(name, target):
+    """注册引擎；target 是 "模块:类" 字符串（延迟导入）或处理器类本身"""
+    with _lock:
+        _registry[name] = target
+        _loaded.pop(name, None)
+
+
+def engine_names():
+    return tuple(_registry)
+
+
+def check_engine(name):
+    """确认引擎已注册，返回名称；未注册时抛出 UnknownEngineError"""
+    if name not in _registry:
+        raise UnknownEngineError(f"Unknown engine {name!r}, expected one of {engine_names()}")
+    return name
+
+
+def load(name):
+    """返回引擎的处理器类，第一次调用时才导入对应的模块"""
+    check_engine(name)
+    with _lock:
+        if name not in _loaded:
+            target = _registry[name]
+            if isinstance(target, str):
+                module_name, _, attr = target.partition(":")
+                target = getattr(importlib.import_module(module_name), attr or "UberReceiptProcessor")
+            _loaded[name] = target
+        return _loaded[name]
+
+
+def extraction_version(name=None):
+    """引擎的提取设置（模型、提示词或解析器版本等），用于报告缓存的键；引擎没有提供时返回 None"""
+    version = getattr(load(name or DEFAULT_ENGINE), "extraction_version", None)
+    return list(version()) if version else None
+
+
+def make_processor(engine=None, output_path="report/expense_batch.pdf", **kwargs):
+    """按名称创建处理器；engine 为 None 时使用 DEFAULT_ENGINE"""
+    return load(engine or DEFAULT_ENGINE)(output_path, **kwargs)
+
+
+register("llm", "uber_llm_ocr:UberReceiptProcessor")
+register("tesseract", "uber_ocr_en:UberReceiptProcessor")
+register("hybrid", "uber_hybrid_ocr:UberReceiptProcessor")
+
+for _plugin in filter(None, os.getenv("RECEIPT_ENGINE_PLUGINS", "").split(",")):
+    _name, _, _target = _plugin.partition("=")
+    register(_name.strip(), _target.strip())
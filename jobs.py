@@ -0,0 +1,310 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from tempfile import NamedTemporaryFile
+from engines import DEFAULT_ENGINE
+from receipt_dedup import DEDUP_THRESHOLD, DuplicateIndex
+from receipt_events import ReceiptProgress, receipt_item
+from receipt_metrics import JOB_QUEUE_DEPTH, JOBS_IN_FLIGHT, WORK_QUEUE_TASKS, observe, timed
+from receipt_sources import discard_source, expand_receipt_paths, split_page_ref
+from work_queue import WORK_DIR
+
+# 工作线程数、排队上限和结果保留时间，可通过环境变量调整
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "16"))
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))  # 秒
+
+
+class QueueFullError(Exception):
+    """任务队列已满，请稍后重试"""
+
+
+class Job:
+    """一次收据处理任务及其进度"""
+
+    def __init__(self, files, names, images_per_page, trace=None, engine=None, report_key=None):
+        self.id = uuid.uuid4().hex
+        # 提取引擎名称，None 表示使用默认引擎
+        self.engine = engine
+        # report_cache 的键；cached 为 True 时 output_path 属于报告缓存，不能删除
+        self.report_key = report_key
+        self.cached = False
+        # 可选的 receipt_metrics.Trace，记录该任务各阶段的耗时
+        self.trace = trace
+        self.files = list(files)
+        # PDF 按页展开，每一页作为一张收据汇报进度
+        self.image_paths = []
+        self.names = []
+        for file_path, name in zip(self.files, names):
+            for ref in expand_receipt_paths([file_path]):
+                page_number = split_page_ref(ref)[1]
+                self.image_paths.append(ref)
+                self.names.append(name if page_number is None else f"{name} (page {page_number})")
+        self.images_per_page = images_per_page
+        self.status = "queued"
+        self.error = None
+        self.output_path = None
+        self.total_amount = 0
+        self.receipts = [None] * len(self.image_paths)
+        self.completed = 0
+        # 每张收据完成时的事件，/jobs/{id}/events 推送给客户端
+        self.progress = ReceiptProgress(total=len(self.image_paths))
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        """任务结束（成功或失败）时调用 fn(job)；若已结束则立即调用"""
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, status, error=None):
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.finished_at = time.time()
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self.progress.finish(status, error=error, total_amount=self.total_amount)
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.error(f"Job {self.id} callback failed: {e}")
+
+    def _on_result(self, index, receipt_info):
+        self.receipts[index] = receipt_info
+        self.completed += 1
+        self.progress.add(self.names[index], receipt_info, index=index)
+
+    def to_dict(self):
+        receipts = [receipt_item(name, info) for name, info in zip(self.names, self.receipts)]
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "total": len(self.image_paths),
+            "completed": self.completed,
+            "total_amount": self.total_amount,
+            "receipts": receipts,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "engine": self.engine,
+            "cached": self.cached,
+            "trace_id": self.trace.id if self.trace else None,
+        }
+
+
+class JobManager:
+    """有界队列 + 工作线程池，在事件循环之外执行提取和PDF生成
+
+    传入 work_queue（work_queue.WorkQueue）时，提取和渲染交给 receipt_worker 进程，
+    这里的线程只负责去重、等待结果和汇总。
+    """
+
+    def __init__(self, processor_factory, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE, ttl=JOB_TTL,
+                 work_queue=None, report_cache=None):
+        self.processor_factory = processor_factory
+        self.workers = workers
+        self.ttl = ttl
+        self.work_queue = work_queue
+        # report_cache.ReportCache；提交时带 report_key 且命中的任务不再排队
+        self.report_cache = report_cache
+        self.jobs = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        JOB_QUEUE_DEPTH.set_function(self.queue_depth)
+        if work_queue is not None:
+            for status in ("queued", "leased"):
+                WORK_QUEUE_TASKS.set_function(lambda status=status: work_queue.count(status), status=status)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, files, names, images_per_page=4, trace=None, engine=None, report_key=None):
+        """提交任务；队列已满时抛出 QueueFullError，由调用方决定如何拒绝
+
+        同样的报告已经生成过时，任务直接以缓存的报告完成，不提取也不渲染。
+        """
+        self.start()
+        self.expire()
+        job = Job(files, names, images_per_page, trace, engine, report_key)
+        if self.report_cache is not None and report_key is not None:
+            hit = self.report_cache.get(report_key)
+            if hit is not None:
+                self._finish_cached(job, *hit)
+                with self._lock:
+                    self.jobs[job.id] = job
+                return job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(f"Job queue is full ({self._queue.maxsize} jobs waiting)")
+        with self._lock:
+            self.jobs[job.id] = job
+        return job
+
+    def _finish_cached(self, job, pdf_path, summary):
+        job.started_at = time.time()
+        job.output_path = pdf_path
+        job.cached = True
+        for i, receipt_info in enumerate(summary["receipts"][:len(job.receipts)]):
+            job._on_result(i, receipt_info)
+        job.total_amount = summary["total_amount"]
+        for file_path in job.files:
+            _unlink(file_path)
+        job._finish("done")
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def discard(self, job_id):
+        """删除任务及其生成的PDF"""
+        with self._lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None and job.output_path and not job.cached:
+            _unlink(job.output_path)
+
+    def expire(self):
+        """清理超过保留时间的已完成任务"""
+        now = time.time()
+        expired = [job.id for job in list(self.jobs.values())
+                   if job.done and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            self.discard(job_id)
+        if self.work_queue is not None:
+            # 前端重启时遗留在队列里的任务
+            self.work_queue.purge(self.ttl)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        observe("queue_wait", job.started_at - job.created_at, job.trace)
+        JOBS_IN_FLIGHT.inc()
+        try:
+            with NamedTemporaryFile(delete=False, suffix='.pdf', dir=WORK_DIR) as tmp_file:
+                job.output_path = tmp_file.name
+            if self.work_queue is not None:
+                with timed("job", job.trace, receipts=len(job.image_paths)):
+                    self._run_remote(job)
+                self._store(job)
+                job._finish("done")
+                return
+            processor = self.processor_factory(
+                engine=job.engine,
+                output_path=job.output_path,
+                images_per_page=job.images_per_page
+            )
+            processor.trace = job.trace
+            with timed("job", job.trace, receipts=len(job.image_paths)):
+                processor.add_receipts(job.image_paths, on_result=job._on_result)
+                processor.create_pdf()
+            job.total_amount = processor.total_amount
+            self._store(job)
+            job._finish("done")
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            job._finish("failed", str(e))
+        finally:
+            JOBS_IN_FLIGHT.dec()
+            # 上传的文件只在任务执行期间需要
+            for file_path in job.files:
+                _unlink(file_path)
+
+    def _store(self, job):
+        """把生成的报告移入报告缓存，之后由缓存负责删除"""
+        if self.report_cache is None or job.report_key is None:
+            return
+        job.output_path = self.report_cache.put(job.report_key, job.output_path, job.receipts,
+                                                job.total_amount)
+        job.cached = True
+
+    def _run_remote(self, job):
+        """每张收据一个 extract 任务，全部完成后提交一个 render 任务"""
+        refs = job.image_paths
+        # worker 的默认引擎可能配置得不同，按前端的默认引擎提交
+        engine = job.engine or DEFAULT_ENGINE
+        # 去重在这里做，重复的收据不提交任务，结束时复制代表收据的结果
+        index = DuplicateIndex(DEDUP_THRESHOLD) if DEDUP_THRESHOLD >= 0 else None
+        representatives = index.assign(refs) if index is not None else [None] * len(refs)
+        position = {}
+        for i, ref in enumerate(refs):
+            position.setdefault(ref, i)
+        unique, members = [], {}
+        for i, rep in enumerate(representatives):
+            if rep is None or position.get(rep, i) == i:
+                unique.append(i)
+            else:
+                members.setdefault(position[rep], []).append(i)
+
+        try:
+            task_ids = self.work_queue.put_many(
+                job.id, "extract", [{"path": refs[i], "engine": engine} for i in unique])
+            index_of = dict(zip(task_ids, unique))
+            for task in self.work_queue.wait(job.id, task_ids):
+                i = index_of[task.id]
+                if task.status != "done":
+                    raise RuntimeError(f"Extraction failed for {job.names[i]}: {task.error}")
+                job._on_result(i, task.result)
+                for j in members.get(i, []):
+                    job._on_result(j, dict(task.result, path=refs[j], duplicate_of=refs[i]))
+
+            # 重复的收据只在报告中标记，不计入总金额
+            job.total_amount = sum(r['amount'] for r in job.receipts if 'duplicate_of' not in r)
+            render_id = self.work_queue.put(job.id, "render", {
+                "engine": engine,
+                "output_path": job.output_path,
+                "images_per_page": job.images_per_page,
+                "receipts": job.receipts,
+                "total_amount": job.total_amount,
+            })
+            for task in self.work_queue.wait(job.id, [render_id]):
+                if task.status != "done":
+                    raise RuntimeError(f"Rendering the report failed: {task.error}")
+        finally:
+            self.work_queue.delete_job(job.id)
+
+
+def _unlink(path):
+    """删除临时文件或释放内存中的上传"""
+    try:
+        discard_source(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Error deleting temporary file {path}: {e}")
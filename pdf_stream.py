@@ -0,0 +1,176 @@
+import queue
+import zlib
+
+# 预留的对象编号：目录、页面树和两种内置字体
+CATALOG_OBJ = 1
+PAGES_OBJ = 2
+FONT_OBJ = 3
+BOLD_FONT_OBJ = 4
+FONTS = {"Helvetica": "F1", "Helvetica-Bold": "F2"}
+
+
+def _escape_text(text):
+    """转义 PDF 字符串；内置字体只支持 WinAnsi 字符，其他字符替换为 ?"""
+    data = str(text).encode("cp1252", "replace")
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def _num(value):
+    return f"{value:.2f}".rstrip("0").rstrip(".").encode()
+
+
+class PageBuilder:
+    """收集一页的绘制指令"""
+
+    def __init__(self):
+        self._ops = []
+        self.images = {}
+
+    def text(self, x, y, string, font="Helvetica", size=12):
+        self._ops.append(b"BT /" + FONTS[font].encode() + b" " + _num(size) + b" Tf "
+                         + _num(x) + b" " + _num(y) + b" Td (" + _escape_text(string) + b") Tj ET")
+
+    def image(self, obj_num, x, y, width, height):
+        name = f"Im{obj_num}"
+        self.images[name] = obj_num
+        self._ops.append(b"q " + _num(width) + b" 0 0 " + _num(height) + b" "
+                         + _num(x) + b" " + _num(y) + b" cm /" + name.encode() + b" Do Q")
+
+    def content(self):
+        return b"\n".join(self._ops)
+
+
+class StreamingPDFWriter:
+    """边生成边输出的最小 PDF 写入器
+
+    图片和页面在添加时立即写出，内存中只保留对象偏移量和页面编号；
+    页面树在 close() 时写入，因此最后生成的页面（例如汇总页）也可以排在最前面。
+    """
+
+    def __init__(self, out, page_size):
+        self._out = out
+        self.page_width, self.page_height = page_size
+        self._offset = 0
+        self._offsets = {}
+        self._next_obj = BOLD_FONT_OBJ + 1
+        self._kids = []
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._write_obj(FONT_OBJ, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica "
+                                  b"/Encoding /WinAnsiEncoding >>")
+        self._write_obj(BOLD_FONT_OBJ, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold "
+                                       b"/Encoding /WinAnsiEncoding >>")
+
+    @property
+    def bytes_written(self):
+        return self._offset
+
+    def _write(self, data):
+        self._out.write(data)
+        self._offset += len(data)
+
+    def _new_obj(self):
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    def _write_obj(self, num, body, stream=None):
+        self._offsets[num] = self._offset
+        self._write(f"{num} 0 obj\n".encode() + body)
+        if stream is not None:
+            self._write(b"\nstream\n")
+            self._write(stream)
+            self._write(b"\nendstream")
+        self._write(b"\nendobj\n")
+
+    def add_jpeg(self, data, width, height, mode="RGB"):
+        """写入 JPEG 图片对象（DCTDecode 原样嵌入），返回对象编号"""
+        num = self._new_obj()
+        colorspace = b"/DeviceGray" if mode == "L" else b"/DeviceRGB"
+        self._write_obj(num, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                             b"/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>"
+                        % (width, height, colorspace, len(data)), data)
+        return num
+
+    def add_page(self, page, first=False):
+        """写入一页；first=True 时在最终文档中排在最前面"""
+        content = zlib.compress(page.content())
+        content_num = self._new_obj()
+        self._write_obj(content_num, b"<< /Length %d /Filter /FlateDecode >>" % len(content), content)
+
+        xobjects = b" ".join(b"/%s %d 0 R" % (name.encode(), num) for name, num in page.images.items())
+        page_num = self._new_obj()
+        self._write_obj(page_num, b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] "
+                                  b"/Resources << /Font << /F1 %d 0 R /F2 %d 0 R >> /XObject << %s >> >> "
+                                  b"/Contents %d 0 R >>"
+                        % (PAGES_OBJ, _num(self.page_width), _num(self.page_height),
+                           FONT_OBJ, BOLD_FONT_OBJ, xobjects, content_num))
+        if first:
+            self._kids.insert(0, page_num)
+        else:
+            self._kids.append(page_num)
+
+    def close(self):
+        """写入页面树、目录和交叉引用表"""
+        kids = b" ".join(b"%d 0 R" % num for num in self._kids)
+        self._write_obj(PAGES_OBJ, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._kids)))
+        self._write_obj(CATALOG_OBJ, b"<< /Type /Catalog /Pages %d 0 R >>" % PAGES_OBJ)
+
+        xref_offset = self._offset
+        size = self._next_obj
+        lines = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for num in range(1, size):
+            lines.append(b"%010d 00000 n \n" % self._offsets[num])
+        self._write(b"".join(lines))
+        self._write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                    % (size, CATALOG_OBJ, xref_offset))
+
+
+class QueueWriter:
+    """把写入的字节按块放入队列，供 HTTP 流式响应逐块读取
+
+    队列有上限，消费端读得慢时写入端会阻塞，避免整个PDF堆积在内存中。
+    """
+
+    def __init__(self, chunk_size=64 * 1024, max_chunks=16):
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = bytearray()
+        self.cancelled = False
+
+    def write(self, data):
+        if self.cancelled:
+            raise BrokenPipeError("Stream consumer has gone away")
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer and not self.cancelled:
+            self.queue.put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self, error=None):
+        """结束输出；出错时把异常放入队列让消费端抛出"""
+        if self.cancelled:
+            return
+        self.flush()
+        self.queue.put(error)
+
+    def cancel(self):
+        """消费端放弃读取：之后的写入抛出异常，并清空队列唤醒阻塞的写入端"""
+        self.cancelled = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def chunks(self):
+        """同步迭代所有数据块"""
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
@@ -0,0 +1,261 @@
+"""批量处理收据目录：结果逐条追加到 JSONL 清单，中断后重新运行只处理新增或修改过的文件
+
+    python receipt_batch.py run receipts/ --manifest receipts.jsonl --engine llm
+    python receipt_batch.py report --manifest receipts.jsonl --output report/expense.pdf
+    python receipt_batch.py ledger --manifest receipts.jsonl --by type,month --output receipts.parquet
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+from engines import DEFAULT_ENGINE, engine_names, make_processor
+from receipt_cache import dump_result, file_sha256, load_result
+from receipt_ledger import GROUP_KEYS, ReceiptLedger
+from receipt_report import StreamingReportWriter
+from receipt_sources import UnreadableReceiptError, expand_receipt_paths, is_receipt_file, split_page_ref
+from report_layout import LAYOUTS, REPORT_LAYOUT
+
+DEFAULT_MANIFEST = "receipts.jsonl"
+# 每批交给处理器的收据数；结果在每张完成时就写入清单，批大小只影响去重和并发的范围
+CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "64"))
+
+
+def walk_receipts(folders):
+    """递归列出目录下的收据文件，按路径排序"""
+    paths = []
+    for folder in folders:
+        if os.path.isfile(folder):
+            paths.append(os.path.abspath(folder))
+            continue
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            paths.extend(os.path.abspath(os.path.join(root, name))
+                         for name in sorted(files) if is_receipt_file(name))
+    return paths
+
+
+class Manifest:
+    """只追加的 JSONL 清单，每行记录一张收据（PDF 的一页）的处理结果
+
+    同一收据出现多次时以最后一行为准；进程中断留下的半行在读取时忽略。
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST):
+        self.path = path
+        self.entries = {}
+        self._by_file = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self._by_file = {}
+        if not os.path.exists(self.path):
+            return self.entries
+        with open(self.path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = load_result(line)
+                except ValueError:
+                    print(f"Skipping unreadable manifest line {line_number}")
+                    continue
+                self._add(entry)
+        return self.entries
+
+    def _add(self, entry):
+        self.entries[entry["path"]] = entry
+        pages = self._by_file.setdefault(entry["file"], {})
+        if entry["path"] != entry["file"]:
+            # PDF 能读出页面之后，之前整个文件读取失败的记录不再有效
+            pages.pop(entry["file"], None)
+        pages[entry["path"]] = entry
+
+    def append(self, entry):
+        """写入一行并立即落盘，崩溃时最多丢失正在处理的收据"""
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(dump_result(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._add(entry)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def file_entries(self, file_path):
+        return list(self._by_file.get(file_path, {}).values())
+
+    def receipts(self):
+        """按文件和页码顺序返回已成功提取、文件仍然存在的收据"""
+        done = [e for e in self.entries.values()
+                if e["status"] == "done" and os.path.exists(e["file"])]
+        done.sort(key=lambda e: (e["file"], split_page_ref(e["path"])[1] or 0))
+        return [dict(e["receipt"], path=e["path"]) for e in done]
+
+
+def _file_state(file_path):
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def plan(manifest, file_paths):
+    """返回需要提取的收据引用；内容没变只是 mtime 变了的文件直接更新清单"""
+    todo = []
+    unchanged = 0
+    for file_path in file_paths:
+        state = _file_state(file_path)
+        previous = manifest.file_entries(file_path)
+        complete = previous and all(e["status"] == "done" for e in previous)
+        if complete and all(e["size"] == state["size"] and e["mtime"] == state["mtime"] for e in previous):
+            unchanged += 1
+            continue
+
+        sha256 = file_sha256(file_path)
+        if complete and all(e["sha256"] == sha256 for e in previous):
+            # 文件被复制或 touch 过，内容没变，不需要重新提取
+            for entry in previous:
+                manifest.append(dict(entry, **state))
+            unchanged += 1
+            continue
+
+        try:
+            refs = expand_receipt_paths([file_path])
+        except UnreadableReceiptError as e:
+            # 整个文件记为失败，下次运行重试；不写入清单就看不出少了这些收据
+            manifest.append(dict(state, path=file_path, file=file_path, sha256=sha256, status="failed",
+                                 error=str(e.__cause__),
+                                 recorded_at=datetime.now().isoformat(timespec="seconds")))
+            continue
+        for ref in refs:
+            entry = manifest.entries.get(ref)
+            if entry is None or entry["status"] != "done" or entry["sha256"] != sha256:
+                todo.append((ref, dict(state, sha256=sha256)))
+    return todo, unchanged
+
+
+def run(folders, manifest_path=DEFAULT_MANIFEST, engine=DEFAULT_ENGINE, chunk_size=CHUNK_SIZE,
+        **processor_kwargs):
+    """提取目录下新增或修改过的收据，每完成一张就追加到清单"""
+    manifest = Manifest(manifest_path)
+    file_paths = walk_receipts(folders)
+    todo, unchanged = plan(manifest, file_paths)
+    print(f"{len(file_paths)} files: {unchanged} unchanged, {len(todo)} receipts to extract")
+    if not todo:
+        manifest.close()
+        return manifest
+
+    processor = make_processor(engine, **processor_kwargs)
+    failed = 0
+    try:
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            chunk_start = time.perf_counter()
+
+            def on_result(index, receipt_info):
+                nonlocal failed
+                ref, state = chunk[index]
+                ok = receipt_info.get("type") != "Unknown"
+                failed += not ok
+                receipt = {k: v for k, v in receipt_info.items() if k != "path"}
+                manifest.append(dict(
+                    state,
+                    path=ref,
+                    file=split_page_ref(ref)[0],
+                    engine=engine,
+                    status="done" if ok else "failed",
+                    receipt=receipt,
+                    # 从本批开始到这张收据完成的时间
+                    elapsed=round(time.perf_counter() - chunk_start, 3),
+                    recorded_at=datetime.now().isoformat(timespec="seconds"),
+                ))
+
+            processor.add_receipts([ref for ref, _ in chunk], on_result=on_result)
+            print(f"Processed {min(start + chunk_size, len(todo))}/{len(todo)} receipts")
+    finally:
+        manifest.close()
+    if hasattr(processor, "summarize_escalations"):
+        summary = processor.summarize_escalations()
+        if summary:
+            print(f"Escalated {summary['escalated']}/{summary['receipts']} receipts to the LLM "
+                  f"({summary['escalation_rate']:.0%}, threshold {summary['threshold']})")
+    if failed:
+        print(f"{failed} receipts could not be extracted and will be retried on the next run")
+    return manifest
+
+
+def build_report(manifest_path, output_path, images_per_page=4, images_per_row=None, layout=None):
+    """只根据清单生成PDF报告，不调用提取引擎"""
+    receipts = Manifest(manifest_path).receipts()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "wb") as f:
+        writer = StreamingReportWriter(f, images_per_page, images_per_row, layout)
+        for receipt in receipts:
+            writer.add(receipt)
+        writer.close()
+    print(f"PDF report generated: {output_path} ({writer.count} receipts)")
+    print(f"total amount$: ${writer.total_amount:.2f}")
+    return writer.total_amount
+
+
+def summarize_ledger(manifest_path, keys=("type", "month"), output_path=None):
+    """把清单中的收据装入台账，打印按 keys 分组的张数和金额；output_path 以 .parquet 结尾时导出 Parquet，否则 CSV"""
+    ledger = ReceiptLedger.from_receipts(Manifest(manifest_path).receipts())
+    for row in ledger.aggregate(*keys):
+        label = "  ".join(str(row[key]) for key in keys)
+        print(f"{label:<32} {row['count']:6d}  ${row['amount']:.2f}")
+    print(f"{len(ledger)} receipts, total amount$: ${ledger.total_amount():.2f}")
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        ledger.save(output_path)
+        print(f"Ledger written to {output_path}")
+    return ledger
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch-process Uber receipt folders")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="extract new or changed receipts into the manifest")
+    run_parser.add_argument("folders", nargs="+")
+    run_parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    run_parser.add_argument("--engine", choices=engine_names(), default=DEFAULT_ENGINE)
+    run_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+
+    report_parser = commands.add_parser("report", help="build a PDF report from the manifest")
+    report_parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    report_parser.add_argument("--output", default="report/expense_batch.pdf")
+    report_parser.add_argument("--images-per-page", type=int, default=4)
+    report_parser.add_argument("--images-per-row", type=int, default=None,
+                               help="columns per row, chosen from the page layout by default")
+    report_parser.add_argument("--layout", choices=LAYOUTS, default=REPORT_LAYOUT)
+
+    ledger_parser = commands.add_parser("ledger", help="total the manifest by type, month or amount range")
+    ledger_parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    ledger_parser.add_argument("--by", default="type,month", help=f"comma-separated keys from {', '.join(GROUP_KEYS)}")
+    ledger_parser.add_argument("--output", default=None, help="export to .csv or .parquet")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args.folders, args.manifest, args.engine, args.chunk_size)
+    elif args.command == "ledger":
+        keys = [key for key in args.by.split(",") if key]
+        unknown = [key for key in keys if key not in GROUP_KEYS]
+        if unknown:
+            parser.error(f"unknown --by keys: {', '.join(unknown)}")
+        summarize_ledger(args.manifest, keys, args.output)
+    else:
+        build_report(args.manifest, args.output, args.images_per_page, args.images_per_row, args.layout)
+
+
+if __name__ == "__main__":
+    main()
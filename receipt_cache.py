@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from receipt_metrics import CACHE_LOOKUPS
+
+# 默认缓存位置和容量，可通过环境变量调整
+DEFAULT_CACHE_PATH = os.getenv(
+    "RECEIPT_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "receipt_org", "extractions.sqlite3")
+)
+DEFAULT_MAX_ENTRIES = int(os.getenv("RECEIPT_CACHE_MAX_ENTRIES", "50000"))
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """计算文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _encode_value(value):
+    # OCR 引擎返回的日期可能是 datetime 对象
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot cache value of type {type(value).__name__}")
+
+
+def _decode_value(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def dump_result(result):
+    """把提取结果序列化为 JSON，datetime 会被保留"""
+    return json.dumps(result, default=_encode_value)
+
+
+def load_result(text):
+    return json.loads(text, object_hook=_decode_value)
+
+
+class ExtractionCache:
+    """基于 SQLite 的提取结果缓存，按图片内容寻址，LRU 淘汰"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS extractions (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions(last_used)"
+        )
+        self._count = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+
+    @staticmethod
+    def make_key(digest, engine, model, prompt_version):
+        """缓存键：图片内容哈希 + 引擎 + 模型 + 提示词版本"""
+        return f"{digest}:{engine}:{model}:{prompt_version}"
+
+    def get(self, key):
+        """命中时返回结果字典（不含 path），否则返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result="hit")
+            self._conn.execute(
+                "UPDATE extractions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return load_result(row[0])
+
+    def put(self, key, result):
+        """写入结果；path 与具体文件位置有关，不写入缓存"""
+        result = {k: v for k, v in result.items() if k != "path"}
+        payload = dump_result(result)
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, result, last_used) VALUES (?, ?, ?)",
+                (key, payload, time.time())
+            )
+            if not exists:
+                self._count += 1
+            if self._count > self.max_entries:
+                self._evict(self._count - self.max_entries)
+
+    def _evict(self, n):
+        # 删除最久未使用的 n 条记录
+        self._conn.execute(
+            """DELETE FROM extractions WHERE key IN (
+                SELECT key FROM extractions ORDER BY last_used ASC LIMIT ?
+            )""",
+            (n,)
+        )
+        self._count = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+
+    def stats(self):
+        """返回命中/未命中计数和当前条目数"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self._count,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM extractions")
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_default_cache():
+    """进程内共享的默认缓存实例；设置 RECEIPT_CACHE_DISABLED=1 可关闭缓存"""
+    global _default_cache
+    if os.getenv("RECEIPT_CACHE_DISABLED") == "1":
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ExtractionCache()
+        return _default_cache
@@ -0,0 +1,312 @@
+import hashlib
+import logging
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+from receipt_metrics import timed
+from receipt_sources import autocrop, load_receipt_image, receipt_digest
+
+logger = logging.getLogger(__name__)
+
+# 感知哈希的网格边长：16x16 网格，每格取水平和垂直两个梯度位，共 512 位
+HASH_SIZE = 16
+# 汉明距离不超过该阈值的图片作为重复的候选；设为负数关闭去重
+DEDUP_THRESHOLD = int(os.getenv("DEDUP_THRESHOLD", "12"))
+# 候选与已有收据的缩略图距离（0-255，见 thumbnail_distance）不超过该阈值时视为重复；
+# 设为负数则只合并文件内容或解码后像素完全相同的图片
+DEDUP_PIXEL_THRESHOLD = int(os.getenv("DEDUP_PIXEL_THRESHOLD", "64"))
+# 确认重复用的灰度缩略图宽度，高度按比例
+THUMBNAIL_WIDTH = 256
+# 计算哈希只需要较小的图，PDF 页面按低DPI栅格化，JPEG 按缩小的尺寸解码
+HASH_PDF_DPI = 72
+HASH_DECODE_SIZE = 512
+HASH_WORKERS = 8
+
+
+def _crop_content(img, max_passes=3):
+    """反复裁掉背景，去掉截图/邮件图片外框和收据本身的留白"""
+    for _ in range(max_passes):
+        cropped = autocrop(img, padding=0)
+        if cropped.size == img.size:
+            break
+        img = cropped
+    return img
+
+
+def dhash(ref, hash_size=HASH_SIZE):
+    """对收据内容区域计算水平+垂直差值哈希，返回整数
+
+    同一版式的收据整体结构很像，只用水平梯度的 dHash 很难区分，
+    加上垂直梯度后对文字行的变化更敏感。
+    """
+    # JPEG 按缩小的尺寸解码；解码结果留在共享缓存中，随后的 OCR 或渲染可以直接使用
+    img = load_receipt_image(ref, HASH_PDF_DPI, (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    return image_hash(img, hash_size)
+
+
+def pixel_digest(ref):
+    """解码后像素的 SHA-256；只是元数据或无损编码不同的同一张图片得到相同的值"""
+    img = load_receipt_image(ref, HASH_PDF_DPI)
+    digest = hashlib.sha256(f"{img.mode}{img.size}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def thumbnail(ref):
+    """裁掉边框、拉伸对比度后的灰度缩略图，用于确认候选是否是同一张收据"""
+    img = load_receipt_image(ref, HASH_PDF_DPI, (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    return image_thumbnail(img)
+
+
+def signature(ref, hash_size=HASH_SIZE):
+    """一次解码同时计算 dhash 和 thumbnail，返回 (哈希, 缩略图)"""
+    img = load_receipt_image(ref, HASH_PDF_DPI, (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    content = _content(img)
+    return _content_hash(content, hash_size), _content_thumbnail(content)
+
+
+def image_thumbnail(img):
+    """对已打开的图片计算与 thumbnail 相同的缩略图"""
+    return _content_thumbnail(_content(img))
+
+
+def _content(img):
+    return _crop_content(ImageOps.exif_transpose(img).convert("L"))
+
+
+def _content_thumbnail(img):
+    # 保持宽高比：短收据拉伸到固定高度后，缩放比例接近 1，细笔画的采样随原图分辨率变化很大
+    img = ImageOps.autocontrast(img)
+    height = max(1, round(img.height * THUMBNAIL_WIDTH / img.width))
+    # 轻微模糊，压掉有损压缩和缩放留下的噪点，文字的差异仍然保留
+    return img.resize((THUMBNAIL_WIDTH, height), Image.BOX).filter(ImageFilter.GaussianBlur(1))
+
+
+def _shift(img, dx, dy):
+    """平移一个像素，移出的边沿保留原值"""
+    out = img.copy()
+    out.paste(img.crop((max(0, -dx), max(0, -dy), img.width - max(0, dx), img.height - max(0, dy))),
+              (max(0, dx), max(0, dy)))
+    return out
+
+
+def _envelope(img, op):
+    """3x3 邻域的最小值（op=darker）或最大值（op=lighter）
+
+    和 MinFilter(3)/MaxFilter(3) 结果相同，但先横后竖地取平移后的最值，快一个数量级。
+    """
+    for dx, dy in ((1, 0), (0, 1)):
+        img = op(op(img, _shift(img, dx, dy)), _shift(img, -dx, -dy))
+    return img
+
+
+def _with_envelope(thumb):
+    """(缩略图, 3x3 邻域最小值, 3x3 邻域最大值)，同一张缩略图和多个候选比较时只算一次"""
+    return thumb, _envelope(thumb, ImageChops.darker), _envelope(thumb, ImageChops.lighter)
+
+
+def _outside(a, b):
+    """a 的每个像素超出 b 在 3x3 邻域内取值范围的量，允许两张图错开一个像素"""
+    _, low, high = b
+    return ImageChops.lighter(ImageChops.subtract(a[0], high), ImageChops.subtract(low, a[0]))
+
+
+def _distance(a, b):
+    if abs(a[0].height - b[0].height) > 2:
+        return 255
+    box = (0, 0, THUMBNAIL_WIDTH, min(a[0].height, b[0].height))
+    a, b = [img.crop(box) for img in a], [img.crop(box) for img in b]
+    return ImageChops.lighter(_outside(a, b), _outside(b, a)).getextrema()[1]
+
+
+def thumbnail_distance(a, b):
+    """两张缩略图的距离（0-255）：允许错开一个像素后最大的像素差；高度相差超过 2 像素时为 255
+
+    同一版式的不同收据只差几行字，字所在的位置差值很大；重新压缩、缩放或截图带来的是分散的小差值。
+    """
+    return _distance(_with_envelope(a), _with_envelope(b))
+
+
+def image_hash(img, hash_size=HASH_SIZE):
+    """对已打开的图片计算与 dhash 相同的哈希"""
+    return _content_hash(_content(img), hash_size)
+
+
+def _content_hash(img, hash_size):
+    small = img.resize((hash_size + 1, hash_size + 1), Image.BOX)
+    pixels = small.load()
+    value = 0
+    for y in range(hash_size):
+        for x in range(hash_size):
+            value = (value << 2) | ((pixels[x, y] > pixels[x + 1, y]) << 1) | (pixels[x, y] > pixels[x, y + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHash:
+    """多索引哈希：把哈希切成 radius+1 段分别建表
+
+    两个哈希的距离不超过 radius 时至少有一段完全相同（鸽巢原理），
+    所以只需比较在某段上精确命中的候选，无需两两比较。
+    """
+
+    def __init__(self, bits, radius):
+        self.radius = radius
+        segments = radius + 1
+        bounds = [bits * k // segments for k in range(segments + 1)]
+        self._segments = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._segments]
+
+    def add(self, value, item):
+        for (shift, mask), table in zip(self._segments, self._tables):
+            table.setdefault((value >> shift) & mask, []).append((value, item))
+
+    def search(self, value):
+        """返回距离不超过 radius 的 (distance, item) 列表"""
+        matches = {}
+        for (shift, mask), table in zip(self._segments, self._tables):
+            for candidate, item in table.get((value >> shift) & mask, ()):
+                if item not in matches:
+                    distance = hamming(value, candidate)
+                    if distance <= self.radius:
+                        matches[item] = distance
+        return [(distance, item) for item, distance in matches.items()]
+
+
+class DuplicateIndex:
+    """保存已见过图片的哈希，跨多次 add_receipt 调用识别重复
+
+    感知哈希只用来找候选：同一版式的不同收据只差日期和金额几行字，哈希常常很接近。
+    文件内容或解码后的像素完全相同的候选直接算作重复；其余的比较缩略图，
+    距离不超过 pixel_threshold 才算重复，这样重新截图、压缩或缩放过的副本也能合并。
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, pixel_threshold=DEDUP_PIXEL_THRESHOLD):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self._index = MultiIndexHash(2 * HASH_SIZE * HASH_SIZE, threshold)
+        self._size = 0
+        # (函数, 引用) -> 内容哈希或像素哈希，每张图片最多计算一次
+        self._digests = {}
+        # 已索引的引用 -> (尺寸, zlib 压缩的缩略图及其邻域最小/最大值)，每张约 30KB，
+        # 确认候选时不用重新解码原图
+        self._thumbnails = {}
+
+    def _digest(self, fn, ref):
+        key = (fn, ref)
+        if key not in self._digests:
+            try:
+                self._digests[key] = fn(ref)
+            except Exception as e:
+                logger.warning("Error reading %s for duplicate check: %s", ref, e)
+                self._digests[key] = None
+        return self._digests[key]
+
+    def _add_thumbnail(self, ref, thumb):
+        self._thumbnails[ref] = (thumb[0].size, [zlib.compress(img.tobytes(), 1) for img in thumb])
+
+    def _thumbnail(self, ref):
+        size, data = self._thumbnails[ref]
+        return [Image.frombytes("L", size, zlib.decompress(d)) for d in data]
+
+    def _same(self, a, thumb, b):
+        """确认候选 b 和新图片 a 是同一张收据：文件内容相同，或者缩略图足够接近
+
+        只做精确比较时（pixel_threshold 为负）改为比较解码后的像素；否则像素相同的图片缩略图距离为 0，不必全尺寸解码。
+        """
+        digest = self._digest(receipt_digest, a)
+        if digest is not None and digest == self._digest(receipt_digest, b):
+            return True
+        if self.pixel_threshold < 0:
+            digest = self._digest(pixel_digest, a)
+            return digest is not None and digest == self._digest(pixel_digest, b)
+        return _distance(thumb, self._thumbnail(b)) <= self.pixel_threshold
+
+    def assign(self, refs):
+        """返回每张图片对应的代表图片；新图片加入索引并返回 None"""
+        with timed("dedup_hash"), ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            signatures = list(executor.map(_safe_signature, refs))
+
+        representatives = []
+        for ref, (value, thumb) in zip(refs, signatures):
+            if value is None:
+                representatives.append(None)
+                continue
+            if self.pixel_threshold >= 0:
+                thumb = _with_envelope(thumb)
+            # 按距离、加入顺序依次确认候选，取第一个确认重复的
+            rep = next((item[1] for _, item in sorted(self._index.search(value))
+                        if self._same(ref, thumb, item[1])), None)
+            if rep is None:
+                self._index.add(value, (self._size, ref))
+                if self.pixel_threshold >= 0:
+                    self._add_thumbnail(ref, thumb)
+                self._size += 1
+            representatives.append(rep)
+        return representatives
+
+
+def _safe_signature(ref):
+    # 无法解码的图片不参与去重，交给提取阶段报错
+    try:
+        return signature(ref)
+    except Exception as e:
+        logger.warning("Error hashing %s: %s", ref, e)
+        return None, None
+
+
+def extract_deduplicated(refs, index, extract_many, previous=None, on_result=None):
+    """去重后只提取每组的代表图片，重复的图片复制代表的结果并标记 duplicate_of
+
+    extract_many(refs, on_result) 是处理器自己的批量提取函数，按顺序返回结果；
+    previous 是之前批次已提取的 {path: info}，用于识别跨批次的重复。
+    """
+    if index is None:
+        return extract_many(refs, on_result)
+
+    representatives = index.assign(refs)
+    # 同一个引用出现多次时以第一次为代表
+    position = {}
+    for i, ref in enumerate(refs):
+        position.setdefault(ref, i)
+    unique = [i for i, rep in enumerate(representatives) if rep is None]
+    members = {}
+    results = [None] * len(refs)
+    for i, rep in enumerate(representatives):
+        if rep is None:
+            continue
+        if rep in position and position[rep] != i:
+            members.setdefault(position[rep], []).append(i)
+        elif previous and rep in previous:
+            results[i] = dict(previous[rep], path=refs[i], duplicate_of=rep)
+        else:
+            unique.append(i)
+    unique.sort()
+    duplicates = len(refs) - len(unique)
+    if duplicates:
+        logger.info("Found %d duplicate receipts", duplicates)
+
+    for i, receipt_info in enumerate(results):
+        if receipt_info is not None and on_result:
+            on_result(i, receipt_info)
+
+    def on_unique_result(k, receipt_info):
+        i = unique[k]
+        results[i] = receipt_info
+        if on_result:
+            on_result(i, receipt_info)
+        for j in members.get(i, []):
+            results[j] = dict(receipt_info, path=refs[j], duplicate_of=refs[i])
+            if on_result:
+                on_result(j, results[j])
+
+    unique_results = extract_many([refs[i] for i in unique], on_unique_result)
+    # 处理器可能不逐个回调，这里按返回值补齐
+    for k, receipt_info in enumerate(unique_results):
+        if results[unique[k]] is None:
+            on_unique_result(k, receipt_info)
+    return results
@@ -0,0 +1,126 @@
+"""任务进度的事件流：每张收据提取完成时推送结果和累计金额，结束时推送汇总，由 app 以 SSE 发给浏览器
+
+事件按顺序编号并全部保留（每个任务最多几百条），浏览器断线重连时用 Last-Event-ID 从中断处继续。
+事件由工作线程写入，SSE 连接在事件循环中等待，不占用线程池。
+"""
+import asyncio
+import json
+import threading
+from datetime import datetime
+
+
+def receipt_item(name, info):
+    """一张收据对外展示的字段，任务状态和事件共用；info 为 None 表示还没有提取"""
+    item = {"file": name, "status": "pending" if info is None else "done"}
+    if info is not None:
+        date = info["date"]
+        item.update({
+            "type": info["type"],
+            "date": date.isoformat() if isinstance(date, datetime) else date,
+            "amount": info["amount"],
+            "duplicate": "duplicate_of" in info,
+        })
+    return item
+
+
+def format_sse(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class EventLog:
+    """只追加的事件列表；close() 之后订阅方读完剩余事件即结束"""
+
+    def __init__(self):
+        self.events = []
+        self.closed = False
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def append(self, event, data, close=False):
+        with self._lock:
+            if self.closed:
+                return
+            self.events.append((len(self.events) + 1, event, data))
+            self.closed = close
+            waiters, self._waiters = self._waiters, []
+        self._wake(waiters)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            waiters, self._waiters = self._waiters, []
+        self._wake(waiters)
+
+    @staticmethod
+    def _wake(waiters):
+        for loop, ready in waiters:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+
+    def read(self, after=0):
+        """返回 (编号大于 after 的事件 [(编号, 类型, 数据)], 是否已关闭)"""
+        with self._lock:
+            return self.events[after:], self.closed
+
+    async def wait(self, after=0, timeout=None):
+        """在事件循环中等待新事件，最多 timeout 秒；返回值同 read()"""
+        ready = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), ready)
+        with self._lock:
+            if len(self.events) > after or self.closed:
+                ready.set()
+            else:
+                self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return self.read(after)
+
+
+class ReceiptProgress:
+    """按完成顺序汇总收据：每张收据写一条 receipt 事件和一条 totals 事件，结束时写 done 事件
+
+    重复的收据照常推送（duplicate 为 true），但和报告一样不计入金额。
+    """
+
+    def __init__(self, total=None):
+        self.log = EventLog()
+        self.total = total
+        self.extracted = 0
+        self.total_amount = 0
+        self.by_type = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, info, **fields):
+        """记录一张收据；fields 附加到 receipt 事件中，例如序号"""
+        with self._lock:
+            self.extracted += 1
+            if 'duplicate_of' not in info:
+                self.total_amount += info['amount']
+                self.by_type[info['type']] = self.by_type.get(info['type'], 0) + info['amount']
+            self.log.append("receipt", dict(receipt_item(name, info), **fields))
+            self.log.append("totals", self.totals())
+
+    def fail(self, name, error, **fields):
+        """记录一个无法读取的文件；它没有收据，不计入 extracted 和金额"""
+        self.log.append("receipt", dict({"file": name, "status": "failed", "error": error}, **fields))
+
+    def totals(self):
+        return {
+            "extracted": self.extracted,
+            "total": self.total,
+            "total_amount": round(self.total_amount, 2),
+            "by_type": {key: round(value, 2) for key, value in self.by_type.items()},
+        }
+
+    def finish(self, status, **fields):
+        """写入 done 事件并关闭事件流；fields 例如 error、total_amount"""
+        self.log.append("done", dict(fields, status=status), close=True)
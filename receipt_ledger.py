@@ -0,0 +1,344 @@
+"""收据台账：按列保存在定长类型数组中的提取结果，用 NumPy 按类型、月份和金额区间汇总
+
+每张收据只占几个数组元素（类型编号 1 字节、时间 8 字节、金额 8 字节、重复标记 1 字节）加上路径字符串，
+几万张收据的归档也可以常驻内存。日期在写入时统一解析成秒级时间戳，
+LLM 返回的 "Jan 05, 2024"、OCR 得到的 datetime 和 "sun jul 14 2024" 都能按月分组，无法识别的日期记为 NaT。
+台账可以导出为 CSV 或 Parquet（需要 pyarrow）并重新读取。NumPy 只在汇总和导出时导入。
+"""
+import array
+import csv
+import threading
+from datetime import date, datetime, timedelta
+
+# 按金额区间汇总时的默认分界（美元）：<0, 0-10, 10-25, 25-50, 50-100, 100+
+AMOUNT_BINS = (0, 10, 25, 50, 100)
+# LLM、OCR 和测试数据中出现过的日期格式；ISO 格式先用 fromisoformat 解析
+DATE_FORMATS = ("%b %d, %Y", "%B %d, %Y", "%b %d %Y", "%a %b %d %Y", "%b %d, %Y %I:%M %p")
+# 没有日期时的时间戳，与 numpy.datetime64 的 NaT 相同
+NO_DATE = -2 ** 63
+GROUP_KEYS = ("type", "month", "amount_range")
+COLUMNS = ("path", "type", "date", "amount", "duplicate_of")
+
+_EPOCH = datetime(1970, 1, 1)
+_SECOND = timedelta(seconds=1)
+
+
+def parse_receipt_date(value):
+    """把提取结果中的日期转换为 datetime，无法识别时返回 None"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if not isinstance(value, str):
+        return None
+    text = " ".join(value.split())
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _timestamp(value):
+    parsed = parse_receipt_date(value)
+    return NO_DATE if parsed is None else (parsed - _EPOCH) // _SECOND
+
+
+class LedgerRecord:
+    """台账中的一行，按需从各列读取字段，不复制数据"""
+
+    __slots__ = ("ledger", "index")
+
+    def __init__(self, ledger, index):
+        self.ledger = ledger
+        self.index = index
+
+    @property
+    def path(self):
+        return self.ledger._paths[self.index]
+
+    @property
+    def type(self):
+        return self.ledger.type_names[self.ledger._types[self.index]]
+
+    @property
+    def date(self):
+        seconds = self.ledger._dates[self.index]
+        return None if seconds == NO_DATE else _EPOCH + timedelta(seconds=seconds)
+
+    @property
+    def amount(self):
+        return self.ledger._amounts[self.index]
+
+    @property
+    def duplicate_of(self):
+        return self.ledger._duplicate_of.get(self.index)
+
+    def to_dict(self):
+        """与处理器 receipts 中相同格式的字典；无法识别的日期为 "Unknown" """
+        receipt = {"date": self.date or "Unknown", "amount": self.amount, "type": self.type, "path": self.path}
+        if self.index in self.ledger._duplicate_of:
+            receipt["duplicate_of"] = self.duplicate_of
+        return receipt
+
+    def __repr__(self):
+        return f"LedgerRecord({self.type}, {self.date}, {self.amount:.2f}, {self.path!r})"
+
+
+class ReceiptLedger:
+    """只追加的收据台账；可以在多个线程中写入
+
+    类型编号按第一次出现的顺序分配，汇总结果的顺序与 summarize_by_type 一致。
+    重复的收据照常记录（标记 duplicate_of），汇总时默认不计入。
+    """
+
+    def __init__(self):
+        self.type_names = []
+        self._type_codes = {}
+        self._paths = []
+        self._types = array.array("B")
+        self._dates = array.array("q")
+        self._amounts = array.array("d")
+        self._duplicates = array.array("B")
+        self._duplicate_of = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_receipts(cls, receipts):
+        ledger = cls()
+        ledger.extend(receipts)
+        return ledger
+
+    def _type_code(self, name):
+        code = self._type_codes.get(name)
+        if code is None:
+            if len(self.type_names) == 255:
+                raise ValueError("A ledger holds at most 255 receipt types")
+            code = self._type_codes[name] = len(self.type_names)
+            self.type_names.append(name)
+        return code
+
+    def append(self, receipt):
+        """加入一条提取结果（处理器 receipts 中的字典），返回行号"""
+        seconds = _timestamp(receipt.get("date"))
+        with self._lock:
+            index = len(self._paths)
+            self._types.append(self._type_code(receipt.get("type") or "Unknown"))
+            self._dates.append(seconds)
+            self._amounts.append(float(receipt.get("amount") or 0.0))
+            self._duplicates.append("duplicate_of" in receipt)
+            if "duplicate_of" in receipt:
+                self._duplicate_of[index] = receipt["duplicate_of"]
+            self._paths.append(receipt.get("path"))
+        return index
+
+    def extend(self, receipts):
+        for receipt in receipts:
+            self.append(receipt)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ledger index out of range")
+        return LedgerRecord(self, index)
+
+    def __iter__(self):
+        return (LedgerRecord(self, i) for i in range(len(self)))
+
+    def receipts(self):
+        """全部收据，格式同处理器的 receipts"""
+        return [record.to_dict() for record in self]
+
+    def nbytes(self):
+        """各列数组占用的字节数（不含路径字符串）"""
+        return sum(column.itemsize * len(column)
+                   for column in (self._types, self._dates, self._amounts, self._duplicates))
+
+    def columns(self):
+        """各列的 NumPy 副本：{"type": uint8 编号, "date": datetime64[s]（NaT 表示没有日期）, "amount", "duplicate"}
+
+        复制而不是共享缓冲区：数组被导出缓冲区期间不能再追加。
+        """
+        import numpy as np
+        with self._lock:
+            return {
+                "type": np.array(self._types, dtype=np.uint8),
+                "date": np.array(self._dates, dtype=np.int64).view("datetime64[s]"),
+                "amount": np.array(self._amounts, dtype=np.float64),
+                "duplicate": np.array(self._duplicates, dtype=bool),
+            }
+
+    @staticmethod
+    def _group(key, columns, type_names, bins):
+        """一个分组键对应的 (每行的组编号, 组名)"""
+        import numpy as np
+        if key == "type":
+            return columns["type"].astype(np.intp), list(type_names)
+        if key == "month":
+            months = columns["date"].astype("datetime64[M]")
+            known = ~np.isnat(months)
+            if not known.any():
+                return np.zeros(len(months), dtype=np.intp), ["unknown"]
+            values = months.view(np.int64)
+            first = values[known].min()
+            span = int(values[known].max() - first) + 1
+            # 没有日期的收据放在最后一组
+            codes = np.where(known, values - first, span).astype(np.intp)
+            labels = [str(np.datetime64(int(first) + i, "M")) for i in range(span)]
+            return codes, labels + ["unknown"]
+        if key == "amount_range":
+            edges = list(bins)
+            labels = [f"<{edges[0]:g}"] + [f"{low:g}-{high:g}" for low, high in zip(edges, edges[1:])]
+            labels.append(f"{edges[-1]:g}+")
+            return np.digitize(columns["amount"], edges).astype(np.intp), labels
+        raise ValueError(f"Unknown group key {key!r}, expected one of {', '.join(GROUP_KEYS)}")
+
+    def aggregate(self, *keys, bins=AMOUNT_BINS, include_duplicates=False):
+        """按 keys（type、month、amount_range 的任意组合）分组统计张数和金额
+
+        返回 [{键: 组名, ..., "count": 张数, "amount": 金额}]，只包含有收据的组，按各键的组顺序排列。
+        """
+        import numpy as np
+        columns = self.columns()
+        groups = [self._group(key, columns, self.type_names, bins) for key in keys]
+        shape = tuple(len(labels) for _, labels in groups)
+        if groups:
+            flat = np.ravel_multi_index([codes for codes, _ in groups], shape)
+        else:
+            flat = np.zeros(len(columns["amount"]), dtype=np.intp)
+        amounts = columns["amount"]
+        if not include_duplicates:
+            kept = ~columns["duplicate"]
+            flat, amounts = flat[kept], amounts[kept]
+        size = int(np.prod(shape)) if groups else 1
+        counts = np.bincount(flat, minlength=size)
+        totals = np.bincount(flat, weights=amounts, minlength=size)
+
+        rows = []
+        for group in np.flatnonzero(counts):
+            position = np.unravel_index(group, shape) if groups else ()
+            row = {key: labels[i] for key, (_, labels), i in zip(keys, groups, position)}
+            row["count"] = int(counts[group])
+            row["amount"] = float(totals[group])
+            rows.append(row)
+        return rows
+
+    def totals_by_type(self):
+        """{类型: 金额}，不含重复的收据，结果与 summarize_by_type 相同"""
+        return {row["type"]: row["amount"] for row in self.aggregate("type")}
+
+    def totals_by_month(self):
+        """{"YYYY-MM" 或 "unknown": 金额}，不含重复的收据"""
+        return {row["month"]: row["amount"] for row in self.aggregate("month")}
+
+    def total_amount(self):
+        rows = self.aggregate()
+        return rows[0]["amount"] if rows else 0.0
+
+    def save(self, path):
+        """按扩展名导出为 .csv 或 .parquet"""
+        if path.endswith(".parquet"):
+            return self.to_parquet(path)
+        return self.to_csv(path)
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith(".parquet"):
+            return cls.from_parquet(path)
+        return cls.from_csv(path)
+
+    def _export_columns(self):
+        """导出用的列：路径、类型名、ISO 日期（没有时为空）、金额、重复对象（没有时为空）"""
+        import numpy as np
+        columns = self.columns()
+        with self._lock:
+            paths = list(self._paths)
+            duplicate_of = [self._duplicate_of.get(i) for i in range(len(paths))]
+        dates = np.datetime_as_string(columns["date"])
+        dates[np.isnat(columns["date"])] = ""
+        types = np.array(self.type_names, dtype=object)[columns["type"]] if paths else []
+        return paths, types, dates, columns["amount"], duplicate_of
+
+    def to_csv(self, path):
+        paths, types, dates, amounts, duplicate_of = self._export_columns()
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            # 金额用 repr 写出，读回时完全一致
+            writer.writerows(zip(paths, types, dates, map(repr, amounts.tolist()),
+                                 (value or "" for value in duplicate_of)))
+
+    @classmethod
+    def from_csv(cls, path):
+        import numpy as np
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return cls()
+            if tuple(header) != COLUMNS:
+                raise ValueError(f"{path} is not a receipt ledger (columns {header})")
+            rows = list(reader)
+        paths, types, dates, amounts, duplicate_of = zip(*rows) if rows else ((),) * 5
+        return cls._from_columns(list(paths), list(types),
+                                 np.array(dates, dtype="datetime64[s]"),
+                                 np.array(amounts, dtype=np.float64),
+                                 [value or None for value in duplicate_of])
+
+    def to_parquet(self, path):
+        """导出为 Parquet（需要 pyarrow）；类型列使用字典编码，日期为可空的秒级时间戳"""
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = self.columns()
+        with self._lock:
+            paths = list(self._paths)
+            duplicate_of = [self._duplicate_of.get(i) for i in range(len(paths))]
+        table = pa.Table.from_arrays([
+            pa.array(paths, pa.string()),
+            pa.DictionaryArray.from_arrays(pa.array(columns["type"].astype(np.int32)),
+                                           pa.array(self.type_names, pa.string())),
+            pa.array(columns["date"], pa.timestamp("s"), mask=np.isnat(columns["date"])),
+            pa.array(columns["amount"], pa.float64()),
+            pa.array(duplicate_of, pa.string()),
+        ], names=list(COLUMNS))
+        pq.write_table(table, path)
+
+    @classmethod
+    def from_parquet(cls, path):
+        import numpy as np
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=list(COLUMNS))
+        types = table.column("type").combine_chunks()
+        if hasattr(types, "dictionary"):
+            types = np.array(types.dictionary.to_pylist(), dtype=object)[types.indices.to_numpy(zero_copy_only=False)]
+        else:
+            types = types.to_pylist()
+        dates = table.column("date").to_numpy().astype("datetime64[s]")
+        return cls._from_columns(table.column("path").to_pylist(), list(types), dates,
+                                 table.column("amount").to_numpy().astype(np.float64),
+                                 table.column("duplicate_of").to_pylist())
+
+    @classmethod
+    def _from_columns(cls, paths, types, dates, amounts, duplicate_of):
+        """由整列数据构造台账，不逐行解析日期"""
+        import numpy as np
+        ledger = cls()
+        ledger._paths = paths
+        codes = [ledger._type_code(name or "Unknown") for name in types]
+        ledger._types = array.array("B", codes)
+        ledger._dates.frombytes(np.ascontiguousarray(dates.astype("datetime64[s]").view(np.int64)).tobytes())
+        ledger._amounts.frombytes(np.ascontiguousarray(amounts, dtype=np.float64).tobytes())
+        ledger._duplicates = array.array("B", (value is not None for value in duplicate_of))
+        ledger._duplicate_of = {i: value for i, value in enumerate(duplicate_of) if value is not None}
+        return ledger
+
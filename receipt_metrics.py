@@ -0,0 +1,255 @@
+"""进程内的轻量指标：计数器、仪表和直方图，按 Prometheus 文本格式导出
+
+每次记录只是一次加锁的字典更新，可以在高负载下常开。
+需要查看单个请求的耗时分布时，创建 Trace 并把它传给 timed()。
+"""
+import abc
+import bisect
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 默认的直方图分桶（秒），覆盖从毫秒级的解析到几十秒的整批处理
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# 最多保留的请求追踪数，超出后丢弃最早的
+TRACE_LIMIT = int(os.getenv("METRICS_TRACE_LIMIT", "100"))
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(abc.ABC):
+    """指标的公共部分；子类给出 kind 并实现 _samples"""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def _samples(self):
+        """返回 (后缀, 标签值, 额外标签, 数值) 的序列，render 逐行输出"""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [("_total", key, (), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn, **labels):
+        """导出时调用 fn() 取值，例如队列长度"""
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        return [("", key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每个桶只记自己的次数，导出时再累加
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def means(self):
+        """各标签组合的平均值，键为标签值元组"""
+        with self._lock:
+            return {key: state[1] / state[2] for key, state in self._values.items() if state[2]}
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                samples.append(("_bucket", key, (("le", _format_value(float(bound))),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), count))
+        return samples
+
+
+def render():
+    """所有指标的 Prometheus 文本格式"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# 各处共用的指标
+STAGE_SECONDS = Histogram("receipt_stage_seconds", "Time spent in each processing stage", ["stage"])
+EXTRACTIONS = Counter("receipt_extractions", "Receipts extracted", ["engine", "status"])
+LLM_REQUESTS = Counter("receipt_llm_requests", "Chat-completion requests by outcome", ["outcome"])
+LLM_TOKENS = Counter("receipt_llm_tokens", "Tokens used by chat-completion requests", ["kind"])
+HYBRID_DECISIONS = Counter("receipt_hybrid_decisions", "Receipts accepted from local OCR or escalated to the LLM", ["decision"])
+CACHE_LOOKUPS = Counter("receipt_cache_lookups", "Extraction cache lookups", ["result"])
+REPORT_CACHE_LOOKUPS = Counter("receipt_report_cache_lookups", "Report cache lookups", ["result"])
+IMAGE_DECODES = Counter("receipt_image_decodes", "Receipt images decoded, by full size, JPEG draft or PDF page", ["kind"])
+IMAGE_CACHE_LOOKUPS = Counter("receipt_image_cache_lookups", "Decoded image cache lookups", ["result"])
+IMAGE_CACHE_BYTES = Gauge("receipt_image_cache_bytes", "Pixel bytes held by the decoded image cache")
+HTTP_REQUESTS = Histogram("receipt_http_request_seconds", "HTTP request latency", ["route", "status"])
+HTTP_IN_FLIGHT = Gauge("receipt_http_requests_in_flight", "HTTP requests being served", ["method"])
+JOBS_IN_FLIGHT = Gauge("receipt_jobs_running", "Jobs currently being processed")
+JOB_QUEUE_DEPTH = Gauge("receipt_job_queue_depth", "Jobs waiting in the queue")
+WORK_QUEUE_TASKS = Gauge("receipt_work_queue_tasks", "Tasks in the shared worker queue", ["status"])
+
+
+class Trace:
+    """单个请求的分阶段耗时记录"""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, start, duration, **attrs):
+        span = {"stage": stage, "start": round(start - self._start, 6), "duration": round(duration, 6),
+                "thread": threading.current_thread().name}
+        span.update(attrs)
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        totals = {}
+        for span in spans:
+            totals[span["stage"]] = totals.get(span["stage"], 0) + span["duration"]
+        return {"id": self.id, "name": self.name, "started_at": self.started_at,
+                "totals": totals, "spans": spans}
+
+
+_traces = OrderedDict()
+_traces_lock = threading.Lock()
+
+
+def start_trace(name):
+    """创建并登记一个追踪，可以之后用 get_trace(id) 取回"""
+    trace = Trace(name)
+    with _traces_lock:
+        _traces[trace.id] = trace
+        while len(_traces) > TRACE_LIMIT:
+            _traces.popitem(last=False)
+    return trace
+
+
+def get_trace(trace_id):
+    return _traces.get(trace_id)
+
+
+def observe(stage, duration, trace=None, start=None, **attrs):
+    """记录一段已经测得的耗时（例如在工作进程中测得的）"""
+    STAGE_SECONDS.observe(duration, stage=stage)
+    if trace is not None:
+        trace.add(stage, time.perf_counter() - duration if start is None else start, duration, **attrs)
+
+
+@contextmanager
+def timed(stage, trace=None, **attrs):
+    """计时一个阶段，写入直方图；传入 trace 时同时记一条 span"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        if trace is not None:
+            trace.add(stage, start, duration, **attrs)
@@ -0,0 +1,319 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from pdf_stream import PageBuilder, StreamingPDFWriter
+from receipt_metrics import timed
+from receipt_sources import (is_memory_ref, is_pdf_page, load_receipt_image, open_receipt_image, open_source,
+                             read_source, receipt_size)
+from report_layout import CAPTION_LEADING, REPORT_LAYOUT, fit_image, make_layout
+
+logger = logging.getLogger(__name__)
+
+# 使用横向A4纸张
+PAGE_SIZE = A4[::-1]  # 交换宽高以获得横向布局
+PAGE_WIDTH, PAGE_HEIGHT = PAGE_SIZE
+# 原来 1x4 布局中每张图片的最大尺寸，也是单独准备图片时的默认尺寸；页面版式见 report_layout
+IMAGE_WIDTH = (PAGE_WIDTH - 150) / 4  # 左右总边距120，图片间距30
+IMAGE_HEIGHT = PAGE_HEIGHT - 120  # 上下留边距
+
+# 快速渲染：按图片在页面上的实际尺寸和目标DPI重采样，只解码一次
+# RENDER_MODE=legacy 恢复为直接嵌入原图
+FAST_RENDER = os.getenv("RENDER_MODE", "fast") != "legacy"
+RENDER_DPI = int(os.getenv("RENDER_DPI", "150"))
+RENDER_JPEG_QUALITY = 85
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
+# PDF 页面栅格化时使用的DPI，刚好满足打印尺寸即可
+RENDER_PDF_DPI = 100
+# 流式生成报告时每批交给处理器的收据数，内存中只有这一批的提取结果
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "32"))
+
+
+def prepare_jpeg(ref, box_width=IMAGE_WIDTH, box_height=IMAGE_HEIGHT, dpi=RENDER_DPI):
+    """解码一次并重采样到目标DPI，返回 (JPEG字节或原文件引用, 像素尺寸, 模式, 绘制宽, 绘制高)
+
+    已经足够小的 RGB/灰度 JPEG 不重新压缩，返回原文件的路径或内存引用。
+    """
+    with timed("render_image"):
+        return _prepare_jpeg(ref, box_width, box_height, dpi)
+
+
+def _prepare_jpeg(ref, box_width, box_height, dpi):
+    if is_pdf_page(ref):
+        (width, height), fmt, mode = receipt_size(ref), None, None
+    else:
+        # 只读文件头，已经足够小的 JPEG 不需要解码
+        with open_receipt_image(ref) as header:
+            (width, height), fmt, mode = header.size, header.format, header.mode
+    draw_width, draw_height = fit_image(width / height, box_width, box_height)
+    target = (max(1, round(draw_width / 72 * dpi)), max(1, round(draw_height / 72 * dpi)))
+    if fmt == "JPEG" and mode in ("RGB", "L") and width <= target[0] and height <= target[1]:
+        return ref, (width, height), mode, draw_width, draw_height
+
+    # 去重或 OCR 已经解码过的图片直接从共享缓存中取；否则 JPEG 用 draft 模式按接近目标的尺寸解码
+    img = load_receipt_image(ref, RENDER_PDF_DPI, target)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if img.width > target[0] or img.height > target[1]:
+        img = img.resize(target, Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=RENDER_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), img.size, img.mode, draw_width, draw_height
+
+
+def prepare_image(ref, box_width=IMAGE_WIDTH, box_height=IMAGE_HEIGHT, dpi=RENDER_DPI):
+    """返回 reportlab 可绘制的 (对象, 绘制宽, 绘制高)；JPEG 数据会被原样嵌入"""
+    data, _, _, draw_width, draw_height = prepare_jpeg(ref, box_width, box_height, dpi)
+    if isinstance(data, str):
+        # 内存中的原图交给 reportlab 时不复制
+        return ImageReader(open_source(data)) if is_memory_ref(data) else data, draw_width, draw_height
+    return ImageReader(io.BytesIO(data)), draw_width, draw_height
+
+
+def _prepare_legacy(ref, box_width=IMAGE_WIDTH, box_height=IMAGE_HEIGHT):
+    # 原来的做法：打开图片只为了取宽高比，再把原图交给 reportlab 嵌入
+    img = open_receipt_image(ref)
+    draw_width, draw_height = fit_image(img.width / img.height, box_width, box_height)
+    # PDF 页面没有可直接嵌入的图片文件，使用栅格化后的图像
+    if is_pdf_page(ref):
+        drawable = ImageReader(img)
+    else:
+        drawable = ImageReader(open_source(ref)) if is_memory_ref(ref) else ref
+    return drawable, draw_width, draw_height
+
+
+def prefetch(fn, items, workers=RENDER_WORKERS):
+    """在线程池中提前准备后续的图片，按顺序产出结果；最多同时保留 2*workers 张"""
+    items = list(items)
+    window = workers * 2
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, item) for item in items[:window]]
+        for i in range(len(items)):
+            result = futures[i].result()
+            futures[i] = None
+            if i + window < len(items):
+                futures.append(executor.submit(fn, items[i + window]))
+            yield result
+
+
+def summarize_by_type(receipts):
+    """按类型汇总金额（重复的收据不计入），返回 (汇总, 重复列表)"""
+    type_summary = {}
+    duplicates = []
+    for receipt in receipts:
+        if 'duplicate_of' in receipt:
+            duplicates.append(receipt)
+            continue
+        type_summary[receipt['type']] = type_summary.get(receipt['type'], 0) + receipt['amount']
+    return type_summary, duplicates
+
+
+def receipt_aspect(receipt):
+    """收据图片的宽高比，只读取文件头"""
+    width, height = receipt_size(receipt['path'])
+    return width / height
+
+
+def receipt_caption(receipt):
+    """图片下方的说明文字，每项一行"""
+    lines = [f"Type: {receipt['type']}", f"Time: {receipt['date']}", f"Amount: ${receipt['amount']:.2f}"]
+    if 'duplicate_of' in receipt:
+        lines.append("Duplicate - not counted")
+    return lines
+
+
+def write_report(output_path, receipts, total_amount, images_per_page=4, images_per_row=None,
+                 fast=FAST_RENDER, trace=None, layout=None, type_summary=None):
+    """生成PDF报告：第一页为汇总，后续页面为收据图片，按 layout（默认 REPORT_LAYOUT）排版
+
+    type_summary 为按类型汇总的金额，例如处理器台账的 totals_by_type()；默认由 receipts 计算。
+    """
+    with timed("pdf_render", trace, receipts=len(receipts)):
+        _write_report(output_path, receipts, total_amount, images_per_page, images_per_row, fast,
+                      layout or REPORT_LAYOUT, type_summary)
+
+
+def _write_report(output_path, receipts, total_amount, images_per_page, images_per_row, fast, layout,
+                  type_summary=None):
+    c = canvas.Canvas(output_path, pagesize=PAGE_SIZE)
+
+    # 第一页：总结页
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(30, PAGE_HEIGHT - 30, "Uber expense report - Summary")
+
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(30, PAGE_HEIGHT - 60, "Amount summary:")
+
+    c.setFont("Helvetica", 12)
+    y = PAGE_HEIGHT - 80
+
+    # 按类型汇总（重复的收据不计入）
+    if type_summary is None:
+        type_summary, duplicates = summarize_by_type(receipts)
+    else:
+        duplicates = [receipt for receipt in receipts if 'duplicate_of' in receipt]
+    logger.debug("type summary: %s", type_summary)
+
+    for receipt_type, amount in type_summary.items():
+        c.drawString(30, y, f"{receipt_type} Total: ${amount:.2f}")
+        y -= 20
+
+    c.drawString(30, y - 20, f"Total: ${total_amount:.2f}")
+
+    # 列出被识别为重复、未计入总额的收据
+    if duplicates:
+        y -= 60
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(30, y, f"Duplicates (not counted): {len(duplicates)}")
+        c.setFont("Helvetica", 10)
+        for receipt in duplicates:
+            y -= 15
+            if y < 30:
+                break
+            c.drawString(30, y, f"{os.path.basename(receipt['path'])} duplicates "
+                                f"{os.path.basename(receipt['duplicate_of'])}")
+
+    # 结束第一页
+    c.showPage()
+
+    # 后续页面：收据图片。先按宽高比排好所有页面，图片按排版后的尺寸准备；
+    # 快速模式下图片在线程池中提前准备，画布按顺序写入
+    pages = list(make_layout(PAGE_SIZE, images_per_page, images_per_row, layout).paginate(
+        (receipt, receipt_aspect(receipt)) for receipt in receipts))
+    prepare = prepare_image if fast else _prepare_legacy
+    placements = [placement for page in pages for placement in page]
+    prepared = prefetch(lambda placement: prepare(placement.item['path'], placement.width, placement.height),
+                        placements)
+
+    for page_number, page in enumerate(pages, start=2):
+        c.setFont("Helvetica-Bold", 16)
+        c.drawString(30, PAGE_HEIGHT - 30, f"Uber expense report - Page {page_number}")
+        c.setFont("Helvetica", 12)
+
+        for placement, (drawable, _, _) in zip(page, prepared):
+            c.drawImage(drawable, placement.x, placement.y, width=placement.width, height=placement.height)
+
+            # 添加收据信息
+            for n, line in enumerate(receipt_caption(placement.item)):
+                c.drawString(placement.caption_x, placement.caption_y - n * CAPTION_LEADING, line)
+
+        c.showPage()
+
+    c.save()
+
+
+class StreamingReportWriter:
+    """流式生成报告：收据页面随提取结果逐页写出，内存中只保留汇总数据
+
+    汇总页在 close() 时生成，并排在文档最前面。
+    """
+
+    # 汇总页最多列出的重复收据数
+    MAX_LISTED_DUPLICATES = 30
+
+    def __init__(self, out, images_per_page=4, images_per_row=None, layout=None):
+        self.images_per_page = images_per_page
+        self.images_per_row = images_per_row
+        self._pdf = StreamingPDFWriter(out, PAGE_SIZE)
+        # 版式只保留当前页的收据，页面排满后写出
+        self._layout = make_layout(PAGE_SIZE, images_per_page, images_per_row, layout)
+        self._page_count = 1  # 汇总页
+        self.count = 0
+        self.total_amount = 0
+        self.type_summary = {}
+        self.duplicate_count = 0
+        self.duplicates = []
+
+    def add(self, receipt):
+        """加入一张收据：更新汇总并排版，当前页排满时准备图片并写出"""
+        if 'duplicate_of' in receipt:
+            self.duplicate_count += 1
+            if len(self.duplicates) < self.MAX_LISTED_DUPLICATES:
+                self.duplicates.append((receipt['path'], receipt['duplicate_of']))
+        else:
+            self.total_amount += receipt['amount']
+            self.type_summary[receipt['type']] = self.type_summary.get(receipt['type'], 0) + receipt['amount']
+
+        self.count += 1
+        for page in self._layout.add(receipt, receipt_aspect(receipt)):
+            self._write_page(page)
+
+    def _write_page(self, placements):
+        """写出一页收据，版式与 write_report 一致"""
+        self._page_count += 1
+        page = PageBuilder()
+        page.text(30, PAGE_HEIGHT - 30, f"Uber expense report - Page {self._page_count}", "Helvetica-Bold", 16)
+        for placement in placements:
+            receipt = placement.item
+            data, (width, height), mode, _, _ = prepare_jpeg(receipt['path'], placement.width, placement.height)
+            if isinstance(data, str):
+                data = read_source(data)
+            image_obj = self._pdf.add_jpeg(data, width, height, mode)
+            page.image(image_obj, placement.x, placement.y, placement.width, placement.height)
+            for n, line in enumerate(receipt_caption(receipt)):
+                page.text(placement.caption_x, placement.caption_y - n * CAPTION_LEADING, line)
+        self._pdf.add_page(page)
+
+    def close(self):
+        """写出最后一页和汇总页，结束文档"""
+        for page in self._layout.close():
+            self._write_page(page)
+        summary = PageBuilder()
+        summary.text(30, PAGE_HEIGHT - 30, "Uber expense report - Summary", "Helvetica-Bold", 16)
+        summary.text(30, PAGE_HEIGHT - 60, "Amount summary:", "Helvetica-Bold", 14)
+        y = PAGE_HEIGHT - 80
+        logger.debug("type summary: %s", self.type_summary)
+        for receipt_type, amount in self.type_summary.items():
+            summary.text(30, y, f"{receipt_type} Total: ${amount:.2f}")
+            y -= 20
+        summary.text(30, y - 20, f"Total: ${self.total_amount:.2f}")
+
+        if self.duplicate_count:
+            y -= 60
+            summary.text(30, y, f"Duplicates (not counted): {self.duplicate_count}", "Helvetica-Bold", 14)
+            for path, duplicate_of in self.duplicates:
+                y -= 15
+                if y < 30:
+                    break
+                summary.text(30, y, f"{os.path.basename(path)} duplicates {os.path.basename(duplicate_of)}",
+                             size=10)
+
+        self._pdf.add_page(summary, first=True)
+        self._pdf.close()
+
+
+def stream_report(processor, image_paths, out, chunk_size=STREAM_CHUNK_SIZE):
+    """边提取边写报告；提取结果按输入顺序写入，返回总金额
+
+    结果写入报告后即丢弃，不加入处理器的 receipts 和 ledger；
+    只保留去重的代表收据，用来识别之后批次中的重复。
+    """
+    writer = StreamingReportWriter(out, processor.images_per_page, processor.images_per_row)
+    representatives = {}
+    for start in range(0, len(image_paths), chunk_size):
+        # 提取是乱序完成的，先缓存提前完成的结果，保证报告顺序与输入一致
+        pending = {}
+        next_index = [0]
+
+        def on_result(index, receipt_info):
+            pending[index] = receipt_info
+            while next_index[0] in pending:
+                writer.add(pending.pop(next_index[0]))
+                next_index[0] += 1
+
+        results = processor.extract_receipts(image_paths[start:start + chunk_size], on_result=on_result,
+                                             previous=representatives)
+        if processor.dedup_index is not None:
+            representatives.update((r['path'], r) for r in results if 'duplicate_of' not in r)
+    writer.close()
+    return writer.total_amount
@@ -0,0 +1,485 @@
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from PIL import Image, ImageChops
+from receipt_cache import file_sha256
+from receipt_metrics import IMAGE_CACHE_BYTES, IMAGE_CACHE_LOOKUPS, IMAGE_DECODES
+
+logger = logging.getLogger(__name__)
+
+# 支持的收据文件类型
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+PDF_EXTENSIONS = ('.pdf',)
+RECEIPT_EXTENSIONS = IMAGE_EXTENSIONS + PDF_EXTENSIONS
+
+# PDF 页面栅格化的默认 DPI
+PDF_DPI = int(os.getenv("PDF_DPI", "200"))
+# 文本层至少有这么多字符才认为可以跳过OCR
+MIN_TEXT_CHARS = 20
+
+# PDF 中的一页用 "<文件路径>#page=<页码>" 表示（页码从1开始），
+# 这样它可以像普通图片路径一样在进程之间传递、写入缓存和报告
+PAGE_MARKER = "#page="
+
+# 内存中的收据用 "mem://<id>/<文件名>" 表示，和文件路径一样可以加页码、作为缓存键和报告中的引用；
+# 数据只在本进程内有效，交给其他进程（work_queue）的收据必须写到磁盘上
+MEMORY_SCHEME = "mem://"
+# 上传的文件不超过这个大小时保存在内存中，更大的写入临时文件；所有内存中的收据合计不超过 MEMORY_BUDGET
+MEMORY_SOURCE_MAX_BYTES = int(os.getenv("UPLOAD_MEMORY_MAX_BYTES", str(8 * 1024 * 1024)))
+MEMORY_BUDGET = int(os.getenv("UPLOAD_MEMORY_BUDGET", str(256 * 1024 * 1024)))
+SPOOL_CHUNK_BYTES = 1024 * 1024
+# 解码后的收据图片由去重、OCR、LLM 预处理和报告渲染共用，按像素字节数计算不超过这个大小，
+# 超出时淘汰最久未用的；设为 0 关闭
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+_memory = {}
+_memory_bytes = 0
+# 上传时已经算好的内容哈希，receipt_digest 不用重新读取文件
+_digests = {}
+_memory_lock = threading.Lock()
+
+
+class UnreadableReceiptError(ValueError):
+    """收据文件无法读取（例如损坏的 PDF）；path 为出错的文件"""
+
+    def __init__(self, message, path):
+        super().__init__(message)
+        self.path = path
+
+
+def is_receipt_file(filename):
+    return filename.lower().endswith(RECEIPT_EXTENSIONS)
+
+
+def is_pdf(path):
+    return path.lower().endswith(PDF_EXTENSIONS)
+
+
+def make_page_ref(pdf_path, page_number):
+    return f"{pdf_path}{PAGE_MARKER}{page_number}"
+
+
+def split_page_ref(ref):
+    """返回 (文件路径, 页码)；普通图片的页码为 None"""
+    path, marker, page = ref.rpartition(PAGE_MARKER)
+    if marker and is_pdf(path) and page.isdigit():
+        return path, int(page)
+    return ref, None
+
+
+def is_pdf_page(ref):
+    return split_page_ref(ref)[1] is not None
+
+
+def is_memory_ref(ref):
+    return ref.startswith(MEMORY_SCHEME)
+
+
+def _guess_name(data):
+    if data[:4] == b"%PDF":
+        return "receipt.pdf"
+    if data[:3] == b"\xff\xd8\xff":
+        return "receipt.jpg"
+    return "receipt.png"
+
+
+def put_memory(data, name=None, digest=None, ref=None):
+    """把收据内容放入内存，返回引用；用 discard_source() 释放"""
+    global _memory_bytes
+    data = bytes(data)
+    ref = ref or f"{MEMORY_SCHEME}{uuid.uuid4().hex}/{os.path.basename(name or _guess_name(data))}"
+    with _memory_lock:
+        _memory[ref] = data
+        _memory_bytes += len(data)
+        if digest is not None:
+            _digests[ref] = digest
+    return ref
+
+
+def memory_bytes():
+    """内存中的收据占用的字节数"""
+    return _memory_bytes
+
+
+def open_source(path):
+    """以二进制方式打开文件路径或内存引用（不带页码）"""
+    if is_memory_ref(path):
+        try:
+            # BytesIO 在写入之前与 bytes 共享内存，不复制数据
+            return io.BytesIO(_memory[path])
+        except KeyError:
+            raise FileNotFoundError(f"Receipt {path} is no longer in memory")
+    return open(path, "rb")
+
+
+def read_source(path):
+    if is_memory_ref(path):
+        with open_source(path) as f:
+            return f.getvalue()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def source_payload(ref):
+    """交给其他进程处理时需要附带的数据：内存中的收据返回内容，文件返回 None"""
+    path = split_page_ref(ref)[0]
+    return read_source(path) if is_memory_ref(path) else None
+
+
+@contextlib.contextmanager
+def attached_source(ref, data):
+    """在工作进程中临时登记主进程传来的内存收据，使同一个引用在这里也能打开"""
+    if data is None:
+        yield
+        return
+    path = put_memory(data, ref=split_page_ref(ref)[0])
+    try:
+        yield
+    finally:
+        discard_source(path)
+
+
+def as_receipt_ref(source, name=None, owned=None):
+    """处理器的输入可以是路径、bytes/bytearray/memoryview 或可读的文件对象；后两种放入内存
+
+    新放入内存的引用会追加到 owned 列表，由调用方在用完后释放。
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = source
+    elif hasattr(source, "read"):
+        data = source.read()
+        name = name or getattr(source, "name", None)
+    else:
+        raise TypeError(f"Expected a path, bytes or a binary file object, got {type(source).__name__}")
+    if not isinstance(name, str) or not is_receipt_file(name):
+        name = None
+    ref = put_memory(data, name)
+    if owned is not None:
+        owned.append(ref)
+    return ref
+
+
+def spool_upload(fileobj, name, directory=None, memory_limit=MEMORY_SOURCE_MAX_BYTES):
+    """读取一个上传的文件，只读一遍：小文件留在内存中，超过 memory_limit 或内存预算时边读边写入临时文件
+
+    返回 (引用, SHA-256)；用完后用 discard_source() 释放。
+    """
+    digest = hashlib.sha256()
+    chunks, size, out = [], 0, None
+    try:
+        for chunk in iter(lambda: fileobj.read(SPOOL_CHUNK_BYTES), b""):
+            digest.update(chunk)
+            if out is not None:
+                out.write(chunk)
+                continue
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > memory_limit or _memory_bytes + size > MEMORY_BUDGET:
+                out = NamedTemporaryFile(delete=False, suffix=os.path.splitext(name)[1].lower(), dir=directory)
+                out.writelines(chunks)
+                chunks = None
+    finally:
+        if out is not None:
+            out.close()
+    if out is None:
+        return put_memory(b"".join(chunks), name, digest.hexdigest()), digest.hexdigest()
+    with _memory_lock:
+        _digests[out.name] = digest.hexdigest()
+    return out.name, digest.hexdigest()
+
+
+def discard_source(path):
+    """释放内存中的收据，或删除临时文件"""
+    global _memory_bytes
+    get_image_cache().discard(path)
+    with _memory_lock:
+        _digests.pop(path, None)
+        if is_memory_ref(path):
+            data = _memory.pop(path, None)
+            if data is not None:
+                _memory_bytes -= len(data)
+            return
+    os.unlink(path)
+
+
+def _open_pdf(pdf_path):
+    import pypdfium2 as pdfium
+    if is_memory_ref(pdf_path):
+        return pdfium.PdfDocument(read_source(pdf_path))
+    return pdfium.PdfDocument(pdf_path)
+
+
+def pdf_page_count(pdf_path):
+    """只读取页数，不渲染页面"""
+    pdf = _open_pdf(pdf_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def expand_receipt_paths(paths):
+    """把 PDF 展开成逐页的引用，图片路径保持不变
+
+    PDF 无法打开时抛出 UnreadableReceiptError，由调用方告诉用户哪个文件出错，而不是悄悄少算收据。
+    """
+    refs = []
+    for path in paths:
+        if is_pdf(path):
+            try:
+                count = pdf_page_count(path)
+            except Exception as e:
+                logger.exception("Error reading PDF %s", path)
+                raise UnreadableReceiptError(f"Cannot read PDF {path}: {e}", path) from e
+            refs.extend(make_page_ref(path, n) for n in range(1, count + 1))
+        else:
+            refs.append(path)
+    return refs
+
+
+def page_text(ref):
+    """读取 PDF 页面的文本层；没有足够文本（扫描件）时返回 None"""
+    pdf_path, page_number = split_page_ref(ref)
+    if page_number is None:
+        return None
+    pdf = _open_pdf(pdf_path)
+    try:
+        page = pdf[page_number - 1]
+        textpage = page.get_textpage()
+        text = textpage.get_text_range()
+        textpage.close()
+        page.close()
+    finally:
+        pdf.close()
+    return text if len(text.strip()) >= MIN_TEXT_CHARS else None
+
+
+def render_page(ref, dpi=PDF_DPI):
+    """按需栅格化单个 PDF 页面，每次只在内存中保留这一页"""
+    pdf_path, page_number = split_page_ref(ref)
+    pdf = _open_pdf(pdf_path)
+    try:
+        page = pdf[page_number - 1]
+        bitmap = page.render(scale=dpi / 72)
+        # to_pil() 与 bitmap 共享内存，复制一份后再释放 bitmap
+        img = bitmap.to_pil().copy()
+        bitmap.close()
+        page.close()
+    finally:
+        pdf.close()
+    return img
+
+
+def open_receipt_image(ref, dpi=PDF_DPI):
+    """打开收据图片；PDF 页面会在此时栅格化"""
+    if is_pdf_page(ref):
+        return render_page(ref, dpi)
+    if is_memory_ref(ref):
+        return Image.open(open_source(ref))
+    return Image.open(ref)
+
+
+def receipt_size(ref):
+    """收据的宽高，只读取图片文件头或 PDF 页面尺寸，不解码像素；用于报告排版"""
+    if is_pdf_page(ref):
+        pdf_path, page_number = split_page_ref(ref)
+        pdf = _open_pdf(pdf_path)
+        try:
+            page = pdf[page_number - 1]
+            width, height = page.get_size()
+            page.close()
+        finally:
+            pdf.close()
+        return width, height
+    with open_receipt_image(ref) as img:
+        return img.size
+
+
+def _decode(ref, dpi, size):
+    """解码一张收据，返回 (图片, 是否为原始尺寸)；size 指定时 JPEG 用 draft 模式按不小于 size 的尺寸解码"""
+    img = open_receipt_image(ref, dpi)
+    if is_pdf_page(ref):
+        IMAGE_DECODES.inc(kind="pdf")
+        return img, True
+    original = img.size
+    if size is not None and img.format == "JPEG":
+        # 按 1/2、1/4 或 1/8 缩小解码，宽高都不小于 size
+        img.draft(None, size)
+    img.load()
+    full = img.size == original
+    IMAGE_DECODES.inc(kind="full" if full else "draft")
+    return img, full
+
+
+def _covers(img, full, size):
+    return full or (size is not None and img.width >= size[0] and img.height >= size[1])
+
+
+def _draft_cheaper(img, size):
+    """JPEG 能按 1/2 或更小解码时，重新解码比从缓存中的大图重采样更快"""
+    return size is not None and img.format == "JPEG" and min(img.width // size[0], img.height // size[1]) >= 2
+
+
+def _image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class ImageCache:
+    """解码后收据图片的 LRU 缓存，键为收据引用（PDF 页面再加上 DPI）
+
+    get() 可以指定需要的最小尺寸：已缓存的原图或足够大的缩小图直接返回，否则重新解码，比原来的大时替换。
+    JPEG 用 draft 模式缩小解码很便宜，比需要的尺寸大一倍以上的缓存不使用，按需要的尺寸重新解码。
+    文件被修改（mtime 或大小变化）后缓存失效；discard_source() 释放收据时一并删除。
+    返回的图片由多个调用方共享，只能读取，不能 close() 或原地修改（draft、thumbnail、paste 等）。
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (文件版本, 图片, 是否为原始尺寸, 字节数)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(ref, dpi):
+        return (ref, dpi) if is_pdf_page(ref) else (ref, None)
+
+    @staticmethod
+    def _version(ref):
+        path = split_page_ref(ref)[0]
+        if is_memory_ref(path):
+            return None
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, ref, dpi=PDF_DPI, size=None):
+        """返回解码后的图片；size=(宽, 高) 时可以是宽高都不小于 size 的缩小图"""
+        key = self._key(ref, dpi)
+        version = self._version(ref)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry[0] == version and _covers(entry[1], entry[2], size)
+                    and not _draft_cheaper(entry[1], size)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                IMAGE_CACHE_LOOKUPS.inc(result="hit")
+                return entry[1]
+            self.misses += 1
+        IMAGE_CACHE_LOOKUPS.inc(result="miss")
+        img, full = _decode(ref, dpi, size)
+        self._put(key, (version, img, full, _image_bytes(img)))
+        return img
+
+    def peek(self, ref, dpi=PDF_DPI):
+        """已缓存的原始尺寸图片，没有时返回 None；不解码，也不计入命中"""
+        with self._lock:
+            entry = self._entries.get(self._key(ref, dpi))
+        if entry is None or not entry[2] or entry[0] != self._version(ref):
+            return None
+        return entry[1]
+
+    def _put(self, key, entry):
+        nbytes = entry[3]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[3]
+                # 另一个线程同时放入了更大的图片时保留它
+                if old[0] == entry[0] and _covers(old[1], old[2], entry[1].size):
+                    entry, nbytes = old, old[3]
+            if nbytes > self.max_bytes:
+                return
+            while self._entries and self.bytes + nbytes > self.max_bytes:
+                self.bytes -= self._entries.popitem(last=False)[1][3]
+                self.evictions += 1
+            self._entries[key] = entry
+            self.bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def discard(self, path):
+        """删除一个文件或内存收据（包括它的所有 PDF 页面）的缓存"""
+        with self._lock:
+            for key in [k for k in self._entries if split_page_ref(k[0])[0] == path]:
+                self.bytes -= self._entries.pop(key)[3]
+
+    def resize(self, max_bytes):
+        """修改容量，超出的部分立即淘汰"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._entries and self.bytes > max_bytes:
+                self.bytes -= self._entries.popitem(last=False)[1][3]
+                self.evictions += 1
+
+    def clear(self):
+        """清空缓存并重置统计"""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = self.peak_bytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """命中、未命中、淘汰次数和占用的字节数"""
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes, "peak_bytes": self.peak_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    """进程内共享的解码图片缓存"""
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache()
+            IMAGE_CACHE_BYTES.set_function(lambda: _image_cache.bytes)
+        return _image_cache
+
+
+def load_receipt_image(ref, dpi=PDF_DPI, size=None):
+    """取得解码后的收据图片，优先使用共享缓存；size 见 ImageCache.get
+
+    返回的图片可能被其他调用方共用，只能读取，不要 close() 或原地修改。
+    """
+    cache = get_image_cache()
+    if cache.max_bytes <= 0:
+        return _decode(ref, dpi, size)[0]
+    return cache.get(ref, dpi, size)
+
+
+def autocrop(img, threshold=24, padding=10):
+    """按四角估计背景色，裁掉收据周围的空白区域"""
+    w, h = img.size
+    corners = [img.getpixel((0, 0)), img.getpixel((w - 1, 0)),
+               img.getpixel((0, h - 1)), img.getpixel((w - 1, h - 1))]
+    background = sorted(corners)[len(corners) // 2]
+    diff = ImageChops.difference(img, Image.new("L", img.size, background))
+    bbox = diff.point(lambda p: 255 if p > threshold else 0).getbbox()
+    if not bbox:
+        return img
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - padding), max(0, top - padding),
+            min(w, right + padding), min(h, bottom + padding))
+    return img.crop(bbox)
+
+
+def receipt_digest(ref):
+    """缓存用的内容哈希；PDF 页面在文件哈希后附加页码"""
+    path, page_number = split_page_ref(ref)
+    digest = _digests.get(path)
+    if digest is None:
+        digest = hashlib.sha256(read_source(path)).hexdigest() if is_memory_ref(path) else file_sha256(path)
+    return digest if page_number is None else f"{digest}p{page_number}"
@@ -0,0 +1,127 @@
+"""worker 进程：从共享的 work_queue 领取收据提取和报告生成任务
+
+    WORK_QUEUE_PATH=/shared/receipts/queue.sqlite3 WORK_DIR=/shared/receipts/files python receipt_worker.py
+
+app 设置相同的 WORK_QUEUE_PATH 和 WORK_DIR 后，/upload 和 /jobs 只负责保存文件、去重和汇总，
+提取和渲染由任意数量的 worker 进程完成；其他机器上的 worker 只要能访问这两个路径即可。
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+from engines import make_processor
+from work_queue import HEARTBEAT_SECONDS, POLL_INTERVAL, WORK_QUEUE_PATH, WorkQueue
+
+logger = logging.getLogger(__name__)
+
+# 每个 worker 进程同时执行的任务数；LLM 引擎主要在等待网络，可以调大
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+
+
+class Worker:
+    """领取任务、执行、写回结果；持有的任务由单独的线程定期续约"""
+
+    def __init__(self, queue, threads=WORKER_THREADS, name=None):
+        self.queue = queue
+        self.threads = threads
+        # 租约按名称归属，同一队列上的每个 worker 进程必须不同
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.processors = {}
+        self.completed = 0
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _processor(self, engine):
+        """每个引擎一个处理器，所有线程共用；去重已经在前端做过"""
+        with self._lock:
+            if engine not in self.processors:
+                self.processors[engine] = make_processor(engine, output_path=os.devnull, dedup_threshold=-1)
+            return self.processors[engine]
+
+    def extract(self, payload):
+        return self._processor(payload.get("engine")).extract_info_from_image(payload["path"])
+
+    def render(self, payload):
+        """用引擎自己的处理器生成报告，版式（每行图片数等）与单进程模式一致"""
+        processor = make_processor(payload.get("engine"), output_path=payload["output_path"],
+                                   images_per_page=payload["images_per_page"], dedup_threshold=-1)
+        processor.receipts = payload["receipts"]
+        processor.ledger.extend(processor.receipts)
+        processor.total_amount = payload["total_amount"]
+        processor.create_pdf()
+        return {"output_path": payload["output_path"]}
+
+    def run_task(self, task):
+        with self._lock:
+            self._held.add(task.id)
+        try:
+            handler = {"extract": self.extract, "render": self.render}.get(task.kind)
+            if handler is None:
+                raise ValueError(f"Unknown task kind {task.kind!r}")
+            result = handler(task.payload)
+        except Exception as e:
+            logger.exception("Task %s (%s) failed on attempt %d", task.id, task.kind, task.attempts)
+            self.queue.fail(task.id, self.name, f"{type(e).__name__}: {e}")
+        else:
+            if not self.queue.complete(task.id, self.name, result):
+                logger.warning("Lease on task %s was lost, result discarded", task.id)
+            with self._lock:
+                self.completed += 1
+        finally:
+            with self._lock:
+                self._held.discard(task.id)
+
+    def _work(self):
+        while not self._stop.is_set():
+            task = self.queue.lease(self.name)
+            if task is None:
+                self._stop.wait(POLL_INTERVAL)
+                continue
+            self.run_task(task)
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            with self._lock:
+                held = set(self._held)
+            lost = held - self.queue.heartbeat(held, self.name)
+            if lost:
+                logger.warning("Lost leases on tasks %s", sorted(lost))
+
+    def run(self):
+        """阻塞运行直到 stop()；正在执行的任务会先完成"""
+        logger.info("Worker %s serving %s with %d threads", self.name, self.queue.path, self.threads)
+        # 续约线程是守护线程：进程被杀时不再续约，租约过期后任务由其他 worker 接手
+        threading.Thread(target=self._heartbeat, name="worker-heartbeat", daemon=True).start()
+        threads = [threading.Thread(target=self._work, name=f"worker-{i}") for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve receipt extraction and report tasks from a shared queue")
+    parser.add_argument("--queue", default=WORK_QUEUE_PATH, help="SQLite queue file (WORK_QUEUE_PATH)")
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS)
+    parser.add_argument("--name", default=None, help="unique worker name, defaults to host:pid")
+    args = parser.parse_args(argv)
+    if not args.queue:
+        parser.error("--queue or WORK_QUEUE_PATH is required")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    worker = Worker(WorkQueue(args.queue), args.threads, args.name)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
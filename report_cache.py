@@ -0,0 +1,144 @@
+"""生成的PDF报告按内容寻址缓存在磁盘上：同样顺序的同样文件、同样的版式和引擎直接返回之前的报告
+
+键由每个上传文件内容的 SHA-256（按上传顺序）、每页图片数、页面版式、引擎及其提取设置、去重阈值和渲染方式得到，
+同时用作 HTTP ETag；这些设置改变后旧的报告不再命中。
+每个报告旁边保存一份提取结果和总金额，命中时任务状态里的收据明细也不需要重新提取。
+目录总大小超过 REPORT_CACHE_MAX_BYTES 时删除最久未使用的报告。
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from receipt_cache import dump_result, load_result
+from receipt_dedup import DEDUP_PIXEL_THRESHOLD, DEDUP_THRESHOLD
+from receipt_metrics import REPORT_CACHE_LOOKUPS
+from receipt_report import FAST_RENDER, RENDER_DPI
+from report_layout import LAYOUT_MIN_WIDTH, REPORT_LAYOUT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT_CACHE_DIR = os.getenv(
+    "REPORT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "receipt_org", "reports")
+)
+DEFAULT_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# 报告版式变化时需要递增 REPORT_VERSION，使旧的缓存失效
+REPORT_VERSION = "3"
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+class ReportCache:
+    """<key>.pdf 为报告，<key>.json 为提取结果；文件的修改时间作为最近使用时间"""
+
+    def __init__(self, directory=DEFAULT_REPORT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(digests, images_per_page, engine, extraction_version=None):
+        """缓存键：按顺序的文件内容哈希 + 版式和渲染参数 + 引擎及其提取设置 + 去重阈值
+
+        extraction_version 是引擎的提取缓存版本（engines.extraction_version），决定提取结果；
+        去重阈值决定哪些收据不计入总金额。
+        """
+        params = [REPORT_VERSION, FAST_RENDER, RENDER_DPI, REPORT_LAYOUT, LAYOUT_MIN_WIDTH, engine,
+                  extraction_version, DEDUP_THRESHOLD, DEDUP_PIXEL_THRESHOLD, images_per_page, list(digests)]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".pdf", base + ".json"
+
+    def get(self, key):
+        """命中时返回 (PDF 路径, {"receipts": [...], "total_amount": ...})，否则返回 None"""
+        pdf_path, meta_path = self._paths(key)
+        try:
+            # 写入时先放PDF再放结果，结果存在则PDF一定存在
+            with open(meta_path) as f:
+                summary = load_result(f.read())
+            os.utime(pdf_path)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            self.misses += 1
+            REPORT_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        self.hits += 1
+        REPORT_CACHE_LOOKUPS.inc(result="hit")
+        return pdf_path, summary
+
+    def put(self, key, pdf_path, receipts, total_amount):
+        """把生成的PDF移入缓存（同一文件系统上只是重命名），返回缓存中的路径"""
+        target, meta_path = self._paths(key)
+        suffix = f".{uuid.uuid4().hex}.tmp"
+        shutil.move(pdf_path, target + suffix)
+        os.replace(target + suffix, target)
+        with open(meta_path + suffix, "w") as f:
+            f.write(dump_result({"receipts": receipts, "total_amount": total_amount}))
+        os.replace(meta_path + suffix, meta_path)
+        self._evict(keep=key)
+        return target
+
+    def _entries(self):
+        """[(最近使用时间, 键, 字节数)]；多个进程可能共用目录，所以每次重新扫描"""
+        entries = {}
+        for entry in os.scandir(self.directory):
+            key, ext = os.path.splitext(entry.name)
+            if ext not in (".pdf", ".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            used, size = entries.get(key, (0, 0))
+            entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+        return sorted((used, key, size) for key, (used, size) in entries.items())
+
+    def _evict(self, keep=None):
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, _, size in entries)
+            for _, key, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                pdf_path, meta_path = self._paths(key)
+                # 先删结果，读取方不会看到缺少PDF的条目
+                for path in (meta_path, pdf_path):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                logger.debug("Evicted report %s", key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(entries),
+            "bytes": sum(size for _, _, size in entries),
+        }
+
+
+def get_default_report_cache():
+    """进程内共享的报告缓存；设置 REPORT_CACHE_DISABLED=1 可关闭"""
+    global _default_cache
+    if os.getenv("REPORT_CACHE_DISABLED") == "1":
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ReportCache()
+        return _default_cache
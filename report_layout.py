@@ -0,0 +1,190 @@
+"""报告收据页的版式：按顺序把收据图片排到页面上，给出每张图片和说明文字的位置
+
+row：原来的版式，每页一行 images_per_page 张
+grid：每页 rows × images_per_row 的网格，行数由 images_per_page 决定
+shelf：每张图片同样的宽度（不小于 LAYOUT_MIN_WIDTH，保证和原来一样清晰），逐行排列；
+       页面高度放得下时短的收据叠放在同一列中，短的 Uber Eats 收据不再各占一整格，页数更少；
+       每页同样最多 images_per_page 张
+"""
+import math
+import os
+
+LAYOUTS = ("row", "grid", "shelf")
+REPORT_LAYOUT = os.getenv("REPORT_LAYOUT", "row")
+# shelf 版式中图片的最小宽度（点）；默认与原来每行 4 张时的宽度相当
+LAYOUT_MIN_WIDTH = float(os.getenv("REPORT_MIN_IMAGE_WIDTH", "170"))
+
+# 页边距、列间距和行间距（点）；图片区域从标题下方开始
+MARGIN = 30
+COLUMN_GAP = 30
+ROW_GAP = 15
+TOP_OFFSET = 60
+BOTTOM_MARGIN = 15
+# 图片下方的说明文字：类型、时间、金额和重复标记，每行 15 点
+CAPTION_LEADING = 15
+CAPTION_HEIGHT = 4 * CAPTION_LEADING + 5
+
+
+def fit_image(aspect, box_width, box_height):
+    """按宽高比缩放到不超过 box 的尺寸"""
+    if aspect > box_width / box_height:
+        return box_width, box_width / aspect
+    return box_height * aspect, box_height
+
+
+class Placement:
+    """一张收据在页面上的位置：图片左下角 (x, y) 和绘制尺寸，说明文字第一行的起点"""
+
+    def __init__(self, item, x, y, width, height, caption_x, caption_y):
+        self.item = item
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.caption_x = caption_x
+        self.caption_y = caption_y
+
+
+class _Layout:
+    """add() 每放入一张收据返回已经排满的页面，close() 返回剩下的页面；每页是 [Placement]"""
+
+    def __init__(self, page_size):
+        self.page_width, self.page_height = page_size
+        self.top = self.page_height - TOP_OFFSET
+        self.usable_width = self.page_width - 2 * MARGIN
+        self.usable_height = self.top - BOTTOM_MARGIN
+
+    def _columns_width(self, columns):
+        return (self.usable_width - (columns - 1) * COLUMN_GAP) / columns
+
+    def _place(self, item, aspect, x, top, cell_width, box_height):
+        """在宽 cell_width 的列中从 top 开始放一张图片，水平居中，说明文字与列左边对齐"""
+        width, height = fit_image(aspect, cell_width, box_height)
+        y = top - height
+        return Placement(item, x + (cell_width - width) / 2, y, width, height, x, y - CAPTION_LEADING)
+
+    def paginate(self, items):
+        """items 为 [(收据, 宽高比)]，逐页产出"""
+        for item, aspect in items:
+            yield from self.add(item, aspect)
+        yield from self.close()
+
+
+class GridLayout(_Layout):
+    """固定网格：每页最多 images_per_page 张，按行填充；图片在格子中等比缩放"""
+
+    def __init__(self, page_size, images_per_page=4, columns=None, rows=None):
+        super().__init__(page_size)
+        self.images_per_page = max(1, images_per_page)
+        self.columns = max(1, min(columns or self.images_per_page, self.images_per_page))
+        self.rows = rows or math.ceil(self.images_per_page / self.columns)
+        self.cell_width = self._columns_width(self.columns)
+        self.cell_height = (self.usable_height - (self.rows - 1) * ROW_GAP) / self.rows
+        self._page = []
+
+    @property
+    def box(self):
+        """每个格子中图片的最大尺寸"""
+        return self.cell_width, self.cell_height - CAPTION_HEIGHT
+
+    def add(self, item, aspect):
+        slot = len(self._page)
+        row, col = divmod(slot, self.columns)
+        x = MARGIN + col * (self.cell_width + COLUMN_GAP)
+        top = self.top - row * (self.cell_height + ROW_GAP)
+        self._page.append(self._place(item, aspect, x, top, *self.box))
+        if len(self._page) < min(self.images_per_page, self.rows * self.columns):
+            return []
+        page, self._page = self._page, []
+        return [page]
+
+    def close(self):
+        page, self._page = self._page, []
+        return [page] if page else []
+
+
+class ShelfLayout(_Layout):
+    """等宽的列，逐行（shelf）排列；一行的高度由其中最高的一列决定
+
+    新的收据先尝试叠放在最后一列已有收据的下方（可以加高这一行，只要页面放得下），
+    放不下时开始新的一列，一行的列用完后开始新的一行，页面剩余高度不够或已有 images_per_page 张时换页。
+    顺序是行内按列、列内从上到下。
+    """
+
+    def __init__(self, page_size, min_width=LAYOUT_MIN_WIDTH, columns=None, images_per_page=None):
+        super().__init__(page_size)
+        self.images_per_page = images_per_page
+        self.columns = columns or max(1, int((self.usable_width + COLUMN_GAP) // (min_width + COLUMN_GAP)))
+        self.cell_width = self._columns_width(self.columns)
+        self._new_page()
+
+    @property
+    def box(self):
+        """图片的最大尺寸：一列宽、一页高"""
+        return self.cell_width, self.usable_height - CAPTION_HEIGHT
+
+    def _new_page(self):
+        self._page = []
+        self._shelf_top = self.top
+        self._shelf_height = 0
+        # 当前行中每列已用的高度
+        self._used = []
+
+    def _height(self, aspect):
+        return fit_image(aspect, *self.box)[1] + CAPTION_HEIGHT
+
+    def add(self, item, aspect):
+        height = self._height(aspect)
+        finished = []
+        if self.images_per_page and len(self._page) >= self.images_per_page:
+            finished.append(self._page)
+            self._new_page()
+        slot = self._slot(height)
+        if slot is None:
+            # 新的一行
+            self._shelf_top -= self._shelf_height + (ROW_GAP if self._shelf_height else 0)
+            self._shelf_height = 0
+            self._used = []
+            if self._page and self._shelf_top - height < BOTTOM_MARGIN:
+                finished.append(self._page)
+                self._new_page()
+            slot = 0
+        if slot == len(self._used):
+            self._used.append(0)
+        offset = self._used[slot] + (ROW_GAP if self._used[slot] else 0)
+        x = MARGIN + slot * (self.cell_width + COLUMN_GAP)
+        self._page.append(self._place(item, aspect, x, self._shelf_top - offset, *self.box))
+        self._used[slot] = offset + height
+        self._shelf_height = max(self._shelf_height, self._used[slot])
+        return finished
+
+    def _slot(self, height):
+        """当前行中能放下这张收据的列：叠放在最后一列下方、新开一列，或者 None（需要换行）"""
+        if not self._used:
+            return None if self._page else 0
+        room = self._shelf_top - BOTTOM_MARGIN
+        last = len(self._used) - 1
+        if self._used[last] + ROW_GAP + height <= room:
+            return last
+        if len(self._used) < self.columns and height <= room:
+            return len(self._used)
+        return None
+
+    def close(self):
+        page = self._page
+        self._new_page()
+        return [page] if page else []
+
+
+def make_layout(page_size, images_per_page=4, images_per_row=None, mode=None):
+    """按 mode（默认 REPORT_LAYOUT）创建版式；shelf 的 images_per_row 指定时作为列数"""
+    mode = mode or REPORT_LAYOUT
+    if mode == "row":
+        return GridLayout(page_size, images_per_page, columns=images_per_page, rows=1)
+    if mode == "grid":
+        # 没有指定每行张数时每行最多 4 张，行数尽量少、各行张数尽量平均
+        columns = images_per_row or math.ceil(images_per_page / math.ceil(images_per_page / 4))
+        return GridLayout(page_size, images_per_page, columns=columns)
+    if mode == "shelf":
+        return ShelfLayout(page_size, columns=images_per_row, images_per_page=images_per_page)
+    raise ValueError(f"Unknown report layout {mode!r}, expected one of {', '.join(LAYOUTS)}")
@@ -3,6 +3,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const fileInput = document.getElementById('fileInput');
     const previewArea = document.getElementById('previewArea');
     const submitBtn = document.getElementById('submitBtn');
+    const results = document.getElementById('results');
+    const resultsTotals = document.getElementById('resultsTotals');
+    const resultsBody = document.getElementById('resultsBody');
 
     // 点击上传区域触发文件选择
     dropZone.addEventListener('click', () => fileInput.click());
@@ -26,76 +29,218 @@ document.addEventListener('DOMContentLoaded', function() {
         handleFiles({ target: { files: e.dataTransfer.files } });
     });
 
+    // 上传前在浏览器中缩小图片：长边超过 MAX_EDGE 的 JPEG/PNG 重新编码为 JPEG
+    const MAX_EDGE = 2048;
+    const JPEG_QUALITY = 0.9;
+    // 同时上传的文件数，以及单个块失败后的重试次数
+    const PARALLEL_FILES = 3;
+    const CHUNK_RETRIES = 5;
+    const downscaleInput = document.getElementById('downscale');
+    // 预览容器 -> 原始 File，提交时直接上传二进制内容
+    const selectedFiles = new Map();
+
     function handleFiles(e) {
         const files = Array.from(e.target.files);
-        
+
         files.forEach(file => {
             if (file.type.startsWith('image/') || file.type === 'application/pdf') {
-                const reader = new FileReader();
                 const previewContainer = document.createElement('div');
                 previewContainer.className = 'preview-container';
+                let previewUrl = null;
 
-                reader.onload = function(e) {
-                    if (file.type.startsWith('image/')) {
-                        const img = document.createElement('img');
-                        img.src = e.target.result;
-                        img.className = 'preview-image';
-                        previewContainer.appendChild(img);
-                    } else {
-                        // PDF 预览
-                        const pdfIcon = document.createElement('div');
-                        pdfIcon.textContent = 'PDF';
-                        pdfIcon.style.textAlign = 'center'; 
-                        pdfIcon.style.lineHeight = '200px';
-                        previewContainer.appendChild(pdfIcon);
-                    }
+                if (file.type.startsWith('image/')) {
+                    // object URL 直接引用文件，不需要把整个文件读成 base64
+                    previewUrl = URL.createObjectURL(file);
+                    const img = document.createElement('img');
+                    img.src = previewUrl;
+                    img.className = 'preview-image';
+                    previewContainer.appendChild(img);
+                } else {
+                    // PDF 预览
+                    const pdfIcon = document.createElement('div');
+                    pdfIcon.textContent = 'PDF';
+                    pdfIcon.style.textAlign = 'center';
+                    pdfIcon.style.lineHeight = '200px';
+                    previewContainer.appendChild(pdfIcon);
+                }
 
-                    // 添加删除按钮
-                    const deleteBtn = document.createElement('button');
-                    deleteBtn.className = 'delete-btn';
-                    deleteBtn.innerHTML = 'x';
-                    deleteBtn.onclick = function() {
-                        previewContainer.remove();
-                        updateSubmitButton();
-                    };
-                    previewContainer.appendChild(deleteBtn);
+                // 添加删除按钮
+                const deleteBtn = document.createElement('button');
+                deleteBtn.className = 'delete-btn';
+                deleteBtn.innerHTML = 'x';
+                deleteBtn.onclick = function(event) {
+                    event.stopPropagation();
+                    if (previewUrl) {
+                        URL.revokeObjectURL(previewUrl);
+                    }
+                    selectedFiles.delete(previewContainer);
+                    previewContainer.remove();
+                    updateSubmitButton();
                 };
+                previewContainer.appendChild(deleteBtn);
 
-                reader.readAsDataURL(file);
+                selectedFiles.set(previewContainer, file);
                 previewArea.appendChild(previewContainer);
                 updateSubmitButton();
             }
         });
     }
 
-    // 在 updateSubmitButton 函数前添加以下代码
-    submitBtn.addEventListener('click', async function() {
-        const formData = new FormData();
-        formData.append('images_per_page', '4');
+    async function downscaleImage(file) {
+        const original = { blob: file, name: file.name };
+        if (!['image/jpeg', 'image/png'].includes(file.type) || !window.createImageBitmap) {
+            return original;
+        }
+        let bitmap;
+        try {
+            bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+        } catch (error) {
+            return original;
+        }
+        const scale = MAX_EDGE / Math.max(bitmap.width, bitmap.height);
+        if (scale >= 1) {
+            bitmap.close();
+            return original;
+        }
+        const canvas = document.createElement('canvas');
+        canvas.width = Math.round(bitmap.width * scale);
+        canvas.height = Math.round(bitmap.height * scale);
+        const context = canvas.getContext('2d');
+        // 透明的 PNG 转 JPEG 时使用白色背景
+        context.fillStyle = '#fff';
+        context.fillRect(0, 0, canvas.width, canvas.height);
+        context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+        bitmap.close();
+        const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', JPEG_QUALITY));
+        if (!blob || blob.size >= file.size) {
+            return original;
+        }
+        return { blob: blob, name: file.name.replace(/\.[^.]*$/, '') + '.jpg' };
+    }
 
-        // Get files from preview containers instead of fileInput
-        const previewContainers = previewArea.querySelectorAll('.preview-container');
-        const files = Array.from(previewContainers).map(container => {
-            const img = container.querySelector('img');
-            if (img) {
-                // Convert base64 back to file
-                return dataURLtoFile(img.src, 'image.jpg');
-            }
+    // 订阅服务端的提取进度：每张收据提取完成就显示一行，并更新累计金额
+    function watchResults(upload) {
+        resultsBody.innerHTML = '';
+        resultsTotals.textContent = '等待第一张收据...';
+        results.hidden = false;
+        if (!window.EventSource) {
             return null;
-        }).filter(file => file !== null);
-
-        files.forEach(file => {
-            formData.append('files', file);
+        }
+        const source = new EventSource(upload.events_url);
+        source.addEventListener('receipt', (e) => {
+            const receipt = JSON.parse(e.data);
+            const row = document.createElement('tr');
+            let values;
+            if (receipt.status === 'failed') {
+                // 无法读取的文件（例如损坏的 PDF）没有金额，显示错误信息
+                row.className = 'failed';
+                values = [receipt.file, '无法读取', '', receipt.error];
+            } else {
+                if (receipt.duplicate) {
+                    row.className = 'duplicate';
+                }
+                const amount = `$${receipt.amount.toFixed(2)}` + (receipt.duplicate ? '（重复，不计入）' : '');
+                values = [receipt.file, receipt.type, receipt.date, amount];
+            }
+            values.forEach(value => {
+                const cell = document.createElement('td');
+                cell.textContent = value;
+                row.appendChild(cell);
+            });
+            resultsBody.appendChild(row);
         });
+        source.addEventListener('totals', (e) => {
+            const totals = JSON.parse(e.data);
+            const byType = Object.entries(totals.by_type)
+                .map(([type, amount]) => `${type} $${amount.toFixed(2)}`)
+                .join('，');
+            resultsTotals.textContent = `已提取 ${totals.extracted}/${totals.total} 张，合计 $${totals.total_amount.toFixed(2)}`
+                + (byType ? `（${byType}）` : '');
+        });
+        // 结束后服务端关闭连接，不让浏览器自动重连
+        source.addEventListener('done', () => source.close());
+        return source;
+    }
+
+    // 分块上传一个文件；网络错误和 5xx 会退避重试，409 时从服务端已收到的位置续传
+    async function uploadFile(upload, index, name, blob) {
+        const url = `${upload.status_url}/files/${index}?name=${encodeURIComponent(name)}`;
+        let offset = 0;
+        let failures = 0;
+        while (offset < blob.size) {
+            const end = Math.min(offset + upload.chunk_size, blob.size);
+            try {
+                const response = await fetch(url, {
+                    method: 'PUT',
+                    headers: {
+                        'Content-Range': `bytes ${offset}-${end - 1}/${blob.size}`,
+                        'Content-Type': 'application/octet-stream'
+                    },
+                    body: blob.slice(offset, end)
+                });
+                const serverOffset = response.headers.get('Upload-Offset');
+                if (response.status === 409 && serverOffset !== null) {
+                    offset = parseInt(serverOffset, 10);
+                    continue;
+                }
+                if (!response.ok) {
+                    const error = new Error(`HTTP error! status: ${response.status}`);
+                    error.fatal = response.status < 500;
+                    throw error;
+                }
+                offset = (await response.json()).received;
+                failures = 0;
+            } catch (error) {
+                if (error.fatal || ++failures > CHUNK_RETRIES) {
+                    throw error;
+                }
+                await new Promise(resolve => setTimeout(resolve, 500 * 2 ** failures));
+            }
+        }
+    }
+
+    submitBtn.addEventListener('click', async function() {
+        const previewContainers = previewArea.querySelectorAll('.preview-container');
+        const files = Array.from(previewContainers)
+            .map(container => selectedFiles.get(container))
+            .filter(file => file !== undefined);
 
+        let upload = null;
+        let events = null;
         try {
             submitBtn.disabled = true;
-            submitBtn.textContent = '处理中...';
+            submitBtn.textContent = '上传中...';
 
-            const response = await fetch('/upload', {
+            const formData = new FormData();
+            formData.append('images_per_page', '4');
+            const created = await fetch('/uploads', {
                 method: 'POST',
                 body: formData
             });
+            if (!created.ok) {
+                throw new Error(`HTTP error! status: ${created.status}`);
+            }
+            upload = await created.json();
+            events = watchResults(upload);
+
+            // 文件按序号并行上传，服务端每收完一个文件就开始提取
+            let next = 0;
+            let uploaded = 0;
+            async function uploadNext() {
+                while (next < files.length) {
+                    const index = next++;
+                    const { blob, name } = downscaleInput.checked
+                        ? await downscaleImage(files[index])
+                        : { blob: files[index], name: files[index].name };
+                    await uploadFile(upload, index, name, blob);
+                    uploaded++;
+                    submitBtn.textContent = `上传中 ${uploaded}/${files.length}`;
+                }
+            }
+            await Promise.all(Array.from({ length: Math.min(PARALLEL_FILES, files.length) }, uploadNext));
+
+            submitBtn.textContent = '生成报告中...';
+            const response = await fetch(upload.finish_url, { method: 'POST' });
 
             if (!response) {
                 throw new Error('No response received from server');
@@ -165,12 +310,21 @@ document.addEventListener('DOMContentLoaded', function() {
             };
 
             // Clear preview area
+            previewArea.querySelectorAll('.preview-image').forEach(img => URL.revokeObjectURL(img.src));
+            selectedFiles.clear();
             previewArea.innerHTML = '';
             updateSubmitButton();
         } catch (error) {
             console.error('处理出错:', error);
+            if (upload) {
+                // 放弃这次上传，释放服务端的临时文件
+                fetch(upload.status_url, { method: 'DELETE' }).catch(() => {});
+            }
             alert('处理过程中出现错误，请重试！');
         } finally {
+            if (events) {
+                events.close();
+            }
             submitBtn.disabled = false;
             submitBtn.textContent = '处理文件';
         }
@@ -179,17 +333,4 @@ document.addEventListener('DOMContentLoaded', function() {
     function updateSubmitButton() {
         submitBtn.disabled = previewArea.children.length === 0;
     }
-
-    // Add this helper function to convert base64 to File object
-    function dataURLtoFile(dataurl, filename) {
-        let arr = dataurl.split(','),
-            mime = arr[0].match(/:(.*?);/)[1],
-            bstr = atob(arr[1]),
-            n = bstr.length,
-            u8arr = new Uint8Array(n);
-        while(n--){
-            u8arr[n] = bstr.charCodeAt(n);
-        }
-        return new File([u8arr], filename, {type:mime});
-    }
 });
\ No newline at end of file
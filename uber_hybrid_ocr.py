@@ -0,0 +1,250 @@
+"""混合引擎：先用本地 tesseract 识别，只有置信度低的收据才交给 LLM
+
+置信度由正则解析结果（日期和金额是否识别、金额是否合理）和 tesseract 的单词平均置信度加权得到，
+低于 HYBRID_CONFIDENCE_THRESHOLD 的收据升级到 LLM。summarize_escalations() 汇总升级率，
+用来在延迟、费用和准确率之间调整阈值。
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import uber_llm_ocr
+import uber_ocr_en
+from receipt_dedup import DEDUP_THRESHOLD
+from receipt_metrics import HYBRID_DECISIONS
+from receipt_sources import (as_receipt_ref, is_pdf_page, is_receipt_file, page_text, receipt_digest,
+                             source_payload)
+
+logger = logging.getLogger(__name__)
+
+ENGINE = "hybrid"
+# 日期、金额和合理性检查都通过时置信度至少为 0.75，剩下的 0.25 来自 tesseract 的单词置信度；
+# 默认阈值 0.9 相当于要求各项检查都通过且单词平均置信度不低于 60
+CONFIDENCE_THRESHOLD = float(os.getenv("HYBRID_CONFIDENCE_THRESHOLD", "0.9"))
+WEIGHTS = {"date": 0.3, "amount": 0.3, "plausible": 0.15, "ocr": 0.25}
+LOW_WORD_CONFIDENCE = 60
+# 超过这个金额的识别结果视为不合理
+MAX_AMOUNT = float(os.getenv("HYBRID_MAX_AMOUNT", "500"))
+MEAL_DATE_FORMAT = "%a %b %d %Y"
+
+
+def _date_ok(date):
+    if isinstance(date, datetime):
+        return True
+    try:
+        datetime.strptime(str(date).strip(), MEAL_DATE_FORMAT)
+        return True
+    except ValueError:
+        return False
+
+
+def score_receipt(receipt_info, text, word_confidence):
+    """给正则解析的结果打分，返回 (0~1 的置信度, 未通过的检查)"""
+    score = 0.0
+    reasons = []
+    if _date_ok(receipt_info['date']):
+        score += WEIGHTS["date"]
+    else:
+        reasons.append("no_date")
+    amount = receipt_info['amount']
+    if amount > 0:
+        score += WEIGHTS["amount"]
+    else:
+        reasons.append("no_amount")
+    # 总价应该是收据上最大的金额；正则取到明细或优惠金额时这里不通过
+    amounts = [float(a.replace('$', '')) for a in uber_ocr_en.AMOUNT_RE.findall(text.lower())]
+    if 0 < amount <= MAX_AMOUNT and amount >= max(amounts, default=0):
+        score += WEIGHTS["plausible"]
+    else:
+        reasons.append("implausible_amount")
+    word_confidence = min(max(word_confidence, 0.0), 100.0)
+    score += WEIGHTS["ocr"] * word_confidence / 100
+    if word_confidence < LOW_WORD_CONFIDENCE:
+        reasons.append("low_ocr_confidence")
+    return round(score, 3), reasons
+
+
+class UberReceiptProcessor(uber_ocr_en.UberReceiptProcessor):
+    """tesseract 优先、低置信度时回退到 LLM 的处理器，接口与其他引擎相同"""
+
+    def __init__(self, output_path, images_per_page=4, cache=None, max_workers=uber_ocr_en.OCR_MAX_WORKERS,
+                 dedup_threshold=DEDUP_THRESHOLD, threshold=CONFIDENCE_THRESHOLD, llm=None,
+                 ocr_mode=uber_ocr_en.OCR_MODE):
+        super().__init__(output_path, images_per_page, cache, max_workers, dedup_threshold, ocr_mode)
+        self.threshold = threshold
+        # 升级用的 LLM 处理器；去重已经在这里做过，不再重复
+        self.llm = llm or uber_llm_ocr.UberReceiptProcessor(output_path, images_per_page, cache=cache,
+                                                           dedup_threshold=-1)
+        # 每张经过本地OCR的收据的置信度和是否升级
+        self.decisions = []
+
+    @staticmethod
+    def extraction_version(ocr_mode=None, threshold=None):
+        """提取缓存键中的 (模型, 版本)：OCR 和 LLM 两部分的设置以及升级阈值"""
+        return (f"{uber_ocr_en.OCR_LANG}+{uber_llm_ocr.MODEL}",
+                f"{uber_ocr_en.PARSER_VERSION}-{ocr_mode or uber_ocr_en.OCR_MODE}.{uber_llm_ocr.PROMPT_VERSION}"
+                f"@{CONFIDENCE_THRESHOLD if threshold is None else threshold}")
+
+    def _cache_key(self, image_path):
+        if self.cache is None:
+            return None
+        return self.cache.make_key(receipt_digest(image_path), ENGINE,
+                                   *self.extraction_version(self.ocr_mode, self.threshold))
+
+    def _cached(self, cache_key, image_path):
+        if cache_key is None:
+            return None
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            cached['path'] = image_path
+        return cached
+
+    def _local(self, image_path, run):
+        """执行本地OCR并打分；可以直接采用时返回结果，需要升级时返回 None"""
+        try:
+            receipt_info, timings, details = run()
+        except Exception as e:
+            # 进程池损坏（例如没有安装 tesseract）时由 get_pool 在下次调用时替换，这里不关闭共用的进程池
+            logger.warning("Local OCR failed for %s, escalating: %s", image_path, e)
+            receipt_info, timings, details = None, {}, {}
+
+        if receipt_info is None:
+            confidence, reasons = 0.0, ["ocr_error"]
+        else:
+            self._observe(image_path, receipt_info, timings)
+            confidence, reasons = score_receipt(receipt_info, details.get("text", ""),
+                                                details.get("word_confidence", 0.0))
+        escalated = confidence < self.threshold
+        self.decisions.append({
+            'path': image_path,
+            'confidence': confidence,
+            'reasons': reasons,
+            'escalated': escalated,
+            'ocr_seconds': sum(timings.values()),
+        })
+        HYBRID_DECISIONS.inc(decision="escalated" if escalated else "accepted")
+        if escalated:
+            logger.info("Escalating %s to LLM (confidence %.2f: %s)", image_path, confidence, ", ".join(reasons))
+            return None
+        return receipt_info
+
+    def _accept(self, receipt_info, cache_key, engine):
+        receipt_info['engine'] = engine
+        # 提取失败的结果不写入缓存，下次重新提取
+        if cache_key is not None and receipt_info['type'] != 'Unknown':
+            self.cache.put(cache_key, receipt_info)
+        return receipt_info
+
+    def extract_info_from_image(self, image_path):
+        """先本地OCR，置信度不够时交给 LLM"""
+        image_path = as_receipt_ref(image_path, owned=self.owned_sources)
+        cache_key = self._cache_key(image_path)
+        cached = self._cached(cache_key, image_path)
+        if cached is not None:
+            return cached
+        receipt_info = self._local(image_path,
+                                   lambda: uber_ocr_en.ocr_with_details(image_path, self.ocr_mode))
+        if receipt_info is not None:
+            return self._accept(receipt_info, cache_key, uber_ocr_en.ENGINE)
+        self.llm.trace = self.trace
+        return self._accept(self.llm.extract_info_from_image(image_path), cache_key, uber_llm_ocr.ENGINE)
+
+    def _extract_many(self, image_paths, max_workers=None, on_result=None):
+        """进程池做本地OCR；需要升级的收据一凑够 LLM 的批大小就提交，和剩余的OCR并行"""
+        results = [None] * len(image_paths)
+        cache_keys = {}
+        pending = []
+        for i, image_path in enumerate(image_paths):
+            cache_keys[i] = self._cache_key(image_path)
+            cached = self._cached(cache_keys[i], image_path)
+            if cached is not None:
+                results[i] = cached
+                if on_result:
+                    on_result(i, cached)
+                continue
+            pending.append(i)
+        if not pending:
+            return results
+
+        workers = max_workers or self.max_workers
+        logger.info("Processing %d receipts with %d OCR workers", len(pending), workers)
+        self.llm.trace = self.trace
+        llm_futures = {}
+        with ThreadPoolExecutor(max_workers=self.llm.max_workers) as llm_executor:
+            def escalate(indexes, use_cache=True):
+                future = llm_executor.submit(self.llm._extract_indexed, image_paths, indexes, use_cache)
+                llm_futures[future] = indexes
+
+            pool = uber_ocr_en.get_pool(workers)
+            futures = {pool.submit(uber_ocr_en.ocr_with_details, image_paths[i], self.ocr_mode,
+                                   source_payload(image_paths[i])): i
+                       for i in pending}
+            batch = []
+            for future in as_completed(futures):
+                i = futures[future]
+                receipt_info = self._local(image_paths[i], future.result)
+                if receipt_info is not None:
+                    results[i] = self._accept(receipt_info, cache_keys[i], uber_ocr_en.ENGINE)
+                    if on_result:
+                        on_result(i, results[i])
+                    continue
+                # 带文本层的 PDF 页面只发送文本，不参与打包
+                if is_pdf_page(image_paths[i]) and page_text(image_paths[i]) is not None:
+                    escalate([i], False)
+                    continue
+                batch.append(i)
+                if len(batch) >= self.llm.batch_size:
+                    escalate(batch)
+                    batch = []
+            if batch:
+                escalate(batch)
+
+            for future in as_completed(llm_futures):
+                for i, receipt_info in zip(llm_futures[future], future.result()):
+                    results[i] = self._accept(receipt_info, cache_keys[i], uber_llm_ocr.ENGINE)
+                    if on_result:
+                        on_result(i, results[i])
+        return results
+
+    def summarize_escalations(self):
+        """汇总升级率、升级原因、本地OCR耗时和 LLM 请求统计"""
+        if not self.decisions:
+            return {}
+        n = len(self.decisions)
+        escalated = [d for d in self.decisions if d['escalated']]
+        reasons = {}
+        for decision in escalated:
+            for reason in decision['reasons']:
+                reasons[reason] = reasons.get(reason, 0) + 1
+        return {
+            'receipts': n,
+            'threshold': self.threshold,
+            'accepted': n - len(escalated),
+            'escalated': len(escalated),
+            'escalation_rate': len(escalated) / n,
+            'avg_confidence': sum(d['confidence'] for d in self.decisions) / n,
+            'reasons': reasons,
+            'avg_ocr_seconds': sum(d['ocr_seconds'] for d in self.decisions) / n,
+            'llm': self.llm.summarize_request_stats(),
+        }
+
+
+# 使用示例
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    receipt_folder = "receipts"
+    output_path = "report/expense_demo.pdf"
+
+    processor = UberReceiptProcessor(output_path)
+    image_paths = [
+        os.path.join(receipt_folder, filename)
+        for filename in sorted(os.listdir(receipt_folder))
+        if is_receipt_file(filename)
+    ]
+    start = time.perf_counter()
+    processor.add_receipts(image_paths)
+    print(f"extracted {len(image_paths)} receipts in {time.perf_counter() - start:.1f}s")
+    print(f"escalations: {processor.summarize_escalations()}")
+    processor.create_pdf()
+    print(f"total amount$: ${processor.total_amount:.2f}")
@@ -1,91 +1,396 @@
-from PIL import Image
+from PIL import Image, ImageOps
 import os,json
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from datetime import datetime
-import pytesseract
-import re
-from openai import OpenAI
+import io
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import base64
+import logging
+from receipt_cache import get_default_cache
+from receipt_metrics import EXTRACTIONS, LLM_REQUESTS, LLM_TOKENS, observe, timed
+from receipt_dedup import DEDUP_THRESHOLD, DuplicateIndex, extract_deduplicated
+from receipt_ledger import ReceiptLedger
+from receipt_report import (FAST_RENDER, IMAGE_HEIGHT, IMAGE_WIDTH, PAGE_HEIGHT, PAGE_WIDTH,
+                            stream_report, write_report)
+from receipt_sources import (as_receipt_ref, autocrop, discard_source, expand_receipt_paths, is_pdf_page,
+                             is_receipt_file, load_receipt_image, page_text, read_source, receipt_digest)
+
+logger = logging.getLogger(__name__)
+
+ENGINE = "llm"
+MODEL = "gpt-4o-mini"
+# 修改 PROMPT 后需要递增 PROMPT_VERSION，使旧的缓存结果失效
+PROMPT_VERSION = "1"
+# Vision API 的提示信息
+PROMPT = """Please analyze this Uber receipt image and extract the following information:
+        1. Type (Meal for Uber Eats or Trip for Uber ride)
+        2. Date (in format MMM DD, YYYY); The year should be 2024 unless otherwise specified
+        3. Amount (in USD)
+
+        Please respond in JSON format like:
+        {
+            "type": "Meal/Trip",
+            "date": "MMM DD, YYYY",
+            "amount": "$XX.XX"
+        }
+        """
+# PDF 自带文本层时改为发送文本，不再发送图片
+TEXT_PROMPT = PROMPT.replace("receipt image", "receipt text") + """
+        Receipt text:
+        """
+# 批量模式：一次请求发送多张带编号的图片，要求返回同样顺序的 JSON 数组
+BATCH_PROMPT = """You will receive {count} Uber receipt images, labelled Receipt 1 to Receipt {count}.
+        For each receipt extract the following information:
+        1. Type (Meal for Uber Eats or Trip for Uber ride)
+        2. Date (in format MMM DD, YYYY); The year should be 2024 unless otherwise specified
+        3. Amount (in USD)
+
+        Please respond with a JSON array containing exactly {count} objects, one per receipt and in order, like:
+        [
+            {{"index": 1, "type": "Meal/Trip", "date": "MMM DD, YYYY", "amount": "$XX.XX"}},
+            ...
+        ]
+        """
+# 没有文本层的 PDF 页面按这个DPI栅格化后发送
+LLM_PDF_DPI = int(os.getenv("LLM_PDF_DPI", "200"))
+
+# 图片预处理参数：发送前裁剪、转灰度、缩放并重新编码
+IMAGE_MAX_EDGE = int(os.getenv("LLM_IMAGE_MAX_EDGE", "1024"))
+IMAGE_FORMAT = os.getenv("LLM_IMAGE_FORMAT", "JPEG")  # JPEG 或 WEBP
+IMAGE_QUALITY = 80
+LOW_DETAIL_MAX_EDGE = 512  # 长边不超过 512 时使用 detail=low
+# 解析失败后依次尝试的分辨率，None 表示发送原图
+ESCALATION_EDGES = (2048, None)
+MAX_IMAGE_ATTEMPTS = 3
+
+# 并发请求数和重试参数，可通过环境变量调整
+MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "8"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+RETRY_BASE_DELAY = 0.5  # 秒
+RETRY_MAX_DELAY = 30.0  # 秒
+# 每个请求打包的收据数；1 为逐张请求
+BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "1"))
+BATCH_TOKENS_PER_RECEIPT = 60
 
 oai_api_key = os.getenv("OPENAI_API_KEY")
 # print(oai_api_key)
-client = OpenAI(api_key=oai_api_key)
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """所有线程共享一个带连接池的客户端，第一次请求时才导入 openai 并创建
+
+    重试由 _create_completion 处理，所以关闭SDK自带的重试；
+    设置 OPENAI_BASE_URL 即可指向本地的 mock chat-completions 服务。
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            import openai
+            _client = openai.OpenAI(
+                api_key=oai_api_key,
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+                ),
+            )
+        return _client
+
+def _is_retryable(error):
+    """429、5xx 和连接错误可以重试"""
+    import openai
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+def _retry_delay(error, attempt):
+    """指数退避加随机抖动；服务端给了 Retry-After 时以它为下限"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
 
 class UberReceiptProcessor:
-    def __init__(self, output_path, images_per_page=4):
+    def __init__(self, output_path, images_per_page=4, max_workers=MAX_WORKERS, cache=None,
+                 image_max_edge=IMAGE_MAX_EDGE, dedup_threshold=DEDUP_THRESHOLD, batch_size=BATCH_SIZE,
+                 client=None):
         self.output_path = output_path
         self.images_per_page = images_per_page
+        # 每行图片数由版式决定（report_layout），None 为自动
+        self.images_per_row = None
+        self.max_workers = max_workers
+        self.image_max_edge = image_max_edge
+        self.batch_size = max(1, batch_size)
+        self.request_stats = []
         self.receipts = []
+        # 与 receipts 同步的列式台账，用于汇总和导出；receipts 仍保留完整结果（引擎返回的原始日期和各引擎自己的字段），
+        # 台账是额外的内存，每张收据约 120 字节
+        self.ledger = ReceiptLedger()
         self.total_amount = 0
-        self.client = client
-
-        # 使用横向A4纸张
-        self.page_width, self.page_height = A4[::-1]  # 交换宽高以获得横向布局
-
-        # 调整图片尺寸以适应1x4布局
-        self.image_width = (self.page_width - 150) / 4  # 左右总边距120，图片间距30
-        self.image_height = self.page_height - 120  # 上下留边距
+        # 以 bytes 或文件对象传入、由处理器放入内存的收据，release_sources() 释放
+        self.owned_sources = []
+        # client=None 时在第一次请求时使用共享的客户端
+        self._client = client
+        # 设置为 receipt_metrics.Trace 时记录每个阶段的耗时
+        self.trace = None
+        # cache=None 使用共享的默认缓存，cache=False 关闭缓存
+        self.cache = get_default_cache() if cache is None else (cache or None)
+        # 感知哈希去重；dedup_threshold 为 None 或负数时关闭
+        self.dedup_index = None
+        if dedup_threshold is not None and dedup_threshold >= 0:
+            self.dedup_index = DuplicateIndex(dedup_threshold)
+
+        # 页面和图片尺寸见 receipt_report
+        self.page_width, self.page_height = PAGE_WIDTH, PAGE_HEIGHT
+        self.image_width, self.image_height = IMAGE_WIDTH, IMAGE_HEIGHT
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_client()
+        return self._client
 
     def encode_image_to_base64(self, image_path):
-        """将图片转换为base64编码"""
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-
-    def extract_info_from_image(self, image_path):
-        """使用LLM从图片中提取日期、金额和类型信息"""
-
-        base64_image = self.encode_image_to_base64(image_path)
-
-        # 准备 Vision API 的提示信息
-        prompt = """Please analyze this Uber receipt image and extract the following information:
-        1. Type (Meal for Uber Eats or Trip for Uber ride)
-        2. Date (in format MMM DD, YYYY); The year should be 2024 unless otherwise specified
-        3. Amount (in USD)
-
-        Please respond in JSON format like:
-        {
-            "type": "Meal/Trip",
-            "date": "MMM DD, YYYY",
-            "amount": "$XX.XX"
+        """将图片转换为base64编码；image_path 可以是内存引用"""
+        return base64.b64encode(read_source(image_path)).decode('utf-8')
+
+    def _create_completion(self, messages, max_tokens=300):
+        """调用 chat completions，遇到 429/5xx 时带抖动退避重试"""
+        import openai
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with timed("llm_request", self.trace, attempt=attempt):
+                    response = self.client.chat.completions.create(
+                        model=MODEL,
+                        messages=messages,
+                        max_tokens=max_tokens
+                    )
+            except openai.OpenAIError as e:
+                if attempt == MAX_RETRIES or not _is_retryable(e):
+                    LLM_REQUESTS.inc(outcome="error")
+                    raise
+                LLM_REQUESTS.inc(outcome="retry")
+                delay = _retry_delay(e, attempt)
+                logger.warning("LLM request failed (%s), retrying in %.2fs", e.__class__.__name__, delay)
+                time.sleep(delay)
+                continue
+            LLM_REQUESTS.inc(outcome="ok")
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                LLM_TOKENS.inc(usage.prompt_tokens, kind="prompt")
+                LLM_TOKENS.inc(usage.completion_tokens, kind="completion")
+            return response
+
+    def _escalation_edges(self):
+        """首次请求的长边尺寸，以及解析失败后依次重试的更高分辨率（None 表示原图）"""
+        edges = [self.image_max_edge]
+        for edge in ESCALATION_EDGES:
+            if edge in edges:
+                continue
+            if edge is None or (self.image_max_edge is not None and edge > self.image_max_edge):
+                edges.append(edge)
+        return edges[:MAX_IMAGE_ATTEMPTS]
+
+    def prepare_image(self, image_path, max_edge):
+        """裁剪收据区域、转灰度、缩放到 max_edge 后重新编码，返回 (base64, mime, detail)"""
+        if max_edge is None and not is_pdf_page(image_path):
+            # 最高一级直接发送原图；只读取一次，格式从同一份数据中识别
+            data = read_source(image_path)
+            with Image.open(io.BytesIO(data)) as img:
+                mime_type = Image.MIME.get(img.format, "image/png")
+            return base64.b64encode(data).decode('utf-8'), mime_type, "high"
+
+        size = None if max_edge is None else (max_edge, max_edge)
+        img = load_receipt_image(image_path, LLM_PDF_DPI, size)
+        img = ImageOps.exif_transpose(img).convert("L")
+        img = autocrop(img)
+        if max_edge is not None and max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+        detail = "low" if max(img.size) <= LOW_DETAIL_MAX_EDGE else "high"
+        mime_type = f"image/{IMAGE_FORMAT.lower()}"
+        return base64.b64encode(buffer.getvalue()).decode('utf-8'), mime_type, detail
+
+    def _parse_response(self, content, image_path):
+        """解析模型返回的 JSON，格式不对时抛出异常"""
+        with timed("llm_parse", self.trace):
+            json_str = content.replace("```json", "").replace("```", "")
+            return self._parse_result(json.loads(json_str), image_path)
+
+    def _parse_result(self, result, image_path):
+        """校验单张收据的字段并转换金额"""
+        if result.get('type') not in ('Meal', 'Trip'):
+            raise ValueError(f"unexpected type {result.get('type')!r}")
+        if not result.get('date'):
+            raise ValueError("missing date")
+        amount = float(str(result['amount']).replace('$', '').replace(',', '').strip())
+        return {
+            'date': result['date'],
+            'amount': amount,
+            'type': result['type'],
+            'path': image_path
         }
+
+    def _parse_batch_response(self, content, image_paths):
+        """把批量请求返回的数组映射回各自的图片，无法对应或校验失败的位置为 None"""
+        results = [None] * len(image_paths)
+        try:
+            items = json.loads(content.replace("```json", "").replace("```", ""))
+        except ValueError as e:
+            logger.warning("Error parsing batch of %d receipts: %s", len(image_paths), e)
+            return results
+        if isinstance(items, dict):
+            items = items.get('receipts', [])
+        if not isinstance(items, list):
+            return results
+        # 优先使用模型返回的 index；都没有 index 且数量一致时按位置对应
+        use_position = len(items) == len(image_paths) and not any(
+            isinstance(item, dict) and 'index' in item for item in items)
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            try:
+                i = position if use_position else int(item['index']) - 1
+                if not 0 <= i < len(image_paths) or results[i] is not None:
+                    raise ValueError(f"bad index {item.get('index')!r}")
+                results[i] = self._parse_result(item, image_paths[i])
+            except Exception as e:
+                logger.warning("Error parsing batch item %d: %s", position + 1, e)
+        return results
+
+    def summarize_request_stats(self):
+        """汇总每张收据的请求数、token 数、发送的字节数和耗时
+
+        批量请求的请求数、token 和耗时按批内收据数平均分摊。
         """
+        if not self.request_stats:
+            return {}
+        total_bytes = sum(s['bytes_sent'] for s in self.request_stats)
+        total_latency = sum(s['latency'] for s in self.request_stats)
+        total_requests = sum(s['requests'] for s in self.request_stats)
+        total_tokens = sum(s['tokens'] for s in self.request_stats)
+        n = len(self.request_stats)
+        return {
+            'receipts': n,
+            'batch_size': self.batch_size,
+            'requests': round(total_requests),
+            'tokens': round(total_tokens),
+            'bytes_sent': total_bytes,
+            'avg_requests_per_receipt': total_requests / n,
+            'avg_tokens_per_receipt': total_tokens / n,
+            'avg_bytes_per_receipt': total_bytes / n,
+            'avg_latency': total_latency / n,
+            'escalations': sum(max(0, s['attempts'] - 1) for s in self.request_stats),
+            'batch_fallbacks': sum(1 for s in self.request_stats if s.get('batch_fallback')),
+        }
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+    def _count_request(self, stats, response, share=1.0):
+        stats['requests'] += share
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            stats['tokens'] += usage.total_tokens * share
+
+    def _extract_from_text(self, text, image_path, stats):
+        """用 PDF 文本层代替图片请求，解析失败时返回 None 以便改用图片"""
+        stats['bytes_sent'] += len(text.encode('utf-8'))
+        stats['attempts'] += 1
+        stats['detail'] = 'text'
+        response = self._create_completion([
+            {"role": "user", "content": TEXT_PROMPT + text}
+        ])
+        self._count_request(stats, response)
+        try:
+            return self._parse_response(response.choices[0].message.content, image_path)
+        except Exception as e:
+            logger.warning("Error parsing receipt %s (text layer): %s", image_path, e)
+            return None
+
+    @staticmethod
+    def extraction_version():
+        """提取缓存键中的 (模型, 版本)；报告缓存也用它区分提取设置"""
+        return MODEL, PROMPT_VERSION
+
+    def _cache_key(self, image_path):
+        if self.cache is None:
+            return None
+        return self.cache.make_key(receipt_digest(image_path), ENGINE, *self.extraction_version())
+
+    def _cached(self, image_path):
+        """返回缓存的提取结果；未命中或未启用缓存时返回 None"""
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self._cache_key(image_path))
+        if cached is not None:
+            cached['path'] = image_path
+        return cached
+
+    def extract_info_from_image(self, image_path):
+        """使用LLM从图片中提取日期、金额和类型信息；image_path 也可以是 bytes 或文件对象"""
+        image_path = as_receipt_ref(image_path, owned=self.owned_sources)
+        cached = self._cached(image_path)
+        if cached is not None:
+            return cached
+        return self._extract_uncached(image_path)
+
+    def _extract_uncached(self, image_path, stats=None):
+        """不查缓存直接请求；stats 为批量请求已记录的统计，回退时在其上累加"""
+        cache_key = self._cache_key(image_path)
+        start = time.perf_counter()
+        if stats is None:
+            stats = {'path': image_path, 'bytes_sent': 0, 'attempts': 0, 'requests': 0, 'tokens': 0,
+                     'latency': 0.0}
+        receipt_info = None
+        # PDF 自带文本层时只发送文本
+        text = page_text(image_path) if is_pdf_page(image_path) else None
+        if text is not None:
+            receipt_info = self._extract_from_text(text, image_path, stats)
+        # 先用缩小后的图片请求，解析失败时逐级提高分辨率重试
+        for max_edge in ([] if receipt_info else self._escalation_edges()):
+            with timed("image_prepare", self.trace):
+                base64_image, mime_type, detail = self.prepare_image(image_path, max_edge)
+            stats['bytes_sent'] += len(base64_image)
+            stats['attempts'] += 1
+            stats['detail'] = detail
+
+            response = self._create_completion([
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": prompt},
+                        {"type": "text", "text": PROMPT},
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
+                                "url": f"data:{mime_type};base64,{base64_image}",
+                                "detail": detail
                             }
                         }
                     ]
                 }
-            ],
-            max_tokens=300
-        )
-        json_str = response.choices[0].message.content
-        json_str = json_str.replace("```json", "").replace("```", "")
-
-        try:
-            # 解析 AI 返回的结果
-            result = json.loads(json_str)
-            amount = float(result['amount'].replace('$', '').strip())
-            return {
-                'date': result['date'],
-                'amount': amount,
-                'type': result['type'],
-                'path': image_path
-            }
-        except Exception as e:
-            print(f"Error parsing receipt {image_path}: {e}")
+            ])
+            self._count_request(stats, response)
+            try:
+                receipt_info = self._parse_response(response.choices[0].message.content, image_path)
+                break
+            except Exception as e:
+                logger.warning("Error parsing receipt %s (max_edge=%s): %s", image_path, max_edge, e)
+
+        stats['latency'] += time.perf_counter() - start
+        observe("extract", time.perf_counter() - start, self.trace, start=start, path=image_path)
+        EXTRACTIONS.inc(engine=ENGINE, status="ok" if receipt_info else "failed")
+        self.request_stats.append(stats)
+
+        if receipt_info is None:
+            # 解析失败的结果不写入缓存，下次重新提取
             return {
                 'date': 'Unknown',
                 'amount': 0.0,
@@ -93,118 +398,206 @@ class UberReceiptProcessor:
                 'path': image_path
             }
 
-    def add_receipt(self, image_path):
-        """添加收据图片及其信息"""
-        print(f"Processing: {image_path}")
-        receipt_info = self.extract_info_from_image(image_path)
-        print(receipt_info)
-        self.receipts.append(receipt_info)
-        self.total_amount += receipt_info['amount']
-
-    def create_pdf(self):
-        """生成PDF报告"""
-        print(f"Creating PDF to:{self.output_path}")
-        c = canvas.Canvas(self.output_path, pagesize=A4[::-1])  # 使用横向A4
-
-        # 第一页：总结页
-        c.setFont("Helvetica-Bold", 16)
-        c.drawString(30, self.page_height - 30, "Uber expense report - Summary")
-
-        c.setFont("Helvetica-Bold", 14)
-        c.drawString(30, self.page_height - 60, "Amount summary:")
-
-        c.setFont("Helvetica", 12)
-        y = self.page_height - 80
+        if cache_key is not None:
+            self.cache.put(cache_key, receipt_info)
+        return receipt_info
 
-        # 按类型汇总
-        type_summary = {}
-        for receipt in self.receipts:
-            type_summary[receipt['type']] = type_summary.get(receipt['type'], 0) + receipt['amount']
+    def extract_batch(self, image_paths):
+        """一次请求提取多张收据，按输入顺序返回结果
 
-        print(type_summary)
-
-        for receipt_type, amount in type_summary.items():
-            c.drawString(30, y, f"{receipt_type} Total: ${amount:.2f}")
-            y -= 20
-
-        c.drawString(30, y - 20, f"Total: ${self.total_amount:.2f}")
-
-        # 结束第一页
-        c.showPage()
-
-        # 后续页面：收据图片
-        current_page = 1
-        images_per_row = 4
-        rows_per_page = 1
-
-        for i, receipt in enumerate(self.receipts):
-            if i % self.images_per_page == 0:
-                if i > 0:
-                    c.showPage()
-                current_page += 1
-                c.setFont("Helvetica-Bold", 16)
-                c.drawString(30, self.page_height - 30, f"Uber expense report - Page {current_page}")
-
-            # 计算当前图片在页面上的位置
-            col = i % images_per_row
-
-            # 计算x和y坐标（每列之间间距30）
-            x = 30 + col * (self.image_width + 30)
-            y = self.page_height - 60  # 固定y坐标，因为只有一行
-
-            # 添加图片
-            img = Image.open(receipt['path'])
-            aspect = img.width / img.height
-            img_height = self.image_height
-            img_width = img_height * aspect
-            if img_width > self.image_width:
-                img_width = self.image_width
-                img_height = img_width / aspect
-
-            # 居中显示图片
-            x_centered = x + (self.image_width - img_width) / 2
+        返回的数组无法解析或缺少某一项时，只有失败的收据会单独重新请求（包括逐级提高分辨率）。
+        """
+        import openai
+        start = time.perf_counter()
+        n = len(image_paths)
+        all_stats = [{'path': path, 'bytes_sent': 0, 'attempts': 0, 'requests': 0, 'tokens': 0}
+                     for path in image_paths]
+        content = [{"type": "text", "text": BATCH_PROMPT.format(count=n)}]
+        for i, (image_path, stats) in enumerate(zip(image_paths, all_stats)):
+            with timed("image_prepare", self.trace):
+                base64_image, mime_type, detail = self.prepare_image(image_path, self.image_max_edge)
+            stats['bytes_sent'] += len(base64_image)
+            stats['detail'] = detail
+            content.append({"type": "text", "text": f"Receipt {i + 1}:"})
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{mime_type};base64,{base64_image}", "detail": detail}
+            })
+
+        results = [None] * n
+        try:
+            response = self._create_completion([{"role": "user", "content": content}],
+                                               max_tokens=BATCH_TOKENS_PER_RECEIPT * n + 100)
+            for stats in all_stats:
+                self._count_request(stats, response, 1 / n)
+            results = self._parse_batch_response(response.choices[0].message.content, image_paths)
+        except openai.OpenAIError as e:
+            logger.warning("Batch request for %d receipts failed: %s", n, e)
+
+        # 批量请求的耗时按收据数平均分摊
+        latency = (time.perf_counter() - start) / n
+        observe("extract_batch", latency * n, self.trace, start=start, size=n)
+        for i, (image_path, stats) in enumerate(zip(image_paths, all_stats)):
+            stats['latency'] = latency
+            if results[i] is None:
+                stats['batch_fallback'] = True
+                results[i] = self._extract_uncached(image_path, stats)
+                continue
+            self.request_stats.append(stats)
+            EXTRACTIONS.inc(engine=ENGINE, status="ok")
+            if self.cache is not None:
+                self.cache.put(self._cache_key(image_path), results[i])
+        return results
 
-            c.drawImage(receipt['path'],
-                       x_centered,
-                       y - img_height,
-                       width=img_width,
-                       height=img_height)
+    def add_receipt(self, image_path):
+        """添加收据图片及其信息；PDF 的每一页作为一张收据"""
+        refs = expand_receipt_paths([as_receipt_ref(image_path, owned=self.owned_sources)])
+        for receipt_info in extract_deduplicated(refs, self.dedup_index, self._extract_serial,
+                                                 self._extracted()):
+            self._record(receipt_info)
 
-            # 添加收据信息
-            c.setFont("Helvetica", 12)
-            info_y = y - img_height - 15
+    def add_receipts(self, image_paths, max_workers=None, on_result=None):
+        """去重后并发提取多张收据的信息；每完成一张就回调 on_result(index, info)，最终按输入顺序加入
 
-            c.drawString(x, info_y,
-                        f"Type: {receipt['type']}")
+        image_paths 中可以混合路径、bytes 和文件对象，后两者直接在内存中处理。
+        """
+        results = self.extract_receipts(image_paths, max_workers, on_result)
+        # 在主线程中按顺序累加，保证 receipts 顺序和 total_amount 与串行处理一致
+        for receipt_info in results:
+            self._record(receipt_info)
+        return results
 
-            c.drawString(x, info_y - 15,
-                        f"Time: {receipt['date']}")
+    def extract_receipts(self, image_paths, max_workers=None, on_result=None, previous=None):
+        """与 add_receipts 相同地去重和提取，但结果只交给 on_result 并按输入顺序返回，不加入 receipts
 
-            c.drawString(x, info_y - 30,
-                        f"Amount: ${receipt['amount']:.2f}")
+        previous 是之前提取过的非重复收据 {path: info}，默认为已加入的收据。
+        """
+        refs = expand_receipt_paths([as_receipt_ref(p, owned=self.owned_sources) for p in image_paths])
+        return extract_deduplicated(
+            refs, self.dedup_index,
+            lambda pending, callback: self._extract_many(pending, max_workers, callback),
+            self._extracted() if previous is None else previous, on_result
+        )
 
-        c.save()
+    def _extract_serial(self, image_paths, on_result=None):
+        results = []
+        for i, image_path in enumerate(image_paths):
+            logger.debug("Processing: %s", image_path)
+            results.append(self.extract_info_from_image(image_path))
+            if on_result:
+                on_result(i, results[-1])
+        return results
+
+    def _extract_many(self, image_paths, max_workers=None, on_result=None):
+        """用线程池并发提取，按输入顺序返回结果；batch_size > 1 时图片按批打包请求"""
+        results = [None] * len(image_paths)
+        if not image_paths:
+            return results
+        workers = max_workers or self.max_workers
+        logger.info("Processing %d receipts with %d workers", len(image_paths), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            batch = []
+            for i, path in enumerate(image_paths):
+                if self.batch_size == 1:
+                    futures[executor.submit(self._extract_indexed, image_paths, [i])] = [i]
+                    continue
+                # 已缓存的结果直接返回，带文本层的 PDF 页面只发送文本，都不参与打包
+                cached = self._cached(path)
+                if cached is not None:
+                    results[i] = cached
+                    if on_result:
+                        on_result(i, cached)
+                    continue
+                if is_pdf_page(path) and page_text(path) is not None:
+                    futures[executor.submit(self._extract_indexed, image_paths, [i], False)] = [i]
+                    continue
+                batch.append(i)
+                if len(batch) == self.batch_size:
+                    futures[executor.submit(self._extract_indexed, image_paths, batch)] = batch
+                    batch = []
+            if batch:
+                futures[executor.submit(self._extract_indexed, image_paths, batch)] = batch
+
+            for future in as_completed(futures):
+                for i, receipt_info in zip(futures[future], future.result()):
+                    results[i] = receipt_info
+                    if on_result:
+                        on_result(i, receipt_info)
+        return results
+
+    def _extract_indexed(self, image_paths, indexes, use_cache=True):
+        paths = [image_paths[i] for i in indexes]
+        if len(paths) > 1:
+            return self.extract_batch(paths)
+        if use_cache:
+            return [self.extract_info_from_image(paths[0])]
+        return [self._extract_uncached(paths[0])]
+
+    def _extracted(self):
+        """已提取的非重复收据，用于识别跨批次的重复"""
+        return {r['path']: r for r in self.receipts if 'duplicate_of' not in r}
+
+    def _record(self, receipt_info):
+        logger.debug("Extracted %s", receipt_info)
+        self.receipts.append(receipt_info)
+        self.ledger.append(receipt_info)
+        # 重复的收据只在报告中标记，不计入总金额
+        if 'duplicate_of' not in receipt_info:
+            self.total_amount += receipt_info['amount']
+
+    def release_sources(self):
+        """释放处理器放入内存的收据；之后不能再用这些收据生成报告"""
+        for ref in self.owned_sources:
+            discard_source(ref)
+        self.owned_sources = []
+
+    def stream_pdf(self, image_paths, out=None):
+        """边提取边生成PDF，页面随结果写出，不在内存中保留图片；out 默认写入 output_path"""
+        logger.info("Streaming PDF to: %s", self.output_path if out is None else out)
+        if out is not None:
+            return stream_report(self, image_paths, out)
+        with open(self.output_path, "wb") as f:
+            return stream_report(self, image_paths, f)
+
+    def create_pdf(self, fast=None):
+        """生成PDF报告；fast=False 时使用直接嵌入原图的旧渲染方式"""
+        logger.info("Creating PDF to: %s", self.output_path)
+        write_report(
+            self.output_path, self.receipts, self.total_amount,
+            type_summary=self.ledger.totals_by_type(),
+            images_per_page=self.images_per_page,
+            images_per_row=self.images_per_row,
+            fast=FAST_RENDER if fast is None else fast,
+            trace=self.trace
+        )
 
 def process_receipts(receipt_folder, output_path):
     """处理指定文件夹中的所有收据图片"""
     processor = UberReceiptProcessor(output_path)
 
     # 处理文件夹中的所有图片
-    for filename in os.listdir(receipt_folder):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            image_path = os.path.join(receipt_folder, filename)
-            processor.add_receipt(image_path)
+    image_paths = [
+        os.path.join(receipt_folder, filename)
+        for filename in os.listdir(receipt_folder)
+        if is_receipt_file(filename)
+    ]
+    processor.add_receipts(image_paths)
 
     print("===" * 20)
     print("Creating PDF and summarize")
 
     processor.create_pdf()
     total = processor.total_amount
+    if processor.cache is not None:
+        print(f"cache stats: {processor.cache.stats()}")
+    print(f"request stats: {processor.summarize_request_stats()}")
     print(f"total amount$:, ${total:.2f}")
     return total
 
 # 使用示例
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     # 指定包含收据图片的文件夹路径
     receipt_folder = "receipts"
     output_path = "report/expense_demo.pdf"
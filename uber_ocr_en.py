@@ -1,183 +1,482 @@
 from PIL import Image
 import os
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 from datetime import datetime
-import pytesseract
 import re
+import atexit
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from receipt_cache import get_default_cache
+from receipt_metrics import EXTRACTIONS, observe
+from receipt_dedup import DEDUP_THRESHOLD, DuplicateIndex, extract_deduplicated
+from receipt_ledger import ReceiptLedger
+from receipt_report import (FAST_RENDER, IMAGE_HEIGHT, IMAGE_WIDTH, PAGE_HEIGHT, PAGE_WIDTH,
+                            stream_report, write_report)
+from receipt_sources import (as_receipt_ref, attached_source, discard_source, expand_receipt_paths,
+                             get_image_cache, is_pdf_page, is_receipt_file, load_receipt_image, page_text,
+                             receipt_digest, source_payload)
+
+logger = logging.getLogger(__name__)
+
+ENGINE = "tesseract"
+OCR_LANG = "eng"
+# 修改正则解析逻辑后需要递增 PARSER_VERSION，使旧的缓存结果失效
+PARSER_VERSION = "1"
+# PDF 页面做OCR时的栅格化DPI
+OCR_PDF_DPI = int(os.getenv("OCR_PDF_DPI", "300"))
+# 并行OCR的进程数，默认使用全部CPU核心
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", "0")) or os.cpu_count() or 1
+# roi：先在缩小的图上做版面分析，找到日期和总价所在的行，只对这两行按原分辨率识别；
+# full：对整张原图做一次OCR。roi 找不到 "total" 时自动退回 full
+# roi 的耗时和准确率还没有用 benchmarks.run --ocr-modes roi,full 测过，暂时需要手动开启
+OCR_MODES = ("roi", "full")
+OCR_MODE = os.getenv("OCR_MODE", "full")
+# 版面分析时图片缩放到的最大宽度（像素）
+LAYOUT_MAX_WIDTH = int(os.getenv("OCR_LAYOUT_MAX_WIDTH", "800"))
+# 裁剪单行时上下的留白（相对行高），以及行高不足时放大到的像素
+ROI_PADDING = 0.35
+ROI_LINE_HEIGHT = 48
+# 单行识别（psm 7）并限制字符集
+AMOUNT_CONFIG = "--psm 7 -c tessedit_char_whitelist=$0123456789.,"
+DATE_CONFIG = ("--psm 7 -c tessedit_char_whitelist="
+               "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789:")
+
+# 正则在模块导入时编译，每个工作进程只编译一次
+MEAL_DATE_RE = re.compile(r'(\w{3} \w{3} \d{1,2} \d{4})') # for meal
+# TRIP_DATE_RE = re.compile(r"(\d{1,2}月\d{1,2}日\s*\d{1,2}:\d{2}[ap]m)") # for Chinese + English
+TRIP_DATE_RE = re.compile(r"(\w{3}\s+\d{1,2}\s+\d{1,2}:\d{2}+[AP]M)", re.IGNORECASE) # for English
+AMOUNT_RE = re.compile(r'(\$?\d+\.\d{2})')
+# 版面分析中定位总价和日期所在行；\btotal\b 不会匹配 subtotal
+TOTAL_RE = re.compile(r'\btotal\b')
+MONTH_RE = re.compile(r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s+\d{1,2}\b')
+
+# 常驻的进程池，多次批处理之间复用已预热的工作进程
+_pool = None
+_pool_workers = 0
+# 被更大的进程池替换下来的旧进程池，可能还有任务在用，进程退出时才关闭
+_pool_lock = threading.Lock()
+# 工作进程不用 fork 创建：Web 服务有很多线程，fork 出的子进程可能继承其他线程持有的锁
+POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def parse_receipt_text(raw_text, image_path):
+    """用正则从OCR文本中解析日期、金额和类型"""
+    clean_text = raw_text.strip().lower()
+
+    # 使用正则表达式提取信息
+    if "eats" in clean_text:
+        receipt_type = "Meal"
+        date = MEAL_DATE_RE.search(clean_text)
+        if date:
+            date_eng = date.group(1)
+            logger.debug("meal date: %s", date_eng)
+        else:
+            logger.info("no date matched: %s", image_path)
+            date_eng = "not recognized"
+    else:
+        receipt_type = "Trip"
+        date = TRIP_DATE_RE.search(clean_text)
+        try:
+            if date:
+                date_text = date.group(1).strip().lower()
+                date_text = "2024 " + date_text
+                date_eng = datetime.strptime(date_text,"%Y %b %d %I:%M%p")
+                # date_eng = date_obj.strftime("%b %d, %Y %I:%M %p")
+                logger.debug("trip date: %s", date_eng)
+            else:
+                logger.info("no date matched: %s", image_path)
+                date_eng = "not recognized"
+                # print("==== clean text ====")
+                # print(clean_text)
+        except:
+                logger.info("unparsable date in %s:\n%s", image_path, clean_text)
+                date_eng = "not recognized"
+
+    amount = AMOUNT_RE.search(clean_text)
+
+    return {
+        'date': date_eng,
+        'amount': float(amount.group().replace('$', '')) if amount else 0.0,
+        'type': receipt_type,
+        'path': image_path
+    }
+
+def _ocr_lines(data, scale=1.0):
+    """把 image_to_data 的单词按行合并，返回 (行列表, 单词平均置信度 0~100)
+
+    每行是 {"text", "words": [(单词, 框)]}，框为 (left, top, right, bottom)，乘以 scale 换算回原图坐标。
+    """
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        word = word.strip()
+        conf = float(data["conf"][i])
+        if not word or conf < 0:
+            continue
+        left, top = data["left"][i], data["top"][i]
+        box = tuple(round(v * scale) for v in (left, top, left + data["width"][i], top + data["height"][i]))
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append((word, box))
+        confidences.append(conf)
+    lines = [{"text": " ".join(word for word, _ in words), "words": words} for words in lines.values()]
+    return lines, sum(confidences) / len(confidences) if confidences else 0.0
+
+def ocr_words(img):
+    """用 image_to_data 识别，返回 (按行拼接的文本, 单词平均置信度 0~100)"""
+    # pytesseract 会连带导入 pandas，只在真正做OCR时导入，不拖慢启动
+    import pytesseract
+    data = pytesseract.image_to_data(img, lang=OCR_LANG, output_type=pytesseract.Output.DICT)
+    lines, confidence = _ocr_lines(data)
+    return "\n".join(line["text"] for line in lines), confidence
+
+def _crop_line(img, box, left=0):
+    """裁出 box 所在的水平条带（从 left 到右边缘），上下留白，行高太小时放大"""
+    _, top, _, bottom = box
+    height = max(bottom - top, 1)
+    pad = int(height * ROI_PADDING) + 2
+    crop = img.crop((left, max(0, top - pad), img.width, min(img.height, bottom + pad)))
+    if height < ROI_LINE_HEIGHT:
+        factor = ROI_LINE_HEIGHT / height
+        crop = crop.resize((round(crop.width * factor), round(crop.height * factor)), Image.LANCZOS)
+    return crop
+
+def ocr_roi(img, timings):
+    """两遍OCR，返回 (文本, 单词平均置信度)；版面中找不到 "total" 时返回 (None, 0)
+
+    返回的文本把高分辨率识别的日期行和总价放在最前面，后面是版面分析的全文，
+    parse_receipt_text 取第一个匹配，所以优先使用这两行的结果。
+    """
+    import pytesseract
+    start = time.perf_counter()
+    gray = img.convert("L")
+    scale = min(1.0, LAYOUT_MAX_WIDTH / gray.width)
+    small = gray.resize((round(gray.width * scale), round(gray.height * scale)), Image.BILINEAR) \
+        if scale < 1.0 else gray
+    data = pytesseract.image_to_data(small, lang=OCR_LANG, output_type=pytesseract.Output.DICT)
+    lines, confidence = _ocr_lines(data, 1 / scale)
+    timings["ocr_layout"] = time.perf_counter() - start
+
+    total_box = date_box = None
+    for line in lines:
+        if total_box is None:
+            total_box = next((box for word, box in line["words"] if TOTAL_RE.search(word.lower())), None)
+        if date_box is None and MONTH_RE.search(line["text"].lower()):
+            boxes = [box for _, box in line["words"]]
+            date_box = (0, min(b[1] for b in boxes), 0, max(b[3] for b in boxes))
+    if total_box is None:
+        return None, 0.0
+
+    start = time.perf_counter()
+    # 总价只识别 "total" 右侧的部分，字符集限制为数字和金额符号
+    amount_text = pytesseract.image_to_string(_crop_line(gray, total_box, total_box[2]), lang=OCR_LANG,
+                                              config=AMOUNT_CONFIG)
+    date_text = ""
+    if date_box is not None:
+        date_text = pytesseract.image_to_string(_crop_line(gray, date_box), lang=OCR_LANG, config=DATE_CONFIG)
+    timings["ocr_roi"] = time.perf_counter() - start
+    layout_text = "\n".join(line["text"] for line in lines)
+    return "\n".join([date_text.strip(), amount_text.strip(), layout_text]), confidence
+
+def ocr_receipt(image_path, timings=None, details=None, mode=None):
+    """对单张图片做OCR并解析；定义在模块级以便在工作进程中执行
+
+    mode 为 OCR_MODES 之一，默认 OCR_MODE。
+    传入 timings 字典时记录各阶段耗时（秒），由主进程写入指标。
+    传入 details 字典时写入识别文本 text 和单词平均置信度 word_confidence（full 模式改用 image_to_data）。
+    """
+    timings = {} if timings is None else timings
+    mode = mode or OCR_MODE
+    # PDF 自带文本层时直接读取文本，跳过OCR
+    if is_pdf_page(image_path):
+        start = time.perf_counter()
+        text = page_text(image_path)
+        timings["pdf_text"] = time.perf_counter() - start
+        if text is not None:
+            if details is not None:
+                details.update(text=text, word_confidence=100.0)
+            start = time.perf_counter()
+            receipt_info = parse_receipt_text(text, image_path)
+            timings["ocr_parse"] = time.perf_counter() - start
+            return receipt_info
+
+    # 使用OCR提取文本
+    # custom_config = r'--oem 3 --psm 6'
+    # raw_text = pytesseract.image_to_string(Image.open(image_path),lang='eng+chi_sim')
+    start = time.perf_counter()
+    # 在主进程中运行时与去重、渲染共用解码后的图片
+    img = load_receipt_image(image_path, OCR_PDF_DPI)
+    timings["image_decode"] = time.perf_counter() - start
+    raw_text = None
+    if mode == "roi":
+        raw_text, word_confidence = ocr_roi(img, timings)
+    if raw_text is None:
+        start = time.perf_counter()
+        if details is None:
+            import pytesseract
+            raw_text = pytesseract.image_to_string(img, lang=OCR_LANG)
+        else:
+            raw_text, word_confidence = ocr_words(img)
+        timings["ocr"] = time.perf_counter() - start
+    if details is not None:
+        details.update(text=raw_text, word_confidence=word_confidence)
+    start = time.perf_counter()
+    receipt_info = parse_receipt_text(raw_text, image_path)
+    timings["ocr_parse"] = time.perf_counter() - start
+    return receipt_info
+
+def _ocr_timed(image_path, mode=None, data=None):
+    """工作进程入口：返回 (结果, 各阶段耗时)；data 为内存中收据的内容，见 source_payload"""
+    timings = {}
+    with attached_source(image_path, data):
+        return ocr_receipt(image_path, timings, mode=mode), timings
+
+def ocr_with_details(image_path, mode=None, data=None):
+    """工作进程入口：返回 (结果, 各阶段耗时, 识别文本和置信度)"""
+    timings, details = {}, {}
+    with attached_source(image_path, data):
+        return ocr_receipt(image_path, timings, details, mode), timings, details
+
+def _init_ocr_worker():
+    """工作进程启动时预热：导入 pytesseract 并确认 tesseract 可用，避免第一张收据承担这部分开销
+
+    每张图片在工作进程中只 OCR 一次，不保留解码后的图片。
+    """
+    get_image_cache().resize(0)
+    import pytesseract
+    pytesseract.get_tesseract_version()
+
+def get_pool(max_workers):
+    """返回常驻的OCR进程池，多个任务的线程共用
+
+    需要的工作进程数超过现有进程池时换成更大的，需要的更少时直接共用；进程池损坏（例如工作进程崩溃、
+    没有安装 tesseract）时换一个新的。创建和替换都在锁内完成；替换下来的进程池以 wait=False 关闭，
+    已经提交的任务照常完成，之后工作进程退出。
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        broken = _pool is not None and getattr(_pool, "_broken", False)
+        if _pool is None or broken or max_workers > _pool_workers:
+            if _pool is not None:
+                # 损坏的进程池上的任务都已失败；更小的进程池上排队的任务仍会执行完
+                _pool.shutdown(wait=False)
+            _pool_workers = max(max_workers, _pool_workers)
+            _pool = ProcessPoolExecutor(max_workers=_pool_workers, initializer=_init_ocr_worker,
+                                        mp_context=multiprocessing.get_context(POOL_START_METHOD))
+        return _pool
+
+def _shutdown_pools():
+    """进程退出时关闭OCR进程池"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        pool, _pool = _pool, None
+        _pool_workers = 0
+    if pool is not None:
+        pool.shutdown()
+
+atexit.register(_shutdown_pools)
 
 class UberReceiptProcessor:
-    def __init__(self, output_path, images_per_page=4):
+    def __init__(self, output_path, images_per_page=4, cache=None, max_workers=OCR_MAX_WORKERS,
+                 dedup_threshold=DEDUP_THRESHOLD, ocr_mode=OCR_MODE):
+        if ocr_mode not in OCR_MODES:
+            raise ValueError(f"ocr_mode must be one of {OCR_MODES}, got {ocr_mode!r}")
+        self.ocr_mode = ocr_mode
         self.output_path = output_path
         self.images_per_page = images_per_page
+        # 每行图片数由版式决定（report_layout），None 为自动
+        self.images_per_row = None
+        self.max_workers = max_workers
         self.receipts = []
+        # 与 receipts 同步的列式台账，用于汇总和导出；receipts 仍保留完整结果（引擎返回的原始日期和各引擎自己的字段），
+        # 台账是额外的内存，每张收据约 120 字节
+        self.ledger = ReceiptLedger()
         self.total_amount = 0
-
-        # 使用横向A4纸张
-        self.page_width, self.page_height = A4[::-1]  # 交换宽高以获得横向布局
-
-        # 调整图片尺寸以适应1x4布局
-        self.image_width = (self.page_width - 150) / 4  # 左右总边距120，图片间距30
-        self.image_height = self.page_height - 120  # 上下留边距
+        # 以 bytes 或文件对象传入、由处理器放入内存的收据，release_sources() 释放
+        self.owned_sources = []
+        # 设置为 receipt_metrics.Trace 时记录每个阶段的耗时
+        self.trace = None
+        # cache=None 使用共享的默认缓存，cache=False 关闭缓存
+        self.cache = get_default_cache() if cache is None else (cache or None)
+        # 感知哈希去重；dedup_threshold 为 None 或负数时关闭
+        self.dedup_index = None
+        if dedup_threshold is not None and dedup_threshold >= 0:
+            self.dedup_index = DuplicateIndex(dedup_threshold)
+
+        # 页面和图片尺寸见 receipt_report
+        self.page_width, self.page_height = PAGE_WIDTH, PAGE_HEIGHT
+        self.image_width, self.image_height = IMAGE_WIDTH, IMAGE_HEIGHT
+
+    @staticmethod
+    def extraction_version(ocr_mode=None):
+        """提取缓存键中的 (模型, 版本)；报告缓存也用它区分提取设置"""
+        return OCR_LANG, f"{PARSER_VERSION}-{ocr_mode or OCR_MODE}"
+
+    def _cache_key(self, image_path):
+        return self.cache.make_key(receipt_digest(image_path), ENGINE, *self.extraction_version(self.ocr_mode))
 
     def extract_info_from_image(self, image_path):
-        """从图片中提取日期、金额和类型信息"""
-        # 使用OCR提取文本
-        # custom_config = r'--oem 3 --psm 6'
-        # raw_text = pytesseract.image_to_string(Image.open(image_path),lang='eng+chi_sim')
-        raw_text = pytesseract.image_to_string(Image.open(image_path),lang='eng')
-        clean_text = raw_text.strip().lower()
-
-        # 使用正则表达式提取信息
-        if "eats" in clean_text:
-            receipt_type = "Meal"
-            date_pattern = r'(\w{3} \w{3} \d{1,2} \d{4})' # for meal
-            date = re.search(date_pattern, clean_text)
-            date_eng = date.group(1)
-            print(date_eng)
-        else:
-            receipt_type = "Trip"
-            # date_pattern = r"(\d{1,2}月\d{1,2}日\s*\d{1,2}:\d{2}[ap]m)" # for Chinese + English
-            date_pattern = r"(\w{3}\s+\d{1,2}\s+\d{1,2}:\d{2}+[AP]M)" # for English
-            date = re.search(date_pattern, clean_text, re.IGNORECASE)
-            try:
-                if date:
-                    date_text = date.group(1).strip().lower()
-                    date_text = "2024 " + date_text
-                    print(date_text)
-                    date_eng = datetime.strptime(date_text,"%Y %b %d %I:%M%p")
-                    # date_eng = date_obj.strftime("%b %d, %Y %I:%M %p")
-                    print(date_eng)
-                else:
-                    print(f"no date matched:{image_path}")
-                    date_eng = "not recognized"
-                    # print("==== clean text ====")
-                    # print(clean_text)
-            except:
-                    print("==== clean text ====")
-                    print(clean_text)
-
-        amount_pattern = r'(\$?\d+\.\d{2})'
-        amount = re.search(amount_pattern, clean_text)
-
-        return {
-            'date': date_eng,
-            'amount': float(amount.group().replace('$', '')) if amount else 0.0,
-            'type': receipt_type,
-            'path': image_path
-        }
+        """从图片中提取日期、金额和类型信息；image_path 也可以是 bytes 或文件对象"""
+        image_path = as_receipt_ref(image_path, owned=self.owned_sources)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(image_path)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                cached['path'] = image_path
+                return cached
+
+        timings = {}
+        receipt_info = ocr_receipt(image_path, timings, mode=self.ocr_mode)
+        self._observe(image_path, receipt_info, timings)
+        if cache_key is not None:
+            self.cache.put(cache_key, receipt_info)
+        return receipt_info
+
+    def _observe(self, image_path, receipt_info, timings):
+        """把工作进程测得的耗时写入指标"""
+        for stage, duration in timings.items():
+            observe(stage, duration, self.trace, path=image_path)
+        observe("extract", sum(timings.values()), self.trace, path=image_path)
+        recognized = receipt_info['amount'] and receipt_info['date'] != "not recognized"
+        EXTRACTIONS.inc(engine=ENGINE, status="ok" if recognized else "failed")
 
     def add_receipt(self, image_path):
-        """添加收据图片及其信息"""
-        print("=====" * 20)
-        print(f"Processing: {image_path}")
-        receipt_info = self.extract_info_from_image(image_path)
+        """添加收据图片及其信息；PDF 的每一页作为一张收据"""
+        refs = expand_receipt_paths([as_receipt_ref(image_path, owned=self.owned_sources)])
+        for receipt_info in extract_deduplicated(refs, self.dedup_index, self._extract_serial,
+                                                 self._extracted()):
+            self._record(receipt_info)
+
+    def add_receipts(self, image_paths, max_workers=None, on_result=None):
+        """去重后用进程池并行OCR多张收据；每完成一张就回调 on_result(index, info)，最终按输入顺序加入
+
+        image_paths 中可以混合路径、bytes 和文件对象，后两者直接在内存中处理。
+        """
+        results = self.extract_receipts(image_paths, max_workers, on_result)
+        # 按输入顺序累加，保证收据顺序和总金额是确定的
+        for receipt_info in results:
+            self._record(receipt_info)
+        return results
+
+    def extract_receipts(self, image_paths, max_workers=None, on_result=None, previous=None):
+        """与 add_receipts 相同地去重和提取，但结果只交给 on_result 并按输入顺序返回，不加入 receipts
+
+        previous 是之前提取过的非重复收据 {path: info}，默认为已加入的收据。
+        """
+        refs = expand_receipt_paths([as_receipt_ref(p, owned=self.owned_sources) for p in image_paths])
+        return extract_deduplicated(
+            refs, self.dedup_index,
+            lambda pending, callback: self._extract_many(pending, max_workers, callback),
+            self._extracted() if previous is None else previous, on_result
+        )
+
+    def _extract_serial(self, image_paths, on_result=None):
+        results = []
+        for i, image_path in enumerate(image_paths):
+            logger.debug("Processing: %s", image_path)
+            results.append(self.extract_info_from_image(image_path))
+            if on_result:
+                on_result(i, results[-1])
+        return results
+
+    def _extract_many(self, image_paths, max_workers=None, on_result=None):
+        """命中缓存的直接返回，其余交给进程池，按输入顺序返回结果"""
+        results = [None] * len(image_paths)
+        cache_keys = {}
+
+        # 命中缓存的收据直接返回，只把未命中的交给进程池
+        pending = []
+        for i, image_path in enumerate(image_paths):
+            if self.cache is not None:
+                cache_keys[i] = self._cache_key(image_path)
+                cached = self.cache.get(cache_keys[i])
+                if cached is not None:
+                    cached['path'] = image_path
+                    results[i] = cached
+                    if on_result:
+                        on_result(i, cached)
+                    continue
+            pending.append(i)
+
+        if pending:
+            workers = max_workers or self.max_workers
+            logger.info("Processing %d receipts with %d OCR workers", len(pending), workers)
+            pool = get_pool(workers)
+            futures = {pool.submit(_ocr_timed, image_paths[i], self.ocr_mode, source_payload(image_paths[i])): i
+                       for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                receipt_info, timings = future.result()
+                self._observe(image_paths[i], receipt_info, timings)
+                results[i] = receipt_info
+                logger.debug("Processed (%d/%d): %s", i + 1, len(image_paths), image_paths[i])
+                if i in cache_keys:
+                    self.cache.put(cache_keys[i], receipt_info)
+                if on_result:
+                    on_result(i, receipt_info)
+
+        return results
+
+    def _extracted(self):
+        """已提取的非重复收据，用于识别跨批次的重复"""
+        return {r['path']: r for r in self.receipts if 'duplicate_of' not in r}
+
+    def _record(self, receipt_info):
         self.receipts.append(receipt_info)
-        self.total_amount += receipt_info['amount']
-
-    def create_pdf(self):
-        """生成PDF报告"""
-        print(f"Creating PDF to:{self.output_path}")
-        c = canvas.Canvas(self.output_path, pagesize=A4[::-1])  # 使用横向A4
-
-        # 第一页：总结页
-        c.setFont("Helvetica-Bold", 16)
-        c.drawString(30, self.page_height - 30, "Uber expense report - Summary")
-
-        c.setFont("Helvetica-Bold", 14)
-        c.drawString(30, self.page_height - 60, "Amount summary:")
-
-        c.setFont("Helvetica", 12)
-        y = self.page_height - 80
-
-        # 按类型汇总
-        type_summary = {}
-        for receipt in self.receipts:
-            type_summary[receipt['type']] = type_summary.get(receipt['type'], 0) + receipt['amount']
-
-        print(type_summary)
-
-        for receipt_type, amount in type_summary.items():
-            c.drawString(30, y, f"{receipt_type} Total: ${amount:.2f}")
-            y -= 20
-
-        c.drawString(30, y - 20, f"Total: ${self.total_amount:.2f}")
-
-        # 结束第一页
-        c.showPage()
-
-        # 后续页面：收据图片
-        current_page = 1
-        images_per_row = self.images_per_page
-        rows_per_page = 1
-
-        for i, receipt in enumerate(self.receipts):
-            if i % self.images_per_page == 0:
-                if i > 0:
-                    c.showPage()
-                current_page += 1
-                c.setFont("Helvetica-Bold", 16)
-                c.drawString(30, self.page_height - 30, f"Uber expense report - Page {current_page}")
-
-            # 计算当前图片在页面上的位置
-            col = i % images_per_row
-
-            # 计算x和y坐标（每列之间间距30）
-            x = 30 + col * (self.image_width + 30)
-            y = self.page_height - 60  # 固定y坐标，因为只有一行
-
-            # 添加图片
-            img = Image.open(receipt['path'])
-            aspect = img.width / img.height
-            img_height = self.image_height
-            img_width = img_height * aspect
-            if img_width > self.image_width:
-                img_width = self.image_width
-                img_height = img_width / aspect
-
-            # 居中显示图片
-            x_centered = x + (self.image_width - img_width) / 2
-
-            c.drawImage(receipt['path'],
-                       x_centered,
-                       y - img_height,
-                       width=img_width,
-                       height=img_height)
-
-            # 添加收据信息
-            c.setFont("Helvetica", 12)
-            info_y = y - img_height - 15
-
-            c.drawString(x, info_y,
-                        f"Type: {receipt['type']}")
-
-            c.drawString(x, info_y - 15,
-                        f"Time: {receipt['date']}")
-
-            c.drawString(x, info_y - 30,
-                        f"Amount: ${receipt['amount']:.2f}")
-
-        print("PDF report generated....")
-        c.save()
+        self.ledger.append(receipt_info)
+        # 重复的收据只在报告中标记，不计入总金额
+        if 'duplicate_of' not in receipt_info:
+            self.total_amount += receipt_info['amount']
+
+    def release_sources(self):
+        """释放处理器放入内存的收据；之后不能再用这些收据生成报告"""
+        for ref in self.owned_sources:
+            discard_source(ref)
+        self.owned_sources = []
+
+    def stream_pdf(self, image_paths, out=None):
+        """边提取边生成PDF，页面随结果写出，不在内存中保留图片；out 默认写入 output_path"""
+        logger.info("Streaming PDF to: %s", self.output_path if out is None else out)
+        if out is not None:
+            return stream_report(self, image_paths, out)
+        with open(self.output_path, "wb") as f:
+            return stream_report(self, image_paths, f)
+
+    def create_pdf(self, fast=None):
+        """生成PDF报告；fast=False 时使用直接嵌入原图的旧渲染方式"""
+        logger.info("Creating PDF to: %s", self.output_path)
+        write_report(
+            self.output_path, self.receipts, self.total_amount,
+            type_summary=self.ledger.totals_by_type(),
+            images_per_page=self.images_per_page,
+            images_per_row=self.images_per_row,
+            fast=FAST_RENDER if fast is None else fast,
+            trace=self.trace
+        )
+        logger.info("PDF report generated")
 
 # 使用示例
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     # 指定包含收据图片的文件夹路径
     receipt_folder = "receipts"
     output_path = "report/expense_demo.pdf"
 
     processor = UberReceiptProcessor(output_path)
-    for filename in os.listdir(receipt_folder):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            image_path = os.path.join(receipt_folder, filename)
-            processor.add_receipt(image_path)
+    image_paths = [
+        os.path.join(receipt_folder, filename)
+        for filename in sorted(os.listdir(receipt_folder))
+        if is_receipt_file(filename)
+    ]
+    processor.add_receipts(image_paths)
 
     print("=====" * 20)
     print(f"Creating PDF and summarize")
     processor.create_pdf()
     total = processor.total_amount
+    if processor.cache is not None:
+        print(f"cache stats: {processor.cache.stats()}")
     print("===== report generated =====")
     print(f"total amount$: ${total:.2f}")
     # total = process_receipts(receipt_folder, output_path)
@@ -0,0 +1,277 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from receipt_events import ReceiptProgress
+from receipt_metrics import timed
+from receipt_report import write_report
+from receipt_sources import UnreadableReceiptError, expand_receipt_paths, is_receipt_file, split_page_ref
+
+# 同时打开的上传会话数、单个文件的大小上限和空闲会话的保留时间，可通过环境变量调整
+UPLOAD_MAX_SESSIONS = int(os.getenv("UPLOAD_MAX_SESSIONS", "16"))
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", "3600"))  # 秒
+# 每个会话并发提取的收据数
+UPLOAD_EXTRACT_WORKERS = int(os.getenv("UPLOAD_EXTRACT_WORKERS", "4"))
+# 建议客户端使用的块大小，以及服务端接受的单块上限
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_MAX_CHUNK_BYTES = 8 * UPLOAD_CHUNK_BYTES
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class UploadError(Exception):
+    """上传请求无效；status 为对应的 HTTP 状态码"""
+
+    def __init__(self, message, status=400, received=None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+
+def parse_content_range(header):
+    """解析 "bytes start-end/total"，返回 (start, end, total)，end 为包含的最后一个字节"""
+    match = CONTENT_RANGE_RE.fullmatch((header or "").strip())
+    if not match:
+        raise UploadError("Content-Range must look like 'bytes start-end/total'")
+    start, end, total = (int(v) for v in match.groups())
+    if end < start or end >= total:
+        raise UploadError(f"Invalid Content-Range {header!r}")
+    return start, end, total
+
+
+class UploadedFile:
+    """一个正在分块上传的文件"""
+
+    def __init__(self, index, name, path, size):
+        self.index = index
+        self.name = name
+        self.path = path
+        self.size = size
+        self.received = 0
+        self.refs = []
+        # 文件传完后无法读取（例如损坏的 PDF）时的错误信息
+        self.error = None
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+
+class UploadSession:
+    """分块、可续传的上传会话：每个文件传完就开始提取，不等整批上传结束
+
+    文件按客户端给的序号排列，报告中的顺序与序号一致，与到达顺序无关。
+    每张收据提取完成时写入 progress 的事件，/uploads/{id}/events 按完成顺序推送。
+    """
+
+    def __init__(self, processor, images_per_page=4, trace=None):
+        self.id = uuid.uuid4().hex
+        self.processor = processor
+        self.images_per_page = images_per_page
+        self.trace = trace
+        self.dir = tempfile.mkdtemp(prefix="upload_")
+        self.files = {}
+        self.results = {}
+        self.duplicates = {}
+        self.created_at = self.updated_at = time.time()
+        self._futures = []
+        # 收据引用 -> 提取结束的标志，重复的收据等待代表收据的结果
+        self._extracted = {}
+        self.progress = ReceiptProgress()
+        self._executor = ThreadPoolExecutor(max_workers=UPLOAD_EXTRACT_WORKERS,
+                                            thread_name_prefix=f"upload-{self.id[:8]}")
+        self._lock = threading.Lock()
+        self._dedup_lock = threading.Lock()
+        self.closed = False
+
+    def write_chunk(self, index, name, content_range, data):
+        """把一块数据写到文件的 start 位置；返回已收到的字节数
+
+        start 与已收到的字节数不一致时抛出 409，客户端从 received 处续传；
+        重复发送已经收到的块是安全的。
+        """
+        start, end, total = parse_content_range(content_range)
+        if len(data) != end - start + 1:
+            raise UploadError(f"Chunk has {len(data)} bytes, Content-Range says {end - start + 1}")
+        if total > UPLOAD_MAX_FILE_BYTES:
+            raise UploadError(f"File is larger than {UPLOAD_MAX_FILE_BYTES} bytes", status=413)
+        upload = self._file(index, name, total)
+        with upload.lock:
+            if upload.error:
+                raise UploadError(upload.error)
+            if end < upload.received:
+                return upload.received
+            if start != upload.received:
+                raise UploadError(f"Expected offset {upload.received}", status=409, received=upload.received)
+            with open(upload.path, "r+b" if start else "wb") as f:
+                f.seek(start)
+                f.write(data)
+            upload.received = end + 1
+            self.updated_at = time.time()
+            if upload.complete:
+                self._on_file_complete(upload)
+            return upload.received
+
+    def _file(self, index, name, size):
+        with self._lock:
+            if self.closed:
+                raise UploadError("Upload session is closed", status=409)
+            upload = self.files.get(index)
+            if upload is None:
+                if not is_receipt_file(name):
+                    raise UploadError(f"Unsupported file type: {name}", status=415)
+                path = os.path.join(self.dir, f"{index:05d}{os.path.splitext(name)[1].lower()}")
+                upload = self.files[index] = UploadedFile(index, name, path, size)
+            elif upload.size != size:
+                raise UploadError(f"File {index} was started with size {upload.size}", status=409,
+                                  received=upload.received)
+            return upload
+
+    def _on_file_complete(self, upload):
+        """文件传完后按页展开，每张收据单独提交提取；无法读取的文件在事件流中记为失败并返回 400"""
+        try:
+            upload.refs = expand_receipt_paths([upload.path])
+        except UnreadableReceiptError as e:
+            upload.error = f"Cannot read PDF {upload.name}: {e.__cause__}"
+            self.progress.fail(upload.name, upload.error, file_index=upload.index)
+            raise UploadError(upload.error)
+        with self._lock:
+            self.progress.total = sum(len(f.refs) for f in self.files.values())
+            for ref in upload.refs:
+                self._extracted[ref] = threading.Event()
+                self._futures.append(self._executor.submit(self._extract, upload, ref))
+
+    def _extract(self, upload, ref):
+        try:
+            self._extract_one(upload, ref)
+        finally:
+            self._extracted[ref].set()
+
+    def _extract_one(self, upload, ref):
+        page_number = split_page_ref(ref)[1]
+        name = upload.name if page_number is None else f"{upload.name} (page {page_number})"
+        index = self.processor.dedup_index
+        if index is not None:
+            # 和已到达的收据比较，重复的不再提取，结束时复制代表收据的结果
+            with self._dedup_lock:
+                representative = index.assign([ref])[0]
+            if representative is not None:
+                self.duplicates[ref] = representative
+                # 代表收据先做了比较，已经在执行或已完成，这里等待不会占满线程池
+                self._extracted[representative].wait()
+                info = dict(self.results[representative], path=ref, duplicate_of=representative)
+                self.progress.add(name, info, file_index=upload.index, page=page_number)
+                return
+        self.results[ref] = self.processor.extract_info_from_image(ref)
+        self.progress.add(name, self.results[ref], file_index=upload.index, page=page_number)
+
+    def status(self):
+        files = sorted(self.files.values(), key=lambda f: f.index)
+        receipts = sum(len(f.refs) for f in files)
+        done = sum(1 for f in files for ref in f.refs if ref in self.results or ref in self.duplicates)
+        return {
+            "upload_id": self.id,
+            "files": [{"index": f.index, "name": f.name, "size": f.size, "received": f.received,
+                       "error": f.error} for f in files],
+            "receipts": receipts,
+            "extracted": done,
+            "closed": self.closed,
+        }
+
+    def receipts(self):
+        """等待所有提取完成，按文件序号和页码返回收据"""
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.result()
+        receipts = []
+        for upload in sorted(self.files.values(), key=lambda f: f.index):
+            for ref in upload.refs:
+                if ref in self.duplicates:
+                    representative = self.duplicates[ref]
+                    receipts.append(dict(self.results[representative], path=ref, duplicate_of=representative))
+                else:
+                    receipts.append(self.results[ref])
+        return receipts
+
+    def finish(self, output_path):
+        """所有文件传完后生成报告，返回总金额"""
+        with self._lock:
+            incomplete = [f.name for f in self.files.values() if not f.complete]
+            if incomplete:
+                raise UploadError(f"Files not fully uploaded: {', '.join(incomplete)}", status=409)
+            if not self.files:
+                raise UploadError("No files were uploaded")
+            unreadable = [f.error for f in self.files.values() if f.error]
+            if unreadable:
+                error = "; ".join(unreadable)
+                # 结束事件流，浏览器不必等到会话过期
+                self.progress.finish("failed", error=error)
+                raise UploadError(error)
+            self.closed = True
+        try:
+            with timed("upload_wait", self.trace):
+                receipts = self.receipts()
+            total_amount = sum(r['amount'] for r in receipts if 'duplicate_of' not in r)
+            write_report(output_path, receipts, total_amount, self.images_per_page,
+                         self.processor.images_per_row, trace=self.trace)
+        except Exception as e:
+            self.progress.finish("failed", error=str(e))
+            raise
+        self.progress.finish("done", total_amount=total_amount)
+        return total_amount
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.progress.finish("cancelled")
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class UploadManager:
+    """按 id 保存上传会话，清理空闲超时的会话"""
+
+    def __init__(self, processor_factory, max_sessions=UPLOAD_MAX_SESSIONS, ttl=UPLOAD_TTL):
+        self.processor_factory = processor_factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, images_per_page=4, trace=None, engine=None):
+        self.expire()
+        with self._lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise UploadError(f"Too many uploads in progress ({self.max_sessions})", status=503)
+            # output_path 不会被用到：报告由会话自己生成
+            processor = self.processor_factory(engine=engine, output_path=os.devnull,
+                                               images_per_page=images_per_page)
+            processor.trace = trace
+            session = UploadSession(processor, images_per_page, trace)
+            self.sessions[session.id] = session
+        return session
+
+    def get(self, upload_id):
+        return self.sessions.get(upload_id)
+
+    def discard(self, upload_id):
+        with self._lock:
+            session = self.sessions.pop(upload_id, None)
+        if session is not None:
+            session.close()
+
+    def expire(self):
+        now = time.time()
+        expired = [s.id for s in list(self.sessions.values()) if now - s.updated_at > self.ttl]
+        for upload_id in expired:
+            logging.info(f"Discarding idle upload {upload_id}")
+            self.discard(upload_id)
+
@@ -0,0 +1,249 @@
+"""基于 SQLite 的持久任务队列，app 前端和多个 worker 进程（或机器）共用
+
+任务被 worker 领取后有一个租约，worker 定期续约；worker 崩溃、租约过期的任务会被其他 worker 重新领取，
+失败或过期超过 WORK_MAX_ATTEMPTS 次后标记为 failed。队列文件放在共享存储上时，
+把 WORK_QUEUE_JOURNAL 设为 DELETE：WAL 模式依赖共享内存，只能在同一台机器上使用。
+"""
+import os
+import sqlite3
+import threading
+import time
+from receipt_cache import dump_result, load_result
+
+# 设置后 /upload 和 /jobs 的提取和渲染交给 worker（python receipt_worker.py）
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH")
+# 上传文件和生成报告的目录，前端和所有 worker 都必须能访问；默认系统临时目录
+WORK_DIR = os.getenv("WORK_DIR") or None
+WORK_QUEUE_JOURNAL = os.getenv("WORK_QUEUE_JOURNAL", "WAL")
+# 租约时长和续约间隔（秒）；worker 停止续约超过租约时长后任务会被重新领取
+LEASE_SECONDS = float(os.getenv("WORK_LEASE_SECONDS", "30"))
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "3"))
+# 前端等待结果、worker 空闲时查询队列的间隔（秒）
+POLL_INTERVAL = float(os.getenv("WORK_POLL_INTERVAL", "0.05"))
+
+_default_queue = None
+_default_queue_lock = threading.Lock()
+
+
+class Task:
+    """一条任务；payload 和 result 是可以包含 datetime 的 JSON 对象"""
+
+    def __init__(self, task_id, job, kind, payload, status="queued", attempts=0, result=None, error=None):
+        self.id = task_id
+        self.job = job
+        self.kind = kind
+        self.payload = payload
+        self.status = status
+        self.attempts = attempts
+        self.result = result
+        self.error = error
+
+
+class WorkQueue:
+    """任务表：queued -> leased -> done / failed
+
+    完成或失败时给任务分配递增的 seq，前端按 seq 增量读取结果，不用每次读全部任务。
+    """
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=WORK_MAX_ATTEMPTS,
+                 journal_mode=WORK_QUEUE_JOURNAL):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # timeout：其他进程持有写锁时等待而不是立即报错
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                result TEXT,
+                error TEXT,
+                seq INTEGER,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_job ON tasks(job, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_seq ON tasks(seq)")
+
+    def _write(self, fn):
+        """在 BEGIN IMMEDIATE 事务中执行 fn(conn)，跨进程串行化写入"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return value
+
+    def put_many(self, job, kind, payloads):
+        """提交一组任务，返回任务 id 列表"""
+        now = time.time()
+
+        def insert(conn):
+            return [conn.execute(
+                "INSERT INTO tasks (job, kind, payload, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job, kind, dump_result(payload), now)
+            ).lastrowid for payload in payloads]
+        return self._write(insert)
+
+    def put(self, job, kind, payload):
+        return self.put_many(job, kind, [payload])[0]
+
+    def lease(self, worker):
+        """领取最早的可执行任务（排队中或租约已过期），没有时返回 None"""
+        # 先用只读查询检查，空闲的 worker 轮询时不抢写锁
+        with self._lock:
+            if self._conn.execute(
+                "SELECT 1 FROM tasks WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?) LIMIT 1",
+                (time.time(),)
+            ).fetchone() is None:
+                return None
+
+        def claim(conn):
+            now = time.time()
+            while True:
+                row = conn.execute(
+                    """SELECT id, job, kind, payload, attempts, error FROM tasks
+                       WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?)
+                       ORDER BY id LIMIT 1""", (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+                task_id, job, kind, payload, attempts, error = row
+                if attempts >= self.max_attempts:
+                    # 已经尝试了足够多次（例如每次都让 worker 崩溃），不再重试
+                    self._finish(conn, task_id, "failed", None,
+                                 error or f"Lease expired {attempts} times without a result")
+                    continue
+                conn.execute(
+                    """UPDATE tasks SET status = 'leased', worker = ?, attempts = attempts + 1,
+                       lease_until = ? WHERE id = ?""",
+                    (worker, now + self.lease_seconds, task_id)
+                )
+                return Task(task_id, job, kind, load_result(payload), "leased", attempts + 1)
+        return self._write(claim)
+
+    def heartbeat(self, task_ids, worker):
+        """为 worker 持有的任务续约，返回仍然持有的任务 id"""
+        if not task_ids:
+            return set()
+        until = time.time() + self.lease_seconds
+
+        def renew(conn):
+            held = set()
+            for task_id in task_ids:
+                cursor = conn.execute(
+                    "UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (until, task_id, worker)
+                )
+                if cursor.rowcount:
+                    held.add(task_id)
+            return held
+        return self._write(renew)
+
+    @staticmethod
+    def _finish(conn, task_id, status, result, error):
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM tasks").fetchone()[0]
+        conn.execute(
+            "UPDATE tasks SET status = ?, result = ?, error = ?, seq = ?, lease_until = NULL WHERE id = ?",
+            (status, None if result is None else dump_result(result), error, seq, task_id)
+        )
+
+    def complete(self, task_id, worker, result):
+        """写入结果；租约过期后任务已经被别的 worker 领取时返回 False，丢弃这次的结果"""
+        def finish(conn):
+            row = conn.execute("SELECT status, worker FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if row is None or row[0] != "leased" or row[1] != worker:
+                return False
+            self._finish(conn, task_id, "done", result, None)
+            return True
+        return self._write(finish)
+
+    def fail(self, task_id, worker, error):
+        """任务出错：还有重试次数时重新排队，否则标记为 failed"""
+        def finish(conn):
+            row = conn.execute("SELECT status, worker, attempts FROM tasks WHERE id = ?",
+                               (task_id,)).fetchone()
+            if row is None or row[0] != "leased" or row[1] != worker:
+                return False
+            if row[2] < self.max_attempts:
+                conn.execute(
+                    "UPDATE tasks SET status = 'queued', worker = NULL, lease_until = NULL, error = ? WHERE id = ?",
+                    (error, task_id)
+                )
+            else:
+                self._finish(conn, task_id, "failed", None, error)
+            return True
+        return self._write(finish)
+
+    def finished(self, job, after_seq=0):
+        """job 中 seq 大于 after_seq 的已结束任务，按完成顺序返回 [(seq, Task)]"""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT seq, id, kind, status, attempts, result, error FROM tasks
+                   WHERE job = ? AND seq > ? ORDER BY seq""", (job, after_seq)
+            ).fetchall()
+        return [(seq, Task(task_id, job, kind, None, status, attempts,
+                           None if result is None else load_result(result), error))
+                for seq, task_id, kind, status, attempts, result, error in rows]
+
+    def wait(self, job, task_ids, timeout=None, poll=POLL_INTERVAL):
+        """按完成顺序逐个产出 task_ids 中的任务，全部结束后返回；超时抛出 TimeoutError"""
+        pending = set(task_ids)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        last_seq = 0
+        while pending:
+            for seq, task in self.finished(job, last_seq):
+                last_seq = seq
+                if task.id in pending:
+                    pending.discard(task.id)
+                    yield task
+            if not pending:
+                return
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"{len(pending)} tasks of job {job} did not finish in time")
+            time.sleep(poll)
+
+    def count(self, status):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tasks WHERE status = ?", (status,)).fetchone()[0]
+
+    def delete_job(self, job):
+        """删除任务记录；任务在执行中时 worker 的结果会被丢弃"""
+        self._write(lambda conn: conn.execute("DELETE FROM tasks WHERE job = ?", (job,)))
+
+    def purge(self, older_than):
+        """删除创建时间早于 older_than 秒之前的任务，例如前端崩溃后遗留的任务"""
+        cutoff = time.time() - older_than
+        self._write(lambda conn: conn.execute("DELETE FROM tasks WHERE created_at < ?", (cutoff,)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_work_queue():
+    """设置了 WORK_QUEUE_PATH 时返回进程内共享的队列，否则返回 None（在本进程内处理）"""
+    global _default_queue
+    if not WORK_QUEUE_PATH:
+        return None
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = WorkQueue(WORK_QUEUE_PATH)
+        return _default_queue